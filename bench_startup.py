@@ -0,0 +1,47 @@
+"""
+启动耗时基准测试：分别测量导入 bot 模块与构建 Application 的耗时。
+
+用法：python bench_startup.py [次数]
+
+每一轮都在新的子进程中执行，避免模块缓存影响结果；
+不会连接 Telegram，也不会调用 set_my_commands。
+"""
+import os
+import sys
+import json
+import statistics
+import subprocess
+
+ROUNDS = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+PROBE = r"""
+import json, time
+t0 = time.perf_counter()
+import bot
+t1 = time.perf_counter()
+bot.build_application("123456:bench")
+t2 = time.perf_counter()
+print(json.dumps({"import": t1 - t0, "build": t2 - t1}))
+"""
+
+def run_once():
+    env = dict(os.environ, TELEGRAM_BOT_TOKEN="123456:bench")
+    output = subprocess.check_output(
+        [sys.executable, "-c", PROBE],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        stderr=subprocess.DEVNULL,
+    )
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+def main():
+    results = [run_once() for _ in range(ROUNDS)]
+    for key in ("import", "build"):
+        values = [r[key] * 1000 for r in results]
+        print(f"{key:>6}: 中位数 {statistics.median(values):7.1f} ms, "
+              f"最小 {min(values):7.1f} ms, 最大 {max(values):7.1f} ms ({ROUNDS} 次)")
+    totals = [(r["import"] + r["build"]) * 1000 for r in results]
+    print(f" total: 中位数 {statistics.median(totals):7.1f} ms")
+
+if __name__ == '__main__':
+    main()
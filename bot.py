@@ -3,14 +3,27 @@ import configparser
 import sys
 import time
 import random
+import hashlib
 import httpx
-import aiohttp
 import logging
 import traceback
 import re
-from telegram import Update, Bot, BotCommand, InlineKeyboardButton, InlineKeyboardMarkup
+import json
+import asyncio
+import contextlib
+import collections
+import secrets
+import codecs
+import urllib.parse
+import signal
+import threading
+from datetime import datetime, timedelta
+from telegram import (Update, Bot, BotCommand, InlineKeyboardButton, InlineKeyboardMarkup,
+                      InlineQueryResultArticle, InputTextMessageContent, InlineQueryResultsButton)
 from telegram.ext import (ApplicationBuilder, CommandHandler, MessageHandler, filters,
-                          ContextTypes, ConversationHandler, CallbackQueryHandler)
+                          ContextTypes, ConversationHandler, CallbackQueryHandler,
+                          TypeHandler, ApplicationHandlerStop, InlineQueryHandler)
+from telegram.error import BadRequest, Forbidden, RetryAfter
 
 # 修改：明确指定日志文件路径
 LOG_FILE = os.path.join(os.path.dirname(__file__), 'bot.log')
@@ -32,12 +45,13 @@ logging.basicConfig(
 logging.getLogger('telegram').setLevel(logging.WARNING)
 logging.getLogger('telegram.ext').setLevel(logging.WARNING)
 logging.getLogger('urllib3').setLevel(logging.WARNING)
-logging.getLogger('aiohttp').setLevel(logging.WARNING)
 logging.getLogger('httpx').setLevel(logging.WARNING)
 
 CONFIG_FILE = 'config.ini'
+CONFIG_WATCH_INTERVAL = int(os.environ.get('CONFIG_WATCH_INTERVAL', '5'))
 ASK_REFRESH_TOKEN = 1
 ASK_CID = 2  # 新增CID请求状态
+ASK_ACCOUNT_TOKEN = 3  # 新增：添加额外账号时请求 refresh_token
 
 API_REFRESH_URL = "https://passportapi.115.com/open/refreshToken"
 API_ADD_TASK_URL = "https://proapi.115.com/open/offline/add_task_urls"
@@ -46,59 +60,974 @@ API_ADD_TASK_URL = "https://proapi.115.com/open/offline/add_task_urls"
 # 示例: https://my.telegram.proxy
 TELEGRAM_API_BASE_URL = os.environ.get('TELEGRAM_API_BASE_URL') or os.environ.get('TELEGRAM_API_URL')
 
+# 本地状态文件：保存待提交队列等需要持久化、但不适合写入 config.ini 的数据
+STATE_FILE = os.environ.get('BOT_STATE_FILE', 'state.json')
+# 待提交队列和操作检查点每次变更都要立即写入，单独保存在一个小文件中（默认 state.durable.json），
+# 不必每次都重写包含快照、索引的整个状态文件
+DURABLE_STATE_PREFIXES = ("pending_tasks_", "checkpoint_")
+DURABLE_STATE_FILE = os.environ.get('BOT_DURABLE_STATE_FILE') or "{0}.durable{1}".format(*os.path.splitext(STATE_FILE))
+
+# 多进程/多实例部署：WORKER_COUNT 个 worker 按用户 ID 划分更新和后台任务，
+# 每个 worker 只处理 user_id % WORKER_COUNT == WORKER_INDEX 的用户，收到其他用户的更新时转发给对应的 worker。
+# 多 worker 时必须使用 webhook 模式；设置 SHARED_STATE_DB 后本地状态和 token 刷新锁保存在共享的 SQLite 数据库中
+WORKER_COUNT = max(1, int(os.environ.get('WORKER_COUNT', '1')))
+WORKER_INDEX = int(os.environ.get('WORKER_INDEX', '0'))
+SHARED_STATE_DB = os.environ.get('SHARED_STATE_DB')
+TOKEN_REFRESH_LEASE = 30  # 刷新 token 的租约时长（秒），持有租约的进程崩溃后由其他进程接管
+# 写入共享数据库时等待锁的最长时间（秒），写入在后台线程中进行；
+# 读取使用单独的连接，WAL 模式下读取不会等待写入，超时设得很短以免阻塞事件循环
+STATE_DB_WRITE_TIMEOUT = 30
+STATE_DB_READ_TIMEOUT = 1
+WORKER_ID = f"{WORKER_INDEX}-{os.getpid()}"
+
+# webhook 模式：设置 WEBHOOK_URL（Telegram 推送更新的公网地址）后启用，否则使用轮询
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+# 各 worker 的内部 webhook 地址（逗号分隔，按 WORKER_INDEX 排列）；
+# 未设置时所有 worker 运行在同一台机器上，第 i 个 worker 监听 WEBHOOK_PORT + i
+WORKER_ENDPOINTS = [url.strip() for url in os.environ.get('WORKER_ENDPOINTS', '').split(',') if url.strip()]
+
+# 本地状态的定期写入间隔（秒）；待提交队列等关键数据变更时会立即写入
+STATE_FLUSH_INTERVAL = int(os.environ.get('STATE_FLUSH_INTERVAL', '60'))
+
+# 优雅停机：收到 SIGTERM/SIGINT 后不再处理新的更新，最多等待 SHUTDOWN_DEADLINE 秒让进行中的清理、整理等操作完成，
+# 超时的操作被中断并保留检查点，下次启动后 RESUME_DELAY 秒起自动重新执行；应小于容器的停止宽限期（如 docker stop -t）
+SHUTDOWN_DEADLINE = float(os.environ.get('SHUTDOWN_DEADLINE', '20'))
+# 中断后再等待 SHUTDOWN_FORCE_GRACE 秒仍未停止（例如有未登记的操作在运行）时，写入状态后直接退出进程
+SHUTDOWN_FORCE_GRACE = 5
+RESUME_DELAY = 30
+
+# 待提交队列：因配额不足、限流或网络错误未能提交的链接，由后台任务每 PENDING_DRAIN_INTERVAL 秒尝试重新提交，
+# 连续失败时按指数退避（最长 PENDING_MAX_BACKOFF 秒），超过 PENDING_MAX_AGE 秒仍未提交的链接会被丢弃并通知用户
+PENDING_DRAIN_INTERVAL = int(os.environ.get('PENDING_DRAIN_INTERVAL', '60'))
+PENDING_MAX_BACKOFF = int(os.environ.get('PENDING_MAX_BACKOFF', '3600'))
+PENDING_MAX_AGE = int(os.environ.get('PENDING_MAX_AGE', str(7 * 24 * 3600)))
+
+# 115 未公开离线任务的错误码，只能根据错误信息判断是否属于配额不足、限流或网络错误等可重试的失败
+DEFERRABLE_ERROR_KEYWORDS = ("配额", "quota", "频繁", "繁忙", "稍后", "请求过程中发生异常")
+
+# 批量移动/删除：每个请求最多携带 BULK_CHUNK_SIZE 个 ID，最多 BULK_CONCURRENCY 个请求并发
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', '500'))
+BULK_CONCURRENCY = int(os.environ.get('BULK_CONCURRENCY', '3'))
+# 网络错误、限流或服务器错误时整个分块最多重试 BULK_RETRIES 次（间隔 1、2、4... 秒），不拆分分块
+BULK_RETRIES = 3
+
+# 提交离线任务时每次请求最多携带 SUBMIT_CHUNK_SIZE 个链接；删除云下载任务时最多 BULK_CONCURRENCY 个请求并发
+SUBMIT_CHUNK_SIZE = int(os.environ.get('SUBMIT_CHUNK_SIZE', '100'))
+
+# 文件导入：用户发送的 .txt 链接列表和 .torrent 文件边下载边解析，不整体读入内存；
+# Telegram Bot API 只允许下载不超过 20MB 的文件，每个文件最多导入 DOCUMENT_MAX_LINKS 个链接
+DOCUMENT_MAX_SIZE = 20 * 1024 * 1024
+DOCUMENT_MAX_LINKS = int(os.environ.get('DOCUMENT_MAX_LINKS', '5000'))
+DOCUMENT_CHUNK_SIZE = 64 * 1024
+LINK_PATTERN = re.compile(r"(?:magnet:\?|ed2k://|thunder://|ftp://|https?://)[^\s\"'<>]+", re.IGNORECASE)
+
+# 递归遍历：最多深入 WALK_MAX_DEPTH 层子文件夹，最多 WALK_CONCURRENCY 个文件夹并发列出
+WALK_MAX_DEPTH = int(os.environ.get('WALK_MAX_DEPTH', '5'))
+WALK_CONCURRENCY = int(os.environ.get('WALK_CONCURRENCY', '4'))
+
+# 归档分组：每个 group_xxx 文件夹最多存放 GROUP_CAPACITY 个文件；分组及其文件数保存在本地索引中，
+# 由我们自己的移动操作更新，每隔 GROUP_INDEX_RECONCILE_INTERVAL 秒与服务器校对一次
+GROUP_CAPACITY = 200
+GROUP_INDEX_RECONCILE_INTERVAL = int(os.environ.get('GROUP_INDEX_RECONCILE_INTERVAL', str(24 * 3600)))
+
+# 归档去重：按 sha1 + 文件大小为归档分组建立内容哈希索引，/cleanup 跳过归档中已存在的视频；
+# 索引由归档操作增量更新，每隔 HASH_INDEX_REBUILD_INTERVAL 秒或执行 /dedup 时重建
+HASH_INDEX_REBUILD_INTERVAL = int(os.environ.get('HASH_INDEX_REBUILD_INTERVAL', str(7 * 24 * 3600)))
+
+# 内联搜索（@bot 关键词）：在本地索引中查找文件夹名称和最近的云下载任务，不在每次输入时请求 115。
+# 索引在首次搜索时建立，之后由后台任务每隔 SEARCH_TASKS_REFRESH_INTERVAL 秒刷新任务列表、
+# 每隔 SEARCH_FOLDERS_REFRESH_INTERVAL 秒重建文件夹索引（最多 SEARCH_INDEX_DEPTH 层、SEARCH_INDEX_MAX_FOLDERS 个文件夹）；
+# 超过 SEARCH_INDEX_IDLE 秒没有搜索的用户不再刷新
+SEARCH_TASKS_REFRESH_INTERVAL = int(os.environ.get('SEARCH_TASKS_REFRESH_INTERVAL', '300'))
+SEARCH_FOLDERS_REFRESH_INTERVAL = int(os.environ.get('SEARCH_FOLDERS_REFRESH_INTERVAL', '3600'))
+SEARCH_INDEX_DEPTH = int(os.environ.get('SEARCH_INDEX_DEPTH', '3'))
+SEARCH_INDEX_MAX_FOLDERS = int(os.environ.get('SEARCH_INDEX_MAX_FOLDERS', '5000'))
+SEARCH_INDEX_IDLE = 7 * 24 * 3600
+SEARCH_USED_RESOLUTION = 60  # 最近搜索时间只用于判断是否闲置，最多每 60 秒记录一次，避免每次按键都写入状态
+SEARCH_MAX_RESULTS = 50  # Telegram 每次最多返回 50 条内联结果
+
+# 定时任务：用户可以用 cron 表达式（分 时 日 月 周，按服务器本地时间）定时执行 /cleanup 或 /organize_videos。
+# 每个用户的任务在触发时间后固定错开 0~SCHEDULE_STAGGER 秒（由用户 ID 决定），再加上 0~SCHEDULE_JITTER 秒的随机延迟，
+# 避免所有用户在同一分钟请求 115；下载文件夹自该任务上次成功执行以来没有变化时跳过本次执行
+SCHEDULE_STAGGER = int(os.environ.get('SCHEDULE_STAGGER', '600'))
+SCHEDULE_JITTER = int(os.environ.get('SCHEDULE_JITTER', '60'))
+CRON_FIELD_RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+# 清理和整理的执行结果：完成、快照没有变化而跳过、没有需要处理的内容、缺少文件夹设置无法执行；
+# 定时任务只在快照没有变化时静默跳过，其余结果都通知用户
+TASK_DONE, TASK_UNCHANGED, TASK_NOTHING, TASK_NOT_CONFIGURED = "done", "unchanged", "nothing", "not_configured"
+
+# 整理和清理使用的文件分类规则（规则语法见 compile_rule），用户可通过 /set_rule 为 /apply_rules 定义自己的规则
+ORGANIZE_RULES = ["type=video; min_size=200MB; action=move"]
+CLEANUP_RULES = ["type=video; action=archive"]
+SIZE_UNITS = {"B": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3, "TB": 1024 ** 4}
+
+# 文件夹快照：下载/归档文件夹的本地快照（以 fid 为键，记录修改时间），
+# 按修改时间倒序增量同步，只处理新增或变更的项目；每隔 SNAPSHOT_FULL_SYNC_INTERVAL 秒做一次全量校对
+SNAPSHOT_FULL_SYNC_INTERVAL = int(os.environ.get('SNAPSHOT_FULL_SYNC_INTERVAL', str(6 * 3600)))
+VIDEO_EXTENSIONS = {"mp4", "mkv", "avi", "wmv", "mov", "flv", "rmvb", "rm", "ts", "m2ts", "mpg", "mpeg", "m4v", "webm", "iso"}
+
+# 配额缓存：(user_id, account) -> {"count", "used", "surplus", "data", "updated_at"}
+# 由后台任务按 QUOTA_REFRESH_INTERVAL（秒）定期刷新，提交任务时直接读取，避免每次提交都请求配额接口；
+# 成功提交后在本地扣减剩余配额，超过 QUOTA_CACHE_TTL（秒）的缓存在读取时重新校验。
+QUOTA_CACHE = {}
+QUOTA_REFRESH_INTERVAL = int(os.environ.get('QUOTA_REFRESH_INTERVAL', '600'))
+QUOTA_CACHE_TTL = int(os.environ.get('QUOTA_CACHE_TTL', '300'))
+
+# 管理员（逗号分隔的 Telegram 用户 ID）可以使用 /usage 和 /broadcast
+ADMIN_USER_IDS = {uid.strip() for uid in os.environ.get('ADMIN_USER_IDS', '').split(',') if uid.strip()}
+# 用量统计：每个用户提交的链接数、115 API 调用次数、移动和归档的字节数，先在内存中累加，每隔 USAGE_FLUSH_INTERVAL 秒写入本地状态
+USAGE_FLUSH_INTERVAL = int(os.environ.get('USAGE_FLUSH_INTERVAL', '60'))
+USAGE_FIELDS = {"links": "提交链接", "api_calls": "API 调用", "bytes_moved": "移动", "bytes_archived": "归档"}
+# 广播每秒最多发送 BROADCAST_RATE 条消息，低于 Telegram 的群发限制（约 30 条/秒）
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', '20'))
+
+# 新增：所有 115 接口请求共用一个 httpx 连接池（python-telegram-bot 本身也使用 httpx），
+# 各用户的 access_token 通过 Api115Client 附加到每个请求上
+HTTP_TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', '30'))
+_HTTP_CLIENT = None
+
+# 录制：设置 RECORD_CASSETTE（文件路径）后，把启动时的配置和本地状态、收到的 Telegram 更新以及 115 接口的请求和响应
+# 写入该文件（每行一个 JSON，启动时覆盖），供 replay.py 离线回放；其中的 token 均被替换为 SCRUBBED
+RECORD_CASSETTE = os.environ.get('RECORD_CASSETTE')
+SCRUBBED = "<scrubbed>"
+SCRUBBED_KEYS = {"access_token", "refresh_token", "token", "authorization"}
+_RECORDER = None
+
+def get_http_client():
+    global _HTTP_CLIENT
+    if _HTTP_CLIENT is None or _HTTP_CLIENT.is_closed:
+        _HTTP_CLIENT = httpx.AsyncClient(
+            timeout=HTTP_TIMEOUT,
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+        )
+        if _RECORDER is not None:
+            _HTTP_CLIENT = RecordingHttpClient(_HTTP_CLIENT, _RECORDER)
+    return _HTTP_CLIENT
+
+async def close_http_client():
+    global _HTTP_CLIENT
+    if _HTTP_CLIENT is not None:
+        await _HTTP_CLIENT.aclose()
+        _HTTP_CLIENT = None
+
+class Api115Client:
+    """
+    共享连接池上的 115 接口客户端，接口与 httpx.AsyncClient 的 get/post 相同，退出 async with 时不关闭连接池。
+    传入 user_id 时每个请求计入该用户的 API 调用次数。
+    """
+
+    def __init__(self, access_token, timeout=None, user_id=None):
+        self.headers = {"Authorization": f"Bearer {access_token}"}
+        self.timeout = timeout or HTTP_TIMEOUT
+        self.user_id = user_id
+
+    async def get(self, url, **kwargs):
+        if self.user_id:
+            record_usage(self.user_id, api_calls=1)
+        return await get_http_client().get(url, headers=self.headers, timeout=self.timeout, **kwargs)
+
+    async def post(self, url, **kwargs):
+        if self.user_id:
+            record_usage(self.user_id, api_calls=1)
+        return await get_http_client().post(url, headers=self.headers, timeout=self.timeout, **kwargs)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+# 新增函数：录制 Telegram 更新和 115 接口响应
+def scrub_secrets(value):
+    """把字典中名为 access_token、refresh_token 等的值替换为 SCRUBBED（递归处理）"""
+    if isinstance(value, dict):
+        return {key: SCRUBBED if str(key).lower() in SCRUBBED_KEYS else scrub_secrets(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [scrub_secrets(item) for item in value]
+    return value
+
+class CassetteRecorder:
+    """把录制的事件逐行写入 cassette 文件：{"kind": 类型, "t": 距开始录制的秒数, ...}"""
+
+    def __init__(self, path):
+        self.file = open(path, 'w', encoding='utf-8')
+        self.started = time.monotonic()
+
+    def write(self, kind, **fields):
+        event = {"kind": kind, "t": round(time.monotonic() - self.started, 3), **scrub_secrets(fields)}
+        self.file.write(json.dumps(event, ensure_ascii=False) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class RecordingHttpClient:
+    """包装共享的 httpx 客户端，记录每个请求的参数、响应和耗时（不记录请求头）"""
+
+    def __init__(self, client, recorder):
+        self.client = client
+        self.recorder = recorder
+
+    @property
+    def is_closed(self):
+        return self.client.is_closed
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def get(self, url, **kwargs):
+        return await self._request("GET", self.client.get, url, kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self._request("POST", self.client.post, url, kwargs)
+
+    def stream(self, method, url, **kwargs):
+        # 用于下载 Telegram 文件，URL 中含有机器人 token，不录制
+        return self.client.stream(method, url, **kwargs)
+
+    async def _request(self, method, send, url, kwargs):
+        request = {"method": method, "url": url, "params": kwargs.get("params"), "data": kwargs.get("data"), "json": kwargs.get("json")}
+        started = time.monotonic()
+        try:
+            response = await send(url, **kwargs)
+        except httpx.HTTPError as e:
+            self.recorder.write("http", **request, error=type(e).__name__, elapsed=round(time.monotonic() - started, 3))
+            raise
+        try:
+            body, text = response.json(), None
+        except ValueError:
+            body, text = None, response.text
+        self.recorder.write("http", **request, status=response.status_code, body=body, text=text,
+                            elapsed=round(time.monotonic() - started, 3))
+        return response
+
+def start_recording(path):
+    """开始录制：先写入当前的配置和本地状态（token 已替换），回放时以此作为初始状态"""
+    global _RECORDER, _HTTP_CLIENT
+    logging.info(f"录制 Telegram 更新和 115 接口响应到 {path}")
+    _RECORDER = CassetteRecorder(path)
+    _HTTP_CLIENT = None  # 下次获取时包装为 RecordingHttpClient
+    config = read_config()
+    _RECORDER.write("start", wall=time.time(),
+                    config={section: dict(config[section]) for section in config.sections()},
+                    state=_get_state())
+
+async def record_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """最先运行：记录收到的更新；用户正在输入 refresh_token（/set_refresh_token、/add_account）时消息文本替换为 SCRUBBED"""
+    data = update.to_dict()
+    message = data.get("message") or {}
+    if context.user_data and 'pending_account' in context.user_data and not message.get("text", "/").startswith("/"):
+        message["text"] = SCRUBBED
+    _RECORDER.write("update", update=data)
+
 def get_bot_token():
     logging.info("Executing: get_bot_token")
     token = os.environ.get("TELEGRAM_BOT_TOKEN")
     if token:
         return token
 
-    config = configparser.ConfigParser()
-    if os.path.exists(CONFIG_FILE):
-        config.read(CONFIG_FILE)
-        if 'telegram' in config and 'token' in config['telegram']:
-            return config['telegram']['token']
+    config = read_config()
+    if 'telegram' in config and 'token' in config['telegram']:
+        return config['telegram']['token']
 
     logging.error("未找到 TELEGRAM_BOT_TOKEN 环境变量，且 config.ini 中也无 token。")
     sys.exit(1)
 
-def read_config():
-    logging.info("Executing: read_config")
+# 配置只在启动时从磁盘加载一次，之后的读写都在内存中进行：
+# - 后台任务每 CONFIG_WATCH_INTERVAL 秒检查 config.ini 的修改时间，发现手动编辑后重新加载并与内存中的改动合并；
+# - 所有写入都交给唯一的写入任务，由它先合并磁盘上的外部修改，再原子地写回文件。
+_CONFIG = None
+_CONFIG_BASE = {}       # 上次从磁盘加载或写入磁盘时的内容，作为三方合并的基准
+_CONFIG_STAT = None     # 上次加载或写入后 config.ini 的 (mtime_ns, size)
+_CONFIG_DIRTY = False
+_CONFIG_WRITE_EVENT = None
+_CONFIG_WRITER_TASK = None
+
+def _config_stat():
+    try:
+        st = os.stat(CONFIG_FILE)
+        return st.st_mtime_ns, st.st_size
+    except FileNotFoundError:
+        return None
+
+def _config_to_dict(config):
+    return {section: dict(config.items(section, raw=True)) for section in config.sections()}
+
+def _config_from_dict(data):
+    config = configparser.ConfigParser()
+    config.read_dict(data)
+    return config
+
+def _load_config_file():
     config = configparser.ConfigParser()
     if os.path.exists(CONFIG_FILE):
         config.read(CONFIG_FILE)
     return config
 
+def merge_config(base, local, remote):
+    """
+    三方合并配置：某个键在内存中相对基准有改动时以内存为准，否则采用磁盘上的值。
+    三个参数及返回值都是 {section: {key: value}}。
+    """
+    merged = {}
+    for section in dict.fromkeys([*local, *remote, *base]):
+        b, l, r = base.get(section), local.get(section), remote.get(section)
+        values = {}
+        for key in dict.fromkeys([*(l or {}), *(r or {}), *(b or {})]):
+            base_value = (b or {}).get(key)
+            local_value = (l or {}).get(key)
+            value = (r or {}).get(key) if local_value == base_value else local_value
+            if value is not None:
+                values[key] = value
+        # 空的段只在某一方新建、且另一方没有删除它时保留
+        keep_section = l is not None and r is not None or (l is not None and b is None) or (r is not None and b is None)
+        if values or keep_section:
+            merged[section] = values
+    return merged
+
+def read_config():
+    """返回内存中的配置，首次调用时从磁盘加载"""
+    global _CONFIG, _CONFIG_BASE, _CONFIG_STAT
+    if _CONFIG is None:
+        _CONFIG_STAT = _config_stat()
+        _CONFIG = _load_config_file()
+        _CONFIG_BASE = _config_to_dict(_CONFIG)
+    return _CONFIG
+
+def reload_config_if_changed():
+    """config.ini 在外部被修改时重新加载，并保留内存中尚未写入的改动；返回是否重新加载"""
+    global _CONFIG, _CONFIG_BASE, _CONFIG_STAT
+    read_config()
+    stat = _config_stat()
+    if stat == _CONFIG_STAT:
+        return False
+    logging.info("检测到 config.ini 被外部修改，重新加载配置")
+    remote = _config_to_dict(_load_config_file())
+    merged = merge_config(_CONFIG_BASE, _config_to_dict(_CONFIG), remote)
+    # 先构建完整的新配置再替换引用，读取方不会看到加载到一半的配置
+    _CONFIG = _config_from_dict(merged)
+    _CONFIG_BASE = remote
+    _CONFIG_STAT = stat
+    # token 可能被手动修改，丢弃解密缓存
+    _TOKEN_CACHE.clear()
+    return True
+
+@contextlib.contextmanager
+def _config_file_lock():
+    """多个 worker 共用 config.ini 时，用文件锁串行化各进程的“合并-写入”"""
+    if WORKER_COUNT <= 1:
+        yield
+        return
+    import fcntl
+    with open(CONFIG_FILE + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _persist_config():
+    """合并外部修改后原子地写入 config.ini，只应由写入任务（或未启动写入任务时的 write_config）调用"""
+    global _CONFIG_BASE, _CONFIG_STAT, _CONFIG_DIRTY
+    with _config_file_lock():
+        reload_config_if_changed()
+        _CONFIG_DIRTY = False
+        tmp_file = CONFIG_FILE + '.tmp'
+        with open(tmp_file, 'w') as f:
+            _CONFIG.write(f)
+        os.replace(tmp_file, CONFIG_FILE)
+    _CONFIG_BASE = _config_to_dict(_CONFIG)
+    _CONFIG_STAT = _config_stat()
+
 def write_config(config):
+    """标记配置已修改并通知写入任务；写入任务未启动时直接写入"""
+    global _CONFIG_DIRTY
     logging.info("Executing: write_config")
-    with open(CONFIG_FILE, 'w') as f:
-        config.write(f)
+    _CONFIG_DIRTY = True
+    if _CONFIG_WRITE_EVENT is not None:
+        _CONFIG_WRITE_EVENT.set()
+    else:
+        _persist_config()
 
-def load_user_tokens(user_id):
-    logging.info("Executing: load_user_tokens")
+async def config_writer():
+    """唯一的配置写入任务"""
+    while True:
+        await _CONFIG_WRITE_EVENT.wait()
+        _CONFIG_WRITE_EVENT.clear()
+        try:
+            if _CONFIG_DIRTY:
+                _persist_config()
+        except Exception:
+            logging.error(f"写入配置文件失败:\n{traceback.format_exc()}")
+
+def start_config_writer():
+    global _CONFIG_WRITE_EVENT, _CONFIG_WRITER_TASK
+    read_config()
+    _CONFIG_WRITE_EVENT = asyncio.Event()
+    _CONFIG_WRITER_TASK = asyncio.create_task(config_writer())
+
+async def stop_config_writer():
+    """停止写入任务，并写入尚未写入的改动"""
+    global _CONFIG_WRITE_EVENT, _CONFIG_WRITER_TASK
+    if _CONFIG_WRITER_TASK is not None:
+        _CONFIG_WRITER_TASK.cancel()
+        try:
+            await _CONFIG_WRITER_TASK
+        except asyncio.CancelledError:
+            pass
+    _CONFIG_WRITE_EVENT = _CONFIG_WRITER_TASK = None
+    if _CONFIG_DIRTY:
+        _persist_config()
+
+async def config_watch_job(context: ContextTypes.DEFAULT_TYPE):
+    """后台定期检查 config.ini 是否被外部修改"""
+    try:
+        reload_config_if_changed()
+    except Exception:
+        logging.error(f"重新加载配置文件失败:\n{traceback.format_exc()}")
+
+# 每个 Telegram 用户可以绑定多个 115 账号：
+# 默认账号的令牌和文件夹设置保存在 [user_<id>] 中（兼容旧配置），
+# 额外账号保存在 [account_<id>_<name>] 中。
+DEFAULT_ACCOUNT = "default"
+ACCOUNT_NAME_PATTERN = re.compile(r"^[\w-]{1,32}$")
+USER_SECTION_PATTERN = re.compile(r"^user_(\d+)$")
+
+# token 加密：设置 TOKEN_ENCRYPTION_KEY（Fernet 密钥）后，access_token 和 refresh_token 加密保存到 config.ini，
+# 加载时解密一次并缓存在内存中，只有 token 变化时才重新加密
+TOKEN_ENCRYPTION_KEY = os.environ.get('TOKEN_ENCRYPTION_KEY')
+ENCRYPTED_TOKEN_PREFIX = "enc:"
+_TOKEN_CIPHER = None
+_TOKEN_CACHE = {}
+_TOKEN_REFRESH_LOCKS = {}
+
+def account_section(user_id, account=None):
+    """返回账号对应的配置段名称，account 为空时使用当前激活的账号"""
+    if account is None:
+        account = load_active_account(user_id)
+    if account == DEFAULT_ACCOUNT:
+        return f"user_{user_id}"
+    return f"account_{user_id}_{account}"
+
+def load_active_account(user_id):
+    """加载用户当前激活的账号（文件夹设置、整理、清理等操作作用于该账号）"""
     config = read_config()
     section = f"user_{user_id}"
     if section not in config:
-        return None
-    return {
-        "access_token": config[section].get("access_token"),
-        "refresh_token": config[section].get("refresh_token"),
-        "access_token_expire_at": int(config[section].get("access_token_expire_at", "0")),
-    }
+        return DEFAULT_ACCOUNT
+    return config[section].get("active_account", DEFAULT_ACCOUNT)
 
-def save_user_tokens(user_id, access_token, refresh_token, expires_in):
-    logging.info("Executing: save_user_tokens")
+def save_active_account(user_id, account):
+    logging.info("Executing: save_active_account")
     config = read_config()
     section = f"user_{user_id}"
     if section not in config:
         config[section] = {}
+    config[section]['active_account'] = account
+    write_config(config)
 
-    config[section]['access_token'] = access_token
-    config[section]['refresh_token'] = refresh_token
-    expire_at = int(time.time()) + int(expires_in) - 60
-    config[section]['access_token_expire_at'] = str(expire_at)
+def list_user_accounts(user_id):
+    """列出用户已保存 refresh_token 的全部账号名称，默认账号排在最前"""
+    config = read_config()
+    accounts = []
+    default_section = f"user_{user_id}"
+    if default_section in config and config[default_section].get("refresh_token"):
+        accounts.append(DEFAULT_ACCOUNT)
+    prefix = f"account_{user_id}_"
+    for section in config.sections():
+        if section.startswith(prefix) and config[section].get("refresh_token"):
+            accounts.append(section[len(prefix):])
+    return accounts
+
+def list_known_users():
+    """列出配置文件中所有 user_<id> 段对应的用户 ID"""
+    config = read_config()
+    return [m.group(1) for m in (USER_SECTION_PATTERN.match(s) for s in config.sections()) if m]
+
+def remove_user_account(user_id, account):
+    logging.info("Executing: remove_user_account")
+    config = read_config()
+    section = account_section(user_id, account)
+    if section not in config:
+        return False
+    config.remove_section(section)
+    _TOKEN_CACHE.pop(section, None)
+    if load_active_account(user_id) == account:
+        config[f"user_{user_id}"]['active_account'] = DEFAULT_ACCOUNT
+    write_config(config)
+    QUOTA_CACHE.pop((user_id, account), None)
+    return True
+
+_STATE = None
+_STATE_DIRTY = set()  # 有变更、尚未写入的键
+_STATE_FLUSHING = set()  # 正在后台线程中写入共享数据库的键
+_STATE_FLUSH_LOCK = None  # 保证异步写入按顺序进行
+_STATE_FLUSH_TASKS = set()  # save_state(flush=True) 在后台发起的写入
+_STATE_DB = None
+_STATE_DB_LOCK = threading.Lock()  # 写连接会在不同的线程中使用
+_STATE_DB_READER = None
+
+def get_state_db():
+    """
+    返回共享状态数据库（SHARED_STATE_DB）的写连接，首次调用时建表。
+    写连接可能阻塞最多 STATE_DB_WRITE_TIMEOUT 秒，须持有 _STATE_DB_LOCK，并在事件循环之外（asyncio.to_thread）使用。
+    """
+    global _STATE_DB
+    if _STATE_DB is None:
+        import sqlite3  # 仅在启用共享状态时导入
+        _STATE_DB = sqlite3.connect(SHARED_STATE_DB, timeout=STATE_DB_WRITE_TIMEOUT, isolation_level=None, check_same_thread=False)
+        _STATE_DB.execute("PRAGMA journal_mode=WAL")
+        _STATE_DB.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        _STATE_DB.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)")
+    return _STATE_DB
+
+def get_state_db_reader():
+    """返回共享状态数据库的只读连接，在事件循环中读取状态时使用"""
+    global _STATE_DB_READER
+    if _STATE_DB_READER is None:
+        import sqlite3
+        with _STATE_DB_LOCK:
+            get_state_db()  # 确保已建表
+        _STATE_DB_READER = sqlite3.connect(SHARED_STATE_DB, timeout=STATE_DB_READ_TIMEOUT, isolation_level=None)
+    return _STATE_DB_READER
+
+def _get_state():
+    global _STATE
+    if _STATE is None:
+        _STATE = {}
+        # 使用共享数据库时按需逐个读取，不预先加载
+        if not SHARED_STATE_DB and os.path.exists(STATE_FILE):
+            try:
+                with open(STATE_FILE, encoding='utf-8') as f:
+                    _STATE = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.error(f"读取状态文件失败，将使用空状态: {e}")
+        if not SHARED_STATE_DB and os.path.exists(DURABLE_STATE_FILE):
+            # 队列和检查点以单独的文件为准
+            try:
+                with open(DURABLE_STATE_FILE, encoding='utf-8') as f:
+                    _STATE.update(json.load(f))
+            except (OSError, ValueError) as e:
+                logging.error(f"读取队列状态文件失败: {e}")
+    return _STATE
+
+def is_durable_key(key):
+    return key.startswith(DURABLE_STATE_PREFIXES)
+
+def load_state(key, default=None, fresh=False):
+    """
+    读取本地状态中的一项，首次调用时从 STATE_FILE（或共享数据库）加载。
+    fresh=True 时从共享数据库重新读取，用于读取其他 worker 负责的用户的状态。
+    """
+    state = _get_state()
+    if SHARED_STATE_DB and (key not in state or fresh and key not in _STATE_DIRTY and key not in _STATE_FLUSHING):
+        # 各用户的状态只由负责该用户的 worker 修改，读取一次后即可缓存在内存中
+        row = get_state_db_reader().execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            state[key] = json.loads(row[0])
+    return state.get(key, default)
+
+def save_state(key, value, flush=False):
+    """
+    更新本地状态中的一项；默认只标记为待写入，flush=True 时立即写入磁盘：
+    队列和检查点只重写 DURABLE_STATE_FILE；使用共享数据库且在事件循环中调用时，立即在后台线程中写入
+    """
+    _get_state()[key] = value
+    _STATE_DIRTY.add(key)
+    if not flush:
+        return
+    if not SHARED_STATE_DB:
+        if is_durable_key(key):
+            flush_durable_state()
+        else:
+            flush_state()
+        return
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        flush_state()
+        return
+    task = asyncio.create_task(flush_state_async())
+    _STATE_FLUSH_TASKS.add(task)
+    task.add_done_callback(_state_flush_done)
+
+def _state_flush_done(task):
+    _STATE_FLUSH_TASKS.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        # 写入失败的键已恢复为待写入，由 flush_state_job 定期重试
+        logging.error(f"写入共享状态数据库失败，将在下次定期写入时重试: {task.exception()!r}")
+
+def _write_json_file(path, data):
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_file, path)
+
+def flush_durable_state():
+    """只把队列和检查点原子地写入 DURABLE_STATE_FILE"""
+    _write_json_file(DURABLE_STATE_FILE, {key: value for key, value in _STATE.items() if is_durable_key(key)})
+    _STATE_DIRTY.difference_update([key for key in _STATE_DIRTY if is_durable_key(key)])
+
+def write_state_rows(rows):
+    """在一个事务中把 [(键, JSON)] 写入共享数据库，可能等待其他进程的写锁"""
+    with _STATE_DB_LOCK:
+        db = get_state_db()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            db.executemany("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", rows)
+
+def flush_state():
+    """
+    将有变更的本地状态原子地写入 STATE_FILE 和 DURABLE_STATE_FILE（或共享数据库）；
+    会阻塞，事件循环中应使用 flush_state_async
+    """
+    if not _STATE_DIRTY:
+        return
+    if SHARED_STATE_DB:
+        write_state_rows([(key, json.dumps(_STATE[key], ensure_ascii=False)) for key in _STATE_DIRTY])
+    else:
+        # 旧版本把队列保存在 STATE_FILE 中，DURABLE_STATE_FILE 不存在时先写入一次
+        if any(is_durable_key(key) for key in _STATE_DIRTY) or not os.path.exists(DURABLE_STATE_FILE):
+            flush_durable_state()
+        if _STATE_DIRTY:
+            _write_json_file(STATE_FILE, {key: value for key, value in _STATE.items() if not is_durable_key(key)})
+    _STATE_DIRTY.clear()
+
+async def flush_state_async():
+    """
+    在事件循环中写入有变更的本地状态：共享数据库的写入在后台线程中进行，
+    写入期间再次变更的键保持待写入，写入失败时全部恢复为待写入
+    """
+    global _STATE_FLUSH_LOCK
+    if not SHARED_STATE_DB:
+        flush_state()
+        return
+    if _STATE_FLUSH_LOCK is None:
+        _STATE_FLUSH_LOCK = asyncio.Lock()
+    async with _STATE_FLUSH_LOCK:
+        if not _STATE_DIRTY:
+            return
+        keys = set(_STATE_DIRTY)
+        rows = [(key, json.dumps(_STATE[key], ensure_ascii=False)) for key in keys]
+        _STATE_DIRTY.difference_update(keys)
+        _STATE_FLUSHING.update(keys)
+        try:
+            await asyncio.to_thread(write_state_rows, rows)
+        except BaseException:
+            _STATE_DIRTY.update(keys)
+            raise
+        finally:
+            _STATE_FLUSHING.difference_update(keys)
+
+# 新增函数：跨进程租约，用于保证同一时刻只有一个进程刷新某个账号的 token
+def _acquire_lease(name, ttl):
+    now = time.time()
+    with _STATE_DB_LOCK:
+        cursor = get_state_db().execute(
+            "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+            "WHERE leases.expires_at < ? OR leases.owner = excluded.owner",
+            (name, WORKER_ID, now + ttl, now)
+        )
+        return cursor.rowcount > 0
+
+def _release_lease(name):
+    with _STATE_DB_LOCK:
+        get_state_db().execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, WORKER_ID))
+
+async def acquire_lease(name, ttl):
+    """获取名为 name 的租约，ttl 秒后自动失效；未配置 SHARED_STATE_DB 时总是成功。数据库操作在后台线程中进行"""
+    if not SHARED_STATE_DB:
+        return True
+    return await asyncio.to_thread(_acquire_lease, name, ttl)
+
+async def release_lease(name):
+    if SHARED_STATE_DB:
+        await asyncio.to_thread(_release_lease, name)
+
+# 新增函数：按用户 ID 划分 worker
+def worker_of(user_id):
+    return int(user_id) % WORKER_COUNT
+
+def owns_user(user_id):
+    """当前 worker 是否负责该用户的更新和后台任务"""
+    return WORKER_COUNT <= 1 or worker_of(user_id) == WORKER_INDEX
+
+def list_owned_users():
+    """列出由当前 worker 负责的已知用户，后台任务只处理这些用户"""
+    return [user_id for user_id in list_known_users() if owns_user(user_id)]
+
+def worker_endpoint(index):
+    if WORKER_ENDPOINTS:
+        return WORKER_ENDPOINTS[index]
+    return f"http://127.0.0.1:{WEBHOOK_PORT + index}/{WEBHOOK_PATH}"
+
+def worker_listen_port():
+    # 未设置 WORKER_ENDPOINTS 时各 worker 在同一台机器上，使用不同的端口
+    return WEBHOOK_PORT if WORKER_ENDPOINTS else WEBHOOK_PORT + WORKER_INDEX
+
+async def route_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    在其他处理器之前运行：不属于当前 worker 的更新转发给负责该用户的 worker，
+    并停止在本进程中继续处理
+    """
+    user = update.effective_user
+    if user is None or owns_user(user.id):
+        return
+    owner = worker_of(user.id)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET} if WEBHOOK_SECRET else {}
+    try:
+        response = await get_http_client().post(worker_endpoint(owner), json=update.to_dict(), headers=headers)
+        if response.status_code != 200:
+            logging.error(f"转发更新 {update.update_id} 到 worker {owner} 失败，状态码: {response.status_code}")
+    except httpx.HTTPError as e:
+        logging.error(f"转发更新 {update.update_id} 到 worker {owner} 失败: {e!r}")
+    raise ApplicationHandlerStop
+
+async def flush_state_job(context: ContextTypes.DEFAULT_TYPE):
+    """后台定期写入有变更的本地状态"""
+    try:
+        await flush_state_async()
+    except OSError as e:
+        logging.error(f"写入状态文件失败: {e}")
+
+# 新增函数：优雅停机
+_INFLIGHT = {}          # 进行中的操作：asyncio.Task -> (user_id, 名称)
+_INTERRUPTED = set()    # 因停机超时被中断的操作
+_SHUTDOWN_STARTED = None
+
+class ShutdownInterrupted(Exception):
+    """操作因停机超时被中断"""
+
+def shutting_down():
+    return _SHUTDOWN_STARTED is not None
+
+async def run_inflight(user_id, name, coro, resumable=False):
+    """
+    在单独的任务中执行 coro 并登记为进行中的操作，停机时等待其完成，超过 SHUTDOWN_DEADLINE 则中断并抛出 ShutdownInterrupted。
+    resumable=True 时在开始前写入检查点 checkpoint_<user_id>_<name>，正常结束（包括失败）后清除，
+    被中断时保留，下次启动后由 resume_interrupted_tasks 重新执行。
+    """
+    key = f"checkpoint_{user_id}_{name}"
+    if resumable:
+        save_state(key, {"started_at": time.time(), "worker": WORKER_ID}, flush=True)
+    task = asyncio.create_task(coro)
+    _INFLIGHT[task] = (user_id, name)
+    try:
+        return await task
+    except asyncio.CancelledError:
+        if task in _INTERRUPTED:
+            raise ShutdownInterrupted("机器人正在重启，操作已中断") from None
+        raise
+    finally:
+        _INFLIGHT.pop(task, None)
+        _INTERRUPTED.discard(task)
+        if resumable and task.done() and not task.cancelled():
+            save_state(key, None)
+
+def interrupt_inflight():
+    """停机等待超时：中断所有仍在进行的操作（检查点保留）"""
+    if not _INFLIGHT:
+        return
+    names = ", ".join(f"{name}({user_id})" for user_id, name in _INFLIGHT.values())
+    logging.warning(f"停机等待超过 {SHUTDOWN_DEADLINE:g} 秒，中断 {len(_INFLIGHT)} 个进行中的操作: {names}")
+    for task in list(_INFLIGHT):
+        _INTERRUPTED.add(task)
+        task.cancel()
+
+def track_handler(name, callback):
+    """把处理器的执行登记为进行中的操作（不可恢复），停机超时被中断时提示用户"""
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        try:
+            return await run_inflight(str(update.effective_user.id), name, callback(update, context))
+        except ShutdownInterrupted:
+            await update.effective_message.reply_text("🔄 机器人正在重启，操作已中断，请稍后重试。")
+    return wrapper
+
+def force_exit():
+    """中断进行中的操作后仍未完成停机：写入配置、用量和本地状态后直接退出进程"""
+    logging.error(f"停机超过 {SHUTDOWN_DEADLINE + SHUTDOWN_FORCE_GRACE:g} 秒仍未完成，强制退出")
+    try:
+        if _CONFIG_DIRTY:
+            _persist_config()
+        flush_usage()
+        flush_state()
+    except Exception:
+        logging.error(f"强制退出前写入状态失败:\n{traceback.format_exc()}")
+    finally:
+        logging.shutdown()
+        os._exit(1)
+
+def begin_shutdown(app, sig):
+    """
+    信号处理：记录停机开始时间并停止 Application。PTB 随后依次停止接收更新、处理完已收到的更新、
+    等待进行中的后台任务，最后调用 on_shutdown 写入状态；进行中的操作最多再等待 SHUTDOWN_DEADLINE 秒
+    """
+    global _SHUTDOWN_STARTED
+    loop = asyncio.get_running_loop()
+    if _SHUTDOWN_STARTED is not None:
+        # 再次收到信号：不再等待，立即中断
+        logging.warning(f"再次收到信号 {sig.name}，立即中断进行中的操作")
+        interrupt_inflight()
+        return
+    _SHUTDOWN_STARTED = time.monotonic()
+    logging.info(f"收到信号 {sig.name}，开始停机，进行中的操作 {len(_INFLIGHT)} 个，最多等待 {SHUTDOWN_DEADLINE:g} 秒")
+    loop.call_later(SHUTDOWN_DEADLINE, interrupt_inflight)
+    loop.call_later(SHUTDOWN_DEADLINE + SHUTDOWN_FORCE_GRACE, force_exit)
+    if app.running:
+        app.stop_running()
+    else:
+        # 仍在启动过程中（post_init），与 PTB 默认的信号处理一样直接退出
+        raise SystemExit
 
+def install_signal_handlers(app):
+    """用 begin_shutdown 代替 PTB 默认的信号处理（main 中以 stop_signals=None 启动）"""
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, begin_shutdown, app, sig)
+        except (NotImplementedError, RuntimeError):
+            # Windows 等不支持 add_signal_handler 的平台：Ctrl+C 时没有停机等待
+            logging.warning(f"无法安装信号处理器 {sig.name}，停机时不会等待进行中的操作")
+
+async def reject_during_shutdown(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """最先运行：停机过程中不再开始新的操作，提示用户稍后重新发送"""
+    if not shutting_down():
+        return
+    try:
+        if update.callback_query:
+            await update.callback_query.answer("🔄 机器人正在重启，请稍后再试。", show_alert=True)
+        elif update.effective_message:
+            await update.effective_message.reply_text("🔄 机器人正在重启，请稍后重新发送。")
+    except Exception as e:
+        logging.warning(f"停机过程中回复更新 {update.update_id} 失败: {e!r}")
+    raise ApplicationHandlerStop
+
+def resume_interrupted_tasks(job_queue):
+    """启动时为当前 worker 负责的用户安排重新执行上次被中断的清理或整理"""
+    count = 0
+    for user_id in list_owned_users():
+        for task in SCHEDULED_TASKS:
+            if load_state(f"checkpoint_{user_id}_{task}"):
+                job_queue.run_once(run_interrupted_task, when=RESUME_DELAY + schedule_offset(user_id, task),
+                                   name=f"resume_{user_id}_{task}", data=(user_id, task))
+                count += 1
+    if count:
+        logging.info(f"已安排重新执行 {count} 个上次被中断的操作")
+
+# 新增函数：用量统计
+_USAGE_DELTAS = collections.defaultdict(collections.Counter)  # user_id -> 尚未写入本地状态的增量
+
+def record_usage(user_id, **counts):
+    """在内存中累加用户的用量，例如 record_usage(user_id, links=3)"""
+    _USAGE_DELTAS[str(user_id)].update(counts)
+
+def flush_usage():
+    """把内存中的用量增量合并到各用户的 usage_<id> 状态中"""
+    for user_id in list(_USAGE_DELTAS):
+        deltas = _USAGE_DELTAS.pop(user_id)
+        usage = dict(load_state(f"usage_{user_id}") or {})
+        for field, value in deltas.items():
+            usage[field] = usage.get(field, 0) + value
+        save_state(f"usage_{user_id}", usage)
+
+async def flush_usage_job(context: ContextTypes.DEFAULT_TYPE):
+    flush_usage()
+
+def load_usage(user_id):
+    """返回用户的累计用量（包括尚未写入的增量）"""
+    usage = collections.Counter(load_state(f"usage_{user_id}", fresh=not owns_user(user_id)) or {})
+    usage.update(_USAGE_DELTAS.get(str(user_id), {}))
+    return usage
+
+# 新增函数：token 加密存储
+def get_token_cipher():
+    """设置了 TOKEN_ENCRYPTION_KEY 时返回 Fernet 实例，否则返回 None（token 以明文保存）"""
+    global _TOKEN_CIPHER
+    if _TOKEN_CIPHER is None and TOKEN_ENCRYPTION_KEY:
+        from cryptography.fernet import Fernet  # 仅在启用加密时导入
+        _TOKEN_CIPHER = Fernet(TOKEN_ENCRYPTION_KEY.encode())
+    return _TOKEN_CIPHER
+
+def encrypt_token(value):
+    cipher = get_token_cipher()
+    if not cipher or not value:
+        return value
+    return ENCRYPTED_TOKEN_PREFIX + cipher.encrypt(value.encode()).decode()
+
+def decrypt_token(value):
+    if not value or not value.startswith(ENCRYPTED_TOKEN_PREFIX):
+        return value
+    cipher = get_token_cipher()
+    if not cipher:
+        raise ValueError("token 已加密保存，但未设置 TOKEN_ENCRYPTION_KEY")
+    return cipher.decrypt(value[len(ENCRYPTED_TOKEN_PREFIX):].encode()).decode()
+
+def _store_tokens(section, tokens):
+    """将 token 写入配置，只重新加密与缓存相比发生变化的字段"""
+    config = read_config()
+    if section not in config:
+        config[section] = {}
+    cached = _TOKEN_CACHE.get(section, {})
+    for key in ("access_token", "refresh_token"):
+        if tokens[key] != cached.get(key) or not config[section].get(key):
+            config[section][key] = encrypt_token(tokens[key])
+    config[section]['access_token_expire_at'] = str(tokens["access_token_expire_at"])
+    _TOKEN_CACHE[section] = dict(tokens)
     write_config(config)
 
+def load_user_tokens(user_id, account=None):
+    logging.info("Executing: load_user_tokens")
+    section = account_section(user_id, account)
+    # 解密后的 token 缓存在内存中，每次请求都不必重新解密
+    if section in _TOKEN_CACHE:
+        return dict(_TOKEN_CACHE[section])
+
+    config = read_config()
+    if section not in config:
+        return None
+    raw_refresh_token = config[section].get("refresh_token")
+    try:
+        tokens = {
+            "access_token": decrypt_token(config[section].get("access_token")),
+            "refresh_token": decrypt_token(raw_refresh_token),
+            "access_token_expire_at": int(config[section].get("access_token_expire_at", "0")),
+        }
+    except Exception as e:
+        logging.error(f"解密 {section} 的 token 失败: {e!r}")
+        return None
+
+    if get_token_cipher() and raw_refresh_token and not raw_refresh_token.startswith(ENCRYPTED_TOKEN_PREFIX):
+        # 启用加密前保存的明文 token，加密后写回
+        logging.info(f"将 {section} 的明文 token 加密保存")
+        _store_tokens(section, tokens)
+    _TOKEN_CACHE[section] = tokens
+    return dict(tokens)
+
+def preload_user_tokens():
+    """启动时解密全部账号的 token 并放入缓存，同时校验 TOKEN_ENCRYPTION_KEY 并加密遗留的明文 token"""
+    if TOKEN_ENCRYPTION_KEY:
+        get_token_cipher()
+    else:
+        logging.warning("未设置 TOKEN_ENCRYPTION_KEY，token 将以明文保存在 config.ini 中")
+    for user_id in list_owned_users():
+        for account in list_user_accounts(user_id):
+            load_user_tokens(user_id, account)
+
+def save_user_tokens(user_id, access_token, refresh_token, expires_in, account=None):
+    logging.info("Executing: save_user_tokens")
+    section = account_section(user_id, account)
+    expire_at = int(time.time()) + int(expires_in) - 60
+    _store_tokens(section, {
+        "access_token": access_token,
+        "refresh_token": refresh_token,
+        "access_token_expire_at": expire_at,
+    })
+
 def load_user_cid(user_id):
     logging.info("Executing: load_user_cid")
     config = read_config()
@@ -116,49 +1045,49 @@ def save_user_cid(user_id, cid):
     config[section]['cid'] = cid
     write_config(config)
 
-def save_user_download_folder(user_id, folder_id, folder_path):
+def save_user_download_folder(user_id, folder_id, folder_path, account=None):
     """保存用户的下载文件夹设置"""
     logging.info("Executing: save_user_download_folder")
     config = read_config()
-    section = f"user_{user_id}"
+    section = account_section(user_id, account)
     if section not in config:
         config[section] = {}
     config[section]['download_folder_id'] = folder_id
     config[section]['download_folder_path'] = folder_path
     write_config(config)
 
-def load_user_download_folder(user_id):
+def load_user_download_folder(user_id, account=None):
     """加载用户的下载文件夹设置"""
     logging.info("Executing: load_user_download_folder")
     config = read_config()
-    section = f"user_{user_id}"
+    section = account_section(user_id, account)
     if section not in config:
         return None, None
     return config[section].get("download_folder_id"), config[section].get("download_folder_path")
 
-def save_user_archive_folder(user_id, folder_id, folder_path):
+def save_user_archive_folder(user_id, folder_id, folder_path, account=None):
     """保存用户的归档文件夹设置"""
     logging.info("Executing: save_user_archive_folder")
     config = read_config()
-    section = f"user_{user_id}"
+    section = account_section(user_id, account)
     if section not in config:
         config[section] = {}
     config[section]['archive_folder_id'] = folder_id
     config[section]['archive_folder_path'] = folder_path
     write_config(config)
 
-def load_user_archive_folder(user_id):
+def load_user_archive_folder(user_id, account=None):
     """加载用户的归档文件夹设置"""
     logging.info("Executing: load_user_archive_folder")
     config = read_config()
-    section = f"user_{user_id}"
+    section = account_section(user_id, account)
     if section not in config:
         return None, None
     return config[section].get("archive_folder_id"), config[section].get("archive_folder_path")
 
 def extract_links(text):
     logging.info("Executing: extract_links")
-    return text.strip().split('\n')
+    return [line.strip() for line in text.strip().split('\n') if line.strip()]
 
 async def refresh_access_token(refresh_token):
     logging.info("Executing: refresh_access_token")
@@ -166,123 +1095,536 @@ async def refresh_access_token(refresh_token):
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(API_REFRESH_URL, data=data, headers=headers) as resp:
-                if resp.status != 200:
-                    logging.error(f"刷新access_token请求失败，状态码: {resp.status}")
-                    return None, f"刷新access_token请求失败，状态码: {resp.status}"
-                resp_json = await resp.json()
-                if "access_token" in resp_json.get("data", {}) and "expires_in" in resp_json.get("data", {}):
-                    return resp_json.get("data"), None
-                else:
-                    error_msg = resp_json.get("error") or resp_json.get("message") or resp_json.get("errno")
-                    logging.error(f"刷新access_token失败: {error_msg}")
-                    return None, f"刷新access_token失败: {error_msg}"
+        response = await get_http_client().post(API_REFRESH_URL, data=data, headers=headers)
+        if response.status_code != 200:
+            logging.error(f"刷新access_token请求失败，状态码: {response.status_code}")
+            return None, f"刷新access_token请求失败，状态码: {response.status_code}"
+        resp_json = response.json()
+        if "access_token" in resp_json.get("data", {}) and "expires_in" in resp_json.get("data", {}):
+            return resp_json.get("data"), None
+        else:
+            error_msg = resp_json.get("error") or resp_json.get("message") or resp_json.get("errno")
+            logging.error(f"刷新access_token失败: {error_msg}")
+            return None, f"刷新access_token失败: {error_msg}"
     except Exception as e:
         logging.error(f"刷新access_token时发生异常: {e}")
         return None, "刷新access_token时发生异常"
 
-async def check_and_get_access_token(user_id, context):
+async def get_valid_access_token(user_id, account=None):
+    """
+    获取指定账号的有效 access_token，过期时自动刷新。
+    不向用户发送任何消息，供后台任务使用。返回 (access_token, error)。
+    """
+    logging.info("Executing: get_valid_access_token")
+    tokens = load_user_tokens(user_id, account)
+    if not tokens or not tokens.get("refresh_token"):
+        return None, "你还没有保存 115 的 refresh_token，请先通过 /set_refresh_token 设置。"
+
+    now = int(time.time())
+    if tokens["access_token"] and tokens["access_token_expire_at"] > now:
+        return tokens["access_token"], None
+
+    # 同一账号同时只刷新一次：进程内用 asyncio.Lock，进程之间用共享数据库中的租约
+    section = account_section(user_id, account)
+    async with _TOKEN_REFRESH_LOCKS.setdefault(section, asyncio.Lock()):
+        lease = f"token_refresh_{section}"
+        deadline = time.time() + TOKEN_REFRESH_LEASE
+        while not await acquire_lease(lease, TOKEN_REFRESH_LEASE):
+            if time.time() > deadline:
+                return None, "其他进程正在刷新 access_token，请稍后重试。"
+            await asyncio.sleep(1)
+        try:
+            # 等待期间其他协程或进程可能已经刷新过
+            reload_config_if_changed()
+            tokens = load_user_tokens(user_id, account) or tokens
+            if tokens["access_token"] and tokens["access_token_expire_at"] > int(time.time()):
+                return tokens["access_token"], None
+
+            data, err = await refresh_access_token(tokens["refresh_token"])
+            if err:
+                return None, f"刷新access_token失败：{err}"
+
+            # 修改：保存新的 access_token 和 refresh_token
+            save_user_tokens(user_id, data['access_token'], data['refresh_token'], data['expires_in'], account)
+            if WORKER_COUNT > 1 and _CONFIG_DIRTY:
+                # 旧的 refresh_token 已经失效，释放租约前写入磁盘，其他进程才能读到新的 token
+                _persist_config()
+            return data['access_token'], None
+        finally:
+            await release_lease(lease)
+
+async def check_and_get_access_token(user_id, context, account=None):
     logging.info("Executing: check_and_get_access_token")
     try:
-        tokens = load_user_tokens(user_id)
-        if not tokens or not tokens.get("refresh_token"):
-            await context.bot.send_message(chat_id=user_id, text="你还没有保存 115 的 refresh_token，请先通过 /set_refresh_token 设置。")
-            return None
-
-        now = int(time.time())
-        if tokens["access_token"] and tokens["access_token_expire_at"] > now:
-            return tokens["access_token"]
-
-        data, err = await refresh_access_token(tokens["refresh_token"])
+        access_token, err = await get_valid_access_token(user_id, account)
         if err:
-            await context.bot.send_message(chat_id=user_id, text=f"刷新access_token失败：{err}")
+            await context.bot.send_message(chat_id=user_id, text=err)
             return None
-
-        # 修改：保存新的 access_token 和 refresh_token
-        save_user_tokens(user_id, data['access_token'], data['refresh_token'], data['expires_in'])
-        return data['access_token']
+        return access_token
     except Exception as e:
         logging.error(f"检查和获取 access_token 时发生异常: {str(e)}\n堆栈信息:\n{traceback.format_exc()}")
         return None
 
-async def add_cloud_download_task(access_token, urls, wp_path_id="0"):
+async def add_cloud_download_task(access_token, urls, wp_path_id="0", user_id=None):
     logging.info("Executing: add_cloud_download_task")
     payload = {
         "urls": "\n".join(urls),
         "wp_path_id": wp_path_id
     }
-    headers = {
-        "Authorization": f"Bearer {access_token}"
-    }
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(API_ADD_TASK_URL, data=payload, headers=headers) as resp:
-                if resp.status != 200:
-                    # 修改：返回完整的响应内容
-                    resp_json = await resp.json()
-                    return False, resp_json
-                
-                resp_json = await resp.json()  # 仅调用一次
-                if resp_json.get("state") is True and resp_json.get("code") == 0:
-                    return True, resp_json
-                else:
-                    # 修改：返回完整的响应内容
-                    return False, resp_json
+        response = await Api115Client(access_token, user_id=user_id).post(API_ADD_TASK_URL, data=payload)
+        if response.status_code != 200:
+            # 修改：返回完整的响应内容，无法解析时按网络错误处理
+            try:
+                return False, response.json()
+            except ValueError:
+                return False, {"error": f"请求过程中发生异常，状态码: {response.status_code}"}
+
+        resp_json = response.json()  # 仅调用一次
+        if resp_json.get("state") is True and resp_json.get("code") == 0:
+            return True, resp_json
+        else:
+            # 修改：返回完整的响应内容
+            return False, resp_json
     except Exception:
         logging.error(f"添加任务时发生异常:\n{traceback.format_exc()}")
         return False, {"error": "请求过程中发生异常"}
 
+def is_deferrable_error(message):
+    """判断提交失败是否属于配额不足、限流或网络错误等可稍后重试的情况"""
+    message = str(message or "").lower()
+    return any(keyword in message for keyword in DEFERRABLE_ERROR_KEYWORDS)
+
+# 新增函数：选择账号并提交链接
+async def submit_links(user_id, links):
+    """
+    从账号池中选出剩余配额最多的账号并提交链接，返回结果字典：
+      account: 使用的账号
+      succeeded: 提交成功的链接
+      failed: [(链接, 错误信息)]，不可重试的失败
+      deferred: 因配额不足、限流或网络错误未能提交、可稍后重试的链接
+      unsent: 某一批整体失败（不可重试）后没有被服务器处理的链接，同时记录在 failed 中
+      error: 整体失败的原因（无则为 None）
+    """
+    logging.info("Executing: submit_links")
+    result = {"account": None, "succeeded": [], "failed": [], "deferred": [], "unsent": [], "error": None}
+
+    account = await select_account_for_submission(user_id)
+    if not account:
+        result["error"] = "请先通过 /set_download_folder 设置下载文件夹。"
+        return result
+    result["account"] = account
+
+    access_token, err = await get_valid_access_token(user_id, account)
+    if err:
+        result["error"] = err
+        return result
+
+    # 获取下载文件夹设置
+    download_folder_id, download_folder_path = load_user_download_folder(user_id, account)
+
+    # 提交前根据配额缓存检查剩余配额，超出部分不发送到服务器
+    quota_entry = QUOTA_CACHE.get((user_id, account))
+    if quota_entry and len(links) > quota_entry["surplus"]:
+        result["deferred"] = links[quota_entry["surplus"]:]
+        links = links[:quota_entry["surplus"]]
+    if not links:
+        result["error"] = "所有账号的离线配额已用完"
+        return result
+
+    # 链接较多时分批提交，某一批整体失败后剩余的批次不再发送
+    for start in range(0, len(links), SUBMIT_CHUNK_SIZE):
+        chunk = links[start:start + SUBMIT_CHUNK_SIZE]
+        success, response = await add_cloud_download_task(access_token, chunk, download_folder_id, user_id)
+        if not success:
+            error_msg = response.get("message") or response.get("error") or "添加任务失败，未知错误。"
+            logging.error(f"添加任务失败: {error_msg}")
+            result["error"] = error_msg
+            if is_deferrable_error(error_msg):
+                if "配额" in error_msg and quota_entry:
+                    quota_entry["surplus"] = 0
+                result["deferred"] = links[start:] + result["deferred"]
+            else:
+                result["unsent"] = links[start:]
+                result["failed"].extend((url, error_msg) for url in links[start:])
+            break
+
+        succeeded = 0
+        for task in response.get("data", []):
+            if task.get("state", False):
+                result["succeeded"].append(task.get("url"))
+                succeeded += 1
+            elif is_deferrable_error(task.get("message")):
+                result["deferred"].append(task.get("url"))
+            else:
+                result["failed"].append((task.get("url"), task.get("message", "未知错误")))
+        consume_cached_quota(user_id, account, succeeded)
+        record_usage(user_id, links=succeeded)
+    return result
+
+def format_submit_result(result, show_account=False):
+    """将 submit_links 的结果格式化为回复文本"""
+    lines = []
+    if result["succeeded"]:
+        success_text = f"✅ 成功添加 {len(result['succeeded'])} 个任务。"
+        if show_account:
+            success_text += f"（账号：{result['account']}）"
+        lines.append(success_text)
+    if result["error"] and not result["deferred"]:
+        lines.append(f"❌ 添加任务失败：{result['error']}")
+
+    if result["failed"]:
+        title = "以下任务添加失败：" if result["succeeded"] else "❌ 以下任务添加失败："
+        lines.append(title + "\n".join(f"\n❌ 失败链接: {url}\n错误信息: {message}" for url, message in result["failed"]))
+
+    if result["deferred"]:
+        reason = f"（{result['error']}）" if result["error"] else "（剩余配额不足）"
+        lines.append(f"⏳ {len(result['deferred'])} 个链接暂未提交{reason}，已加入待提交队列，将在配额或网络恢复后自动提交。")
+    return "\n".join(lines)
+
 async def handle_add_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logging.info("Executing: handle_add_task")
     try:
         user_id = str(update.effective_user.id)
-        access_token = await check_and_get_access_token(user_id, context)
-        if not access_token:
-            return
-
         links = extract_links(update.message.text.strip())
         if not links:
             await update.message.reply_text("未检测到有效的下载链接，请发送支持的磁力链（magnet）或电驴链接（ed2k）。")
             return
 
-        # 获取下载文件夹设置
-        download_folder_id, download_folder_path = load_user_download_folder(user_id)
-        if not download_folder_id:
-            await update.message.reply_text("请先通过 /set_download_folder 设置下载文件夹。")
+        accounts = list_user_accounts(user_id)
+        if not accounts:
+            await update.message.reply_text("你还没有保存 115 的 refresh_token，请先通过 /set_refresh_token 设置。")
             return
 
-        success, result = await add_cloud_download_task(access_token, links, download_folder_id)
-        if success:
-            tasks = result.get("data", [])
-            if not tasks:
-                await update.message.reply_text("未检测到任何任务信息。")
-                return
-
-            success_count = sum(1 for task in tasks if task.get("state", False))
-            failure_messages = []
-
-            for task in tasks:
-                if not task.get("state", False):
-                    failure_messages.append(f"\n❌ 失败链接: {task['url']}\n错误信息: {task.get('message', '未知错误')}")
-
-            if success_count > 0:
-                success_text = f"✅ 成功添加 {success_count} 个任务。"
-                if failure_messages:
-                    success_text += "\n以下任务添加失败：" + "\n".join(failure_messages)
-                await send_long_message(update, context, success_text)
-            elif failure_messages:
-                failure_text = "❌ 以下任务添加失败：" + "\n".join(failure_messages)
-                await send_long_message(update, context, failure_text)
-        else:
-            error_msg = result.get("message") or result.get("error") or "添加任务失败，未知错误。"
-            logging.error(f"添加任务失败: {error_msg}")
-            await update.message.reply_text(f"❌ 添加任务失败：{error_msg}")
+        await submit_and_reply(update, context, user_id, links, accounts)
     except Exception as e:
         logging.error(f"添加任务时发生内部错误: {e}")
         await update.message.reply_text("❌ 添加任务时发生内部错误。")
 
+async def submit_and_reply(update, context, user_id, links, accounts):
+    """提交链接，暂时无法提交的加入待提交队列，并回复提交结果"""
+    result = await submit_links(user_id, links)
+    if result["deferred"]:
+        enqueue_pending_links(user_id, result["deferred"], result["error"])
+
+    result_text = format_submit_result(result, show_account=len(accounts) > 1)
+    if result_text:
+        await send_long_message(update, context, result_text)
+    else:
+        await update.message.reply_text("未检测到任何任务信息。")
+
+# 新增：流式解析 torrent 文件
+class TorrentParseError(Exception):
+    """torrent 文件不是有效的 bencode 数据或缺少 info 字段"""
+
+class TorrentInfoHasher:
+    """
+    增量解析 bencode 数据，计算顶层字典中 info 值的 SHA1（即 BitTorrent v1 的 infohash）。
+    通过 feed() 逐块传入文件内容；只缓冲字典键和 name/announce 等短字符串，
+    pieces 等长字符串边读边计算哈希后即丢弃。infohash 算出后 done 为 True，其余内容无需再读取。
+    """
+
+    MAX_CAPTURE = 4096
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.stack = []            # [类型 b"d"/b"l", 是否等待键, 最近的键]
+        self.sha1 = None
+        self.string_remaining = 0
+        self.string_value = None   # 需要保留的字符串内容，None 表示只跳过
+        self.infohash = None
+        self.name = None
+        self.announce = None
+        self.done = False
+
+    def _take(self, n):
+        chunk = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        if self.sha1 is not None:
+            self.sha1.update(chunk)
+        return chunk
+
+    def _value_done(self):
+        if self.stack and self.stack[-1][0] == b"d":
+            self.stack[-1][1] = True
+        if self.sha1 is not None and len(self.stack) == 1:
+            self.infohash = self.sha1.hexdigest()
+            self.sha1 = None
+            self.done = True
+        elif not self.stack:
+            self.done = True
+
+    def _finish_string(self):
+        value, self.string_value = self.string_value, None
+        top = self.stack[-1] if self.stack else None
+        if top is not None and top[0] == b"d" and top[1]:
+            top[1], top[2] = False, value
+            return
+        if value is not None and top is not None:
+            if len(self.stack) == 2 and self.sha1 is not None and top[2] == b"name":
+                self.name = value.decode("utf-8", errors="replace")
+            elif len(self.stack) == 1 and top[2] == b"announce":
+                self.announce = value.decode("utf-8", errors="replace")
+        self._value_done()
+
+    def _should_capture(self):
+        if not self.stack:
+            return False
+        top = self.stack[-1]
+        return top[0] == b"d" and (top[1] or top[2] in (b"name", b"announce") and len(self.stack) <= 2)
+
+    def feed(self, data):
+        self.buffer += data
+        while self.buffer and not self.done:
+            if self.string_remaining:
+                chunk = self._take(min(self.string_remaining, len(self.buffer)))
+                self.string_remaining -= len(chunk)
+                if self.string_value is not None:
+                    self.string_value += chunk
+                if not self.string_remaining:
+                    self._finish_string()
+                continue
+
+            # 顶层字典中 info 键对应的值从这里开始计算哈希
+            if (len(self.stack) == 1 and self.sha1 is None and self.infohash is None
+                    and not self.stack[0][1] and self.stack[0][2] == b"info"):
+                self.sha1 = hashlib.sha1()
+
+            token = self.buffer[:1]
+            if self.stack and self.stack[-1][1] and token != b"e" and not token.isdigit():
+                raise TorrentParseError("字典的键必须是字符串")
+            if token in (b"d", b"l"):
+                self._take(1)
+                self.stack.append([bytes(token), token == b"d", None])
+            elif token == b"e":
+                if not self.stack:
+                    raise TorrentParseError("多余的结束符")
+                self._take(1)
+                self.stack.pop()
+                self._value_done()
+            elif token == b"i":
+                end = self.buffer.find(b"e")
+                if end < 0:
+                    if len(self.buffer) > 32:
+                        raise TorrentParseError("整数过长")
+                    break
+                self._take(end + 1)
+                self._value_done()
+            elif token.isdigit():
+                colon = self.buffer.find(b":")
+                if colon < 0:
+                    if len(self.buffer) > 20:
+                        raise TorrentParseError("字符串长度无效")
+                    break
+                if not self.buffer[:colon].isdigit():
+                    raise TorrentParseError("字符串长度无效")
+                length = int(self.buffer[:colon])
+                capture = self._should_capture()
+                if capture and length > self.MAX_CAPTURE:
+                    raise TorrentParseError("字典的键过长")
+                self._take(colon + 1)
+                self.string_remaining = length
+                self.string_value = bytearray() if capture else None
+                if not length:
+                    self._finish_string()
+            else:
+                raise TorrentParseError(f"无效的 bencode 数据: {bytes(token)!r}")
+
+    def magnet(self):
+        link = f"magnet:?xt=urn:btih:{self.infohash}"
+        if self.name:
+            link += "&dn=" + urllib.parse.quote(self.name)
+        if self.announce:
+            link += "&tr=" + urllib.parse.quote(self.announce, safe="")
+        return link
+
+async def iter_telegram_file(file, chunk_size=DOCUMENT_CHUNK_SIZE):
+    """逐块读取 Telegram 文件：使用本地 Bot API 服务器时直接读取本地路径，否则流式下载"""
+    if os.path.isfile(file.file_path):
+        with open(file.file_path, 'rb') as f:
+            while chunk := f.read(chunk_size):
+                yield chunk
+        return
+    async with get_http_client().stream("GET", file.file_path) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes(chunk_size):
+            yield chunk
+
+async def extract_links_from_text_file(file):
+    """逐行读取文本文件中的下载链接（去重，最多 DOCUMENT_MAX_LINKS 个）"""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    links, pending = {}, ""
+    async with contextlib.aclosing(iter_telegram_file(file)) as chunks:
+        async for chunk in chunks:
+            lines = (pending + decoder.decode(chunk)).split("\n")
+            pending = lines.pop()
+            for line in lines:
+                links.update(dict.fromkeys(LINK_PATTERN.findall(line)))
+            if len(links) >= DOCUMENT_MAX_LINKS:
+                break
+    links.update(dict.fromkeys(LINK_PATTERN.findall(pending + decoder.decode(b"", final=True))))
+    return list(links)[:DOCUMENT_MAX_LINKS]
+
+async def extract_magnet_from_torrent(file):
+    """流式解析 torrent 文件并返回磁力链接，算出 infohash 后不再读取剩余内容"""
+    hasher = TorrentInfoHasher()
+    async with contextlib.aclosing(iter_telegram_file(file)) as chunks:
+        async for chunk in chunks:
+            hasher.feed(chunk)
+            if hasher.done:
+                break
+    if not hasher.infohash:
+        raise TorrentParseError("文件中没有找到 info 字段")
+    return hasher.magnet()
+
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理用户发送的 .torrent 文件和包含下载链接的文本文件"""
+    logging.info("Executing: handle_document")
+    user_id = str(update.effective_user.id)
+    document = update.message.document
+    file_name = (document.file_name or "").lower()
+    is_torrent = file_name.endswith(".torrent") or document.mime_type == "application/x-bittorrent"
+    is_text = file_name.endswith(".txt") or (document.mime_type or "").startswith("text/")
+    if not is_torrent and not is_text:
+        await update.message.reply_text("❌ 只支持 .torrent 文件和包含下载链接的 .txt 文件。")
+        return
+    if document.file_size and document.file_size > DOCUMENT_MAX_SIZE:
+        await update.message.reply_text("❌ 文件超过 20MB，Telegram 不允许机器人下载。")
+        return
+
+    accounts = list_user_accounts(user_id)
+    if not accounts:
+        await update.message.reply_text("你还没有保存 115 的 refresh_token，请先通过 /set_refresh_token 设置。")
+        return
+
+    try:
+        file = await context.bot.get_file(document.file_id)
+        if is_torrent:
+            links = [await extract_magnet_from_torrent(file)]
+        else:
+            links = await extract_links_from_text_file(file)
+            if not links:
+                await update.message.reply_text("未在文件中检测到下载链接。")
+                return
+            await update.message.reply_text(f"📄 从文件中读取到 {len(links)} 个链接，正在提交...")
+        await submit_and_reply(update, context, user_id, links, accounts)
+    except TorrentParseError as e:
+        await update.message.reply_text(f"❌ 无法解析 torrent 文件：{e}")
+    except Exception as e:
+        logging.error(f"导入文件时发生异常:\n{traceback.format_exc()}")
+        await update.message.reply_text(f"❌ 导入文件失败：{e}")
+
+# 新增函数：待提交队列
+def load_pending_queue(user_id):
+    """读取用户的待提交队列：{"links": [{"url", "added_at"}], "attempts", "next_attempt_at", "last_error"}"""
+    return load_state(f"pending_tasks_{user_id}") or {"links": [], "attempts": 0, "next_attempt_at": 0, "last_error": ""}
+
+def save_pending_queue(user_id, queue):
+    # 待提交队列丢失即意味着链接丢失，因此每次变更都立即写入磁盘
+    save_state(f"pending_tasks_{user_id}", queue, flush=True)
+
+def enqueue_pending_links(user_id, links, error=None):
+    logging.info("Executing: enqueue_pending_links")
+    queue = load_pending_queue(user_id)
+    known_urls = {item["url"] for item in queue["links"]}
+    now = int(time.time())
+    for url in links:
+        if url and url not in known_urls:
+            queue["links"].append({"url": url, "added_at": now})
+            known_urls.add(url)
+    queue["last_error"] = error or queue.get("last_error", "")
+    save_pending_queue(user_id, queue)
+
+def remove_pending_links(user_id, urls, **fields):
+    """
+    重新读取队列后移除指定链接并更新其他字段（attempts 等）。
+    提交过程中 enqueue_pending_links 可能加入了新的链接，不能用提交前读取的队列覆盖
+    """
+    queue = load_pending_queue(user_id)
+    queue["links"] = [item for item in queue["links"] if item["url"] not in urls]
+    queue.update(fields)
+    save_pending_queue(user_id, queue)
+
+async def drain_pending_queue(bot, user_id):
+    """尝试提交单个用户的待提交队列，并把结果通知用户"""
+    queue = load_pending_queue(user_id)
+    now = int(time.time())
+    if not queue["links"] or queue["next_attempt_at"] > now:
+        return
+
+    # 丢弃等待时间过长的链接
+    expired = [item["url"] for item in queue["links"] if now - item["added_at"] > PENDING_MAX_AGE]
+    if expired:
+        remove_pending_links(user_id, set(expired))
+        queue["links"] = [item for item in queue["links"] if item["url"] not in expired]
+        await bot.send_message(chat_id=user_id, text=f"⚠️ 以下 {len(expired)} 个链接等待过久仍未能提交，已从待提交队列移除：\n" + "\n".join(expired)[:3500])
+        if not queue["links"]:
+            return
+
+    # 根据配额缓存判断：所有账号都没有剩余配额时不请求服务器，等待后台刷新配额缓存（配额重置后自然恢复）
+    accounts = [a for a in list_user_accounts(user_id) if load_user_download_folder(user_id, a)[0]]
+    cached = [QUOTA_CACHE.get((user_id, a)) for a in accounts]
+    if cached and all(entry is not None and entry["surplus"] <= 0 for entry in cached):
+        logging.info(f"用户 {user_id} 的所有账号配额已用完，暂不提交待提交队列")
+        return
+
+    links = [item["url"] for item in queue["links"]]
+    result = await submit_links(user_id, links)
+    if result["succeeded"] or result["failed"]:
+        # 有链接被服务器处理，说明配额和网络已恢复，重置退避
+        queue["attempts"] = 0
+        queue["next_attempt_at"] = 0
+        queue["last_error"] = ""
+        report = "📬 待提交队列处理结果：\n" + format_submit_result({**result, "deferred": []}, show_account=len(accounts) > 1)
+        await bot.send_message(chat_id=user_id, text=report[:4096])
+    if result["deferred"] or (result["error"] and not result["succeeded"] and not result["failed"]):
+        # 指数退避：60s, 120s, 240s ... 最长 PENDING_MAX_BACKOFF
+        queue["attempts"] += 1
+        queue["next_attempt_at"] = now + min(PENDING_MAX_BACKOFF, 60 * 2 ** (queue["attempts"] - 1))
+        queue["last_error"] = result["error"] or "剩余配额不足"
+    # 只移除服务器已处理（成功或失败）的链接，其余链接（包括整体失败时的全部链接）留在队列中
+    processed = set(result["succeeded"]) | {url for url, _ in result["failed"]}
+    remove_pending_links(user_id, processed, attempts=queue["attempts"],
+                         next_attempt_at=queue["next_attempt_at"], last_error=queue["last_error"])
+
+async def drain_pending_tasks_job(context: ContextTypes.DEFAULT_TYPE):
+    """后台定期处理所有用户的待提交队列"""
+    for user_id in list_owned_users():
+        if shutting_down():
+            break
+        try:
+            await run_inflight(user_id, "drain_pending", drain_pending_queue(context.bot, user_id))
+        except ShutdownInterrupted:
+            break
+        except Exception:
+            logging.error(f"处理用户 {user_id} 的待提交队列时发生异常:\n{traceback.format_exc()}")
+
+async def handle_pending(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理 /pending 命令，查看或清空待提交队列"""
+    logging.info("Executing: handle_pending")
+    user_id = str(update.effective_user.id)
+    queue = load_pending_queue(user_id)
+
+    if context.args and context.args[0] == "clear":
+        count = len(queue["links"])
+        save_pending_queue(user_id, {"links": [], "attempts": 0, "next_attempt_at": 0, "last_error": ""})
+        await update.message.reply_text(f"🗑️ 已清空待提交队列，共移除 {count} 个链接。")
+        return
+
+    if not queue["links"]:
+        await update.message.reply_text("✅ 待提交队列为空。")
+        return
+
+    response_text = f"⏳ 待提交队列 ({len(queue['links'])} 个链接):\n"
+    if queue.get("last_error"):
+        response_text += f"上次失败原因: {queue['last_error']}\n"
+    if queue["next_attempt_at"] > int(time.time()):
+        response_text += f"下次尝试时间: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(queue['next_attempt_at']))}\n"
+    response_text += "\n" + "\n".join(item["url"] for item in queue["links"])
+    response_text += "\n\n使用 /pending clear 清空队列。"
+    await send_long_message(update, context, response_text)
+
 # 新增函数：分段发送长消息
 async def send_long_message(update, context, message):
     MAX_LENGTH = 4096
@@ -303,6 +1645,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     response_text = '你好，我是你的机器人！请发送磁力链接（magnet）或电驴链接（ed2k）进行识别。\n\n'
     response_text += f'👤 用户 ID: {user_id}\n'
+    response_text += f'👥 当前账号: {load_active_account(user_id)}\n'
     response_text += f'📁 下载文件夹: {download_folder_path or "未设置"}\n'
     response_text += f'📦 归档文件夹: {archive_folder_path or "未设置"}\n\n'
 
@@ -315,13 +1658,25 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def ask_refresh_token(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logging.info("Executing: ask_refresh_token")
+    context.user_data['pending_account'] = DEFAULT_ACCOUNT
     await update.message.reply_text("请输入你的 115 refresh_token：")
     return ASK_REFRESH_TOKEN
 
+# 新增函数：添加额外的 115 账号
+async def ask_account_token(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logging.info("Executing: ask_account_token")
+    if not context.args or not ACCOUNT_NAME_PATTERN.match(context.args[0]) or context.args[0] == DEFAULT_ACCOUNT:
+        await update.message.reply_text("用法：/add_account <账号名>\n账号名只能包含字母、数字、下划线或短横线，且不能为 default。")
+        return ConversationHandler.END
+    context.user_data['pending_account'] = context.args[0]
+    await update.message.reply_text(f"请输入账号 {context.args[0]} 的 115 refresh_token：")
+    return ASK_ACCOUNT_TOKEN
+
 async def save_refresh_token(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logging.info("Executing: save_refresh_token")
     refresh_token = update.message.text.strip()
     user_id = str(update.effective_user.id)
+    account = context.user_data.pop('pending_account', DEFAULT_ACCOUNT)
 
     try:
         data, err = await refresh_access_token(refresh_token)
@@ -330,9 +1685,20 @@ async def save_refresh_token(update: Update, context: ContextTypes.DEFAULT_TYPE)
             return ConversationHandler.END
 
         # 保存新的 access_token 和 refresh_token（使用接口返回的新 token）
-        save_user_tokens(user_id, data['access_token'], data['refresh_token'], data['expires_in'])
+        save_user_tokens(user_id, data['access_token'], data['refresh_token'], data['expires_in'], account)
 
-        await update.message.reply_text("refresh_token 和 access_token 已保存。")
+        if account == DEFAULT_ACCOUNT:
+            await update.message.reply_text("refresh_token 和 access_token 已保存。")
+        else:
+            await update.message.reply_text(
+                f"账号 {account} 的 refresh_token 和 access_token 已保存。\n"
+                f"可通过 /use_account {account} 切换到该账号并设置下载文件夹。"
+            )
+
+        # 预先缓存该账号的配额，供提交任务时选择账号
+        _, quota_err = await refresh_account_quota(user_id, account)
+        if quota_err:
+            logging.warning(f"缓存账号 {account} 的配额失败: {quota_err}")
         return ConversationHandler.END
     except Exception:
         logging.error(f"保存 refresh_token 时发生异常:\n{traceback.format_exc()}")
@@ -343,18 +1709,69 @@ async def save_refresh_token(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def set_download_folder(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """设置下载文件夹"""
     logging.info("Executing: set_download_folder")
-    await show_folder_selection(update, context, "0", 0, "download")
+    await show_folder_selection(update, context, create_folder_session(str(update.effective_user.id), "download"))
 
 async def set_archive_folder(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """设置归档文件夹"""
     logging.info("Executing: set_archive_folder")
-    await show_folder_selection(update, context, "0", 0, "archive")
+    await show_folder_selection(update, context, create_folder_session(str(update.effective_user.id), "archive"))
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logging.info("Executing: cancel")
+    context.user_data.pop('pending_account', None)
     await update.message.reply_text("已取消设置 refresh_token。")
     return ConversationHandler.END
 
+# 新增函数：列出账号池
+async def handle_accounts(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理 /accounts 命令，列出用户的全部 115 账号及缓存的剩余配额"""
+    logging.info("Executing: handle_accounts")
+    user_id = str(update.effective_user.id)
+    accounts = list_user_accounts(user_id)
+    if not accounts:
+        await update.message.reply_text("你还没有保存 115 的 refresh_token，请先通过 /set_refresh_token 设置。")
+        return
+
+    active_account = load_active_account(user_id)
+    response_text = "👥 账号列表：\n\n"
+    for account in accounts:
+        marker = "👉 " if account == active_account else ""
+        _, download_folder_path = load_user_download_folder(user_id, account)
+        entry = QUOTA_CACHE.get((user_id, account))
+        quota_text = f"{entry['surplus']}/{entry['count']}" if entry else "未知"
+        response_text += f"{marker}{account}\n"
+        response_text += f"  📁 下载文件夹: {download_folder_path or '未设置'}\n"
+        response_text += f"  📊 剩余配额: {quota_text}\n"
+    response_text += "\n提交任务时会自动选择剩余配额最多的账号。"
+    await update.message.reply_text(response_text)
+
+# 新增函数：切换当前激活的账号
+async def handle_use_account(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logging.info("Executing: handle_use_account")
+    user_id = str(update.effective_user.id)
+    if not context.args:
+        await update.message.reply_text("用法：/use_account <账号名>")
+        return
+    account = context.args[0]
+    if account not in list_user_accounts(user_id):
+        await update.message.reply_text(f"❌ 账号 {account} 不存在，可通过 /accounts 查看已添加的账号。")
+        return
+    save_active_account(user_id, account)
+    await update.message.reply_text(f"✅ 已切换到账号 {account}，文件夹设置、整理和清理操作将作用于该账号。")
+
+# 新增函数：删除额外账号
+async def handle_remove_account(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logging.info("Executing: handle_remove_account")
+    user_id = str(update.effective_user.id)
+    if not context.args or context.args[0] == DEFAULT_ACCOUNT:
+        await update.message.reply_text("用法：/remove_account <账号名>（默认账号不能删除）")
+        return
+    account = context.args[0]
+    if account not in list_user_accounts(user_id) or not remove_user_account(user_id, account):
+        await update.message.reply_text(f"❌ 账号 {account} 不存在。")
+        return
+    await update.message.reply_text(f"🗑️ 已删除账号 {account}。")
+
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     处理 /status 命令，返回用户状态信息
@@ -366,21 +1783,12 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("你还没有保存 115 的 refresh_token，请先通过 /set_refresh_token 设置。")
         return
 
-    now = int(time.time())
-    access_token_valid = False
-    if tokens["access_token"] and tokens["access_token_expire_at"] > now:
-        access_token_valid = True
-
-    # 如果 access_token 无效，尝试刷新
-    if not access_token_valid:
-        data, err = await refresh_access_token(tokens["refresh_token"])
-        if err:
-            await update.message.reply_text(f"刷新 access_token 失败：{err}")
-            return
-
-        # 更新 access_token 和 refresh_token
-        save_user_tokens(user_id, data['access_token'], data['refresh_token'], data['expires_in'])
-        tokens = load_user_tokens(user_id)
+    # access_token 无效时刷新；与后台任务共用刷新锁和租约，避免同一个 refresh_token 被提交两次
+    access_token, err = await get_valid_access_token(user_id)
+    if err:
+        await update.message.reply_text(f"❌ {err}")
+        return
+    tokens = load_user_tokens(user_id)
 
     # 计算 access_token 有效期并转换为北京时间
     expire_at = tokens["access_token_expire_at"]
@@ -395,6 +1803,7 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     response_text = (
         f"� 用户 ID: {user_id}\n"
+        f"👥 当前账号: {load_active_account(user_id)}\n"
         f"🔑 Access Token: {tokens['access_token'][:20]}...\n"
         f"⏰ Access Token 有效期: {expire_time}\n"
         f"🔄 Refresh Token: {tokens['refresh_token'][:20]}...\n\n"
@@ -403,45 +1812,127 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     await update.message.reply_text(response_text)
 
-async def get_quota_info(access_token):
+async def get_quota_info(access_token, user_id=None):
     logging.info("Executing: get_quota_info")
     url = "https://proapi.115.com/open/offline/get_quota_info"
-    headers = {
-        "Authorization": f"Bearer {access_token}"
-    }
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=headers) as resp:
-                if resp.status != 200:
-                    logging.error(f"获取配额信息失败，状态码: {resp.status}")
-                    return None, f"获取配额信息失败，状态码: {resp.status}"
-                resp_json = await resp.json()
-                if resp_json.get("state") is True and resp_json.get("code") == 0:
-                    return resp_json.get("data"), None
-                else:
-                    error_msg = resp_json.get("message") or resp_json.get("error") or "获取配额信息失败，未知错误。"
-                    logging.error(f"获取配额信息失败: {error_msg}")
-                    return None, error_msg
+        response = await Api115Client(access_token, user_id=user_id).get(url)
+        if response.status_code != 200:
+            logging.error(f"获取配额信息失败，状态码: {response.status_code}")
+            return None, f"获取配额信息失败，状态码: {response.status_code}"
+        resp_json = response.json()
+        if resp_json.get("state") is True and resp_json.get("code") == 0:
+            return resp_json.get("data"), None
+        else:
+            error_msg = resp_json.get("message") or resp_json.get("error") or "获取配额信息失败，未知错误。"
+            logging.error(f"获取配额信息失败: {error_msg}")
+            return None, error_msg
     except Exception as e:
         logging.error(f"获取配额信息时发生异常: {e}")
         return None, "获取配额信息时发生异常"
 
-async def handle_quota(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logging.info("Executing: handle_quota")
-    try:
-        user_id = str(update.effective_user.id)
-        access_token = await check_and_get_access_token(user_id, context)
-        if not access_token:
-            return
+# 新增函数：刷新单个账号的配额缓存
+async def refresh_account_quota(user_id, account):
+    """请求配额接口并更新 QUOTA_CACHE，返回 (缓存条目, error)"""
+    logging.info("Executing: refresh_account_quota")
+    access_token, err = await get_valid_access_token(user_id, account)
+    if err:
+        return None, err
+
+    quota_data, err = await get_quota_info(access_token, user_id)
+    if err:
+        return None, err
+
+    quota_data = quota_data or {}
+    entry = {
+        "count": int(quota_data.get("count") or 0),
+        "used": int(quota_data.get("used") or 0),
+        "surplus": int(quota_data.get("surplus") or 0),
+        "data": quota_data,
+        "updated_at": int(time.time()),
+    }
+    QUOTA_CACHE[(user_id, account)] = entry
+    return entry, None
 
-        quota_data, err = await get_quota_info(access_token)
-        if err:
-            await update.message.reply_text(f"❌ 获取配额信息失败：{err}")
-            return
+# 新增函数：读取配额缓存，过期时重新校验
+async def get_cached_quota(user_id, account, max_age=None):
+    """
+    返回账号的配额缓存条目，超过 max_age（默认 QUOTA_CACHE_TTL）秒时重新请求配额接口。
+    重新请求失败时退回到旧的缓存条目（若有）。返回 (缓存条目, error)。
+    """
+    if max_age is None:
+        max_age = QUOTA_CACHE_TTL
+    entry = QUOTA_CACHE.get((user_id, account))
+    if entry and int(time.time()) - entry["updated_at"] <= max_age:
+        return entry, None
+
+    fresh_entry, err = await refresh_account_quota(user_id, account)
+    if err:
+        if entry:
+            logging.warning(f"重新校验账号 {account} 的配额失败，使用旧缓存: {err}")
+            return entry, None
+        return None, err
+    return fresh_entry, None
+
+# 新增函数：成功提交后在本地扣减配额缓存
+def consume_cached_quota(user_id, account, count):
+    entry = QUOTA_CACHE.get((user_id, account))
+    if not entry or count <= 0:
+        return
+    entry["surplus"] = max(0, entry["surplus"] - count)
+    entry["used"] += count
 
-        # 预处理配额数据，防止出现 None 的情况
-        quota_data = quota_data or {}
+# 新增函数：为提交任务选择账号
+async def select_account_for_submission(user_id):
+    """
+    从用户的账号池中选出已设置下载文件夹、且缓存中剩余配额最多的账号。
+    仅当某账号的缓存缺失或过期时才请求配额接口；所有账号都无法获取配额时，退回到第一个可用账号。
+    """
+    logging.info("Executing: select_account_for_submission")
+    candidates = [a for a in list_user_accounts(user_id) if load_user_download_folder(user_id, a)[0]]
+    if not candidates:
+        return None
+
+    best_account, best_surplus = None, -1
+    for account in candidates:
+        entry, err = await get_cached_quota(user_id, account)
+        if err:
+            logging.warning(f"获取账号 {account} 的配额失败: {err}")
+            continue
+        if entry["surplus"] > best_surplus:
+            best_account, best_surplus = account, entry["surplus"]
+
+    return best_account or candidates[0]
+
+# 新增函数：后台定期刷新所有账号的配额缓存
+async def refresh_quota_cache_job(context: ContextTypes.DEFAULT_TYPE):
+    logging.info("Executing: refresh_quota_cache_job")
+    for user_id in list_owned_users():
+        for account in list_user_accounts(user_id):
+            try:
+                _, err = await refresh_account_quota(user_id, account)
+                if err:
+                    logging.warning(f"刷新用户 {user_id} 账号 {account} 的配额缓存失败: {err}")
+            except Exception:
+                logging.error(f"刷新配额缓存时发生异常:\n{traceback.format_exc()}")
+
+async def handle_quota(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logging.info("Executing: handle_quota")
+    try:
+        user_id = str(update.effective_user.id)
+        account = load_active_account(user_id)
+        # /quota refresh 强制重新请求配额接口，否则优先使用配额缓存
+        max_age = 0 if context.args and context.args[0] == "refresh" else None
+        entry, err = await get_cached_quota(user_id, account, max_age)
+        if err:
+            await update.message.reply_text(f"❌ 获取配额信息失败：{err}")
+            return
+
+        # 预处理配额数据，防止出现 None 的情况；缓存中的剩余配额可能已在本地扣减
+        quota_data = dict(entry.get("data") or {})
+        quota_data['used'] = entry["used"]
+        quota_data['surplus'] = entry["surplus"]
         quota_data.setdefault('count', 0)
         quota_data.setdefault('used', 0)
         quota_data.setdefault('surplus', 0)
@@ -451,7 +1942,8 @@ async def handle_quota(update: Update, context: ContextTypes.DEFAULT_TYPE):
         formatted_quota = "📊 **配额信息**\n\n"
         formatted_quota += f"总配额: {quota_data.get('count', 0)}\n"
         formatted_quota += f"已用配额: {quota_data.get('used', 0)}\n"
-        formatted_quota += f"剩余配额: {quota_data.get('surplus', 0)}\n\n"
+        formatted_quota += f"剩余配额: {quota_data.get('surplus', 0)}\n"
+        formatted_quota += f"更新时间: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['updated_at']))}（/quota refresh 立即刷新）\n\n"
 
         for package in quota_data.get("package", []):
             package = package or {}
@@ -499,54 +1991,99 @@ async def handle_organize_videos(update: Update, context: ContextTypes.DEFAULT_T
     if not access_token:
         return
 
-    # 获取下载文件夹设置
-    download_folder_id, download_folder_path = load_user_download_folder(user_id)
-    if not download_folder_id:
-        await update.message.reply_text("请先通过 /set_download_folder 设置下载文件夹。")
-        return
-
-    headers = {"Authorization": f"Bearer {access_token}"}
-    async with httpx.AsyncClient(headers=headers, timeout=20) as client:
+    async with Api115Client(access_token, timeout=20, user_id=user_id) as client:
         try:
-            # 第一步：创建新文件夹
-            folder_id, folder_name = await create_folder(client, download_folder_id)
-            logging.info(f"已创建文件夹：{folder_name}（CID: {folder_id}）")
-
-            # 第二步：列出视频文件并找出大于200MB的文件
-            files = await list_files(client, download_folder_id)
-            big_video_ids = []
-            moved_files = []
-            for file in files:
-                if file.get("fc") == "1" and int(file.get("fs", 0)) > 200 * 1024 * 1024:
-                    big_video_ids.append(file["fid"])
-                    moved_files.append({
-                        "name": file.get("fn", "未知文件名"),
-                        "size": int(file.get("fs", 0))
-                    })
-            logging.info(f"准备移动的文件数: {len(big_video_ids)}")
-
-            # 移动文件
-            await move_files(client, big_video_ids, folder_id)
-            logging.info("文件移动完成")
-
-            # 第三步：清空目录（排除新建文件夹）
-            delete_ids, deleted_names = await delete_files(client, download_folder_id, exclude_ids={folder_id})
-            logging.info("目录清理完成")
-
-            # 发送整理结果
-            result_text = "视频文件整理完成！\n"
-            result_text += f"移动文件数: {len(moved_files)}\n"
-            result_text += f"删除文件/文件夹数: {len(delete_ids)}\n\n"  # 修改：使用 delete_ids 的长度
-
-            # 记录移动的文件详情到日志中
-            for file in moved_files:
-                logging.info(f"移动的文件: {file['name']}, 大小: {file['size'] / (1024 * 1024):.2f} MB")
-
-            await send_long_message(update, context, result_text)
+            await run_inflight(user_id, "organize", organize_download_folder(client, user_id, update.message.reply_text),
+                               resumable=True)
+        except ShutdownInterrupted:
+            await update.message.reply_text("🔄 机器人正在重启，整理已中断，重启后会自动继续完成。")
         except Exception as e:
             logging.error(f"视频文件整理失败: {e}")
             await update.message.reply_text(f"❌ 视频文件整理失败：{e}")
 
+async def organize_download_folder(client, user_id, notify, skip_unchanged=False):
+    """
+    整理下载文件夹：把符合整理规则的视频移动到新建的文件夹，再清空其余内容。
+    结果通过 notify(文本) 发送；skip_unchanged=True 时快照自上次成功整理以来没有变化即跳过（定时任务使用）。
+    返回执行结果 TASK_*。
+    """
+    # 获取下载文件夹设置
+    download_folder_id, download_folder_path = load_user_download_folder(user_id)
+    if not download_folder_id:
+        await notify("请先通过 /set_download_folder 设置下载文件夹。")
+        return TASK_NOT_CONFIGURED
+
+    # 第一步：增量同步下载文件夹快照，只有新增项目需要请求服务器；
+    # 是否有新内容按上次整理时的快照版本判断，不受其他操作（如 /cleanup）同步快照的影响
+    items, changed = await sync_folder_snapshot(client, user_id, download_folder_id)
+    if is_snapshot_processed(user_id, "organize", download_folder_id) and (
+            skip_unchanged or not any(record["fc"] == "1" for record in items.values())):
+        if not skip_unchanged:
+            await notify("✅ 下载文件夹没有新的内容需要整理。")
+        return TASK_UNCHANGED
+
+    # 第二步：创建新文件夹
+    folder_id, folder_name = await create_folder(client, download_folder_id)
+    logging.info(f"已创建文件夹：{folder_name}（CID: {folder_id}）")
+
+    # 第三步：并发遍历子文件夹，连同顶层文件一起按整理规则（默认：大于200MB的视频文件）找出需要移动的文件
+    nested, owners, truncated = await collect_nested_files(client, items.values())
+    classified = classify_records(compile_rules(ORGANIZE_RULES), list(items.values()) + nested)
+    big_video_ids = []
+    moved_files = []
+    for record in classified.get(("move", None), []):
+        big_video_ids.append(record["fid"])
+        moved_files.append({
+            "name": record["fn"] or "未知文件名",
+            "size": record["fs"]
+        })
+    logging.info(f"准备移动的文件数: {len(big_video_ids)}")
+
+    # 移动文件，移动失败的文件不会被删除
+    failures = failed_results(await move_files(client, big_video_ids, folder_id))
+    moved_files = [file for fid, file in zip(big_video_ids, moved_files) if fid not in failures]
+    big_video_ids = [fid for fid in big_video_ids if fid not in failures]
+    snapshot_remove(user_id, download_folder_id, big_video_ids)
+    record_usage(user_id, bytes_moved=sum(int(file["size"] or 0) for file in moved_files))
+    logging.info("文件移动完成")
+
+    # 第四步：清空目录（排除新建文件夹）
+    moved_ids = set(big_video_ids)
+    remaining_items = [record for fid, record in items.items() if fid not in moved_ids]
+    # 嵌套文件移动失败或子文件夹层数过多未遍历完整时，保留其所在的顶层文件夹
+    keep_ids = {folder_id, *failures, *(owners[fid] for fid in failures if fid in owners), *truncated}
+    delete_ids, deleted_names = await delete_items(client, download_folder_id, remaining_items, exclude_ids=keep_ids)
+    snapshot_remove(user_id, download_folder_id, delete_ids)
+    # 快照中记录服务器上的修改时间，否则下次同步会把新建的文件夹当作外部变化
+    try:
+        folder_record = await fetch_snapshot_record(client, download_folder_id, folder_id)
+    except Exception as e:
+        logging.warning(f"读取新建文件夹 {folder_id} 的信息失败: {e}")
+        folder_record = None
+    snapshot_add(user_id, download_folder_id, [folder_record or {
+        "fid": folder_id, "fn": folder_name, "fc": "0", "fs": 0,
+        "upt": int(time.time()), "sha1": "", "ico": "", "isv": "0",
+    }])
+    logging.info("目录清理完成")
+
+    # 发送整理结果
+    result_text = "视频文件整理完成！\n"
+    result_text += f"移动文件数: {len(moved_files)}\n"
+    result_text += f"删除文件/文件夹数: {len(delete_ids)}\n"  # 修改：使用 delete_ids 的长度
+    if failures:
+        result_text += f"移动失败（已保留）: {len(failures)}\n"
+    if truncated:
+        result_text += f"子文件夹层数过多（已保留）: {len(truncated)}\n"
+    result_text += "\n"
+
+    # 记录移动的文件详情到日志中
+    for file in moved_files:
+        logging.info(f"移动的文件: {file['name']}, 大小: {file['size'] / (1024 * 1024):.2f} MB")
+
+    mark_snapshot_processed(user_id, "organize", download_folder_id)
+    await notify(result_text)
+    return TASK_DONE
+
 # 生成随机中文字符串
 def random_chinese(length=4):
     return ''.join(chr(random.randint(0x4E00, 0x9FA5)) for _ in range(length))
@@ -579,19 +2116,75 @@ async def list_files(client, cid, file_type=4):
         raise Exception(f"获取文件列表失败: {res}")
     return res.get("data", [])
 
+# 新增函数：批量文件操作
+async def bulk_file_operation(client, url, file_ids, data=None, chunk_size=None, concurrency=None):
+    """
+    将 file_ids 按 chunk_size 分块，最多 concurrency 个分块并发请求 url。
+    115 拒绝某个分块时对半拆分后重试，直到定位到具体出错的 ID；
+    网络错误、限流或服务器错误与具体 ID 无关，整个分块按退避重试，仍失败则整块标记为失败。
+    返回逐个 ID 的结果字典：{fid: None（成功）或错误信息}。
+    """
+    chunk_size = chunk_size or BULK_CHUNK_SIZE
+    semaphore = asyncio.Semaphore(concurrency or BULK_CONCURRENCY)
+    results = {}
+
+    async def attempt(chunk):
+        """返回 (错误信息或 None, 是否为与 ID 无关的暂时性错误)"""
+        async with semaphore:
+            try:
+                response = await client.post(url, data={"file_ids": ",".join(chunk), **(data or {})})
+            except Exception as e:
+                return f"请求异常: {e!r}", True
+        if response.status_code == 429 or response.status_code >= 500:
+            return f"服务器返回状态码 {response.status_code}", True
+        try:
+            res = response.json()
+        except ValueError:
+            return f"无法解析服务器响应，状态码: {response.status_code}", True
+        if res.get("state"):
+            return None, False
+        error = res.get("message") or res.get("error") or str(res)
+        return error, is_deferrable_error(error)
+
+    async def run(chunk):
+        for retry in range(BULK_RETRIES + 1):
+            error, transient = await attempt(chunk)
+            if not transient or retry == BULK_RETRIES:
+                break
+            await asyncio.sleep(2 ** retry)
+        if error is None:
+            for fid in chunk:
+                results[fid] = None
+        elif transient:
+            logging.warning(f"文件操作失败 {url}（{len(chunk)} 个 ID，已重试 {BULK_RETRIES} 次）: {error}")
+            for fid in chunk:
+                results[fid] = error
+        elif len(chunk) > 1:
+            middle = len(chunk) // 2
+            await asyncio.gather(run(chunk[:middle]), run(chunk[middle:]))
+        else:
+            logging.warning(f"文件操作失败 {url} {chunk[0]}: {error}")
+            results[chunk[0]] = error
+
+    unique_ids = list(dict.fromkeys(fid for fid in file_ids if fid))
+    await asyncio.gather(*(run(unique_ids[i:i + chunk_size]) for i in range(0, len(unique_ids), chunk_size)))
+    return results
+
+def failed_results(results):
+    """从批量操作结果中取出失败的 {fid: 错误信息}"""
+    return {fid: error for fid, error in results.items() if error is not None}
+
 # 新增函数：移动文件
 async def move_files(client, file_ids, to_cid):
+    """批量移动文件（夹），返回逐个 ID 的结果字典"""
     if not file_ids:
-        return
+        return {}
     url = "https://proapi.115.com/open/ufile/move"
-    data = {
-        "file_ids": ','.join(file_ids),
-        "to_cid": str(to_cid)
-    }
-    response = await client.post(url, data=data)
-    res = response.json()
-    if not res.get("state"):
-        raise Exception(f"移动文件失败: {res}")
+    results = await bulk_file_operation(client, url, file_ids, {"to_cid": str(to_cid)})
+    failures = failed_results(results)
+    if failures:
+        logging.error(f"移动文件失败 {len(failures)}/{len(results)} 个: {list(failures.items())[:5]}")
+    return results
 
 # 新增函数：删除文件
 async def delete_files(client, cid, exclude_ids):
@@ -606,7 +2199,11 @@ async def delete_files(client, cid, exclude_ids):
     if not res.get("state"):
         raise Exception(f"列出文件失败: {res}")
     items = res.get("data", [])
+    return await delete_items(client, cid, items, exclude_ids)
 
+# 新增函数：删除指定的文件（夹）
+async def delete_items(client, cid, items, exclude_ids=frozenset()):
+    """删除 cid 下的指定项目（列表项或快照记录），返回删除的 ID 和名称"""
     delete_ids = []
     deleted_names = []  # 新增：用于记录删除的文件（夹）名称
     for item in items:
@@ -617,16 +2214,19 @@ async def delete_files(client, cid, exclude_ids):
 
     if delete_ids:
         del_url = "https://proapi.115.com/open/ufile/delete"
-        data = {"file_ids": ",".join(delete_ids), "parent_id": str(cid)}
-        del_resp = await client.post(del_url, data=data)
-        del_res = del_resp.json()
-        if not del_res.get("state"):
-            raise Exception(f"删除文件失败: {del_res}")
+        results = await bulk_file_operation(client, del_url, delete_ids, {"parent_id": str(cid)})
+        failures = failed_results(results)
+        if failures and len(failures) == len(results):
+            raise Exception(f"删除文件失败: {next(iter(failures.values()))}")
+        if failures:
+            logging.error(f"删除文件失败 {len(failures)}/{len(results)} 个: {list(failures.items())[:5]}")
+            deleted_names = [name for fid, name in zip(delete_ids, deleted_names) if fid not in failures]
+            delete_ids = [fid for fid in delete_ids if fid not in failures]
         logging.info(f"已删除文件/文件夹数: {len(delete_ids)}，名称: {', '.join(deleted_names)}")  # 修改：增加删除文件（夹）名称的日志记录
     else:
         logging.info("无可删除内容。")
 
-    # 新增：返回删除的文件 ID 和名称
+    # 新增：返回删除成功的文件 ID 和名称
     return delete_ids, deleted_names
 
 # 新增函数：查找或创建指定路径的文件夹
@@ -689,6 +2289,339 @@ async def list_all_items(client, cid):
         raise Exception(f"获取项目列表失败: {res}")
     return res.get("data", [])
 
+# 新增函数：按页列出项目，同时返回服务器端的项目总数
+async def list_folder_page(client, cid, offset=0, limit=1150, order=None, asc=None, file_type=None, show_dir=1):
+    """列出 cid 下的一页项目，order 可为 user_utime/file_name/file_size 等，返回 (项目列表, 总数)"""
+    url = "https://proapi.115.com/open/ufile/files"
+    params = {
+        "cid": str(cid),
+        "limit": limit,
+        "offset": offset,
+        "show_dir": show_dir,
+    }
+    if order:
+        params["o"] = order
+        params["asc"] = asc
+    if file_type is not None:
+        params["type"] = file_type
+    response = await client.get(url, params=params)
+    res = response.json()
+    if not res.get("state"):
+        raise Exception(f"获取项目列表失败: {res}")
+    return res.get("data", []), int(res.get("count") or 0)
+
+def to_snapshot_record(item):
+    """将列表项压缩为快照记录，只保留分类和比较需要的字段"""
+    try:
+        upt = int(item.get("upt") or 0)
+    except (ValueError, TypeError):
+        upt = 0
+    try:
+        size = int(item.get("fs") or 0)
+    except (ValueError, TypeError):
+        size = 0
+    return {
+        "fid": item.get("fid") or item.get("cid"),
+        "fn": item.get("fn") or "",
+        "fc": str(item.get("fc")),
+        "fs": size,
+        "upt": upt,
+        "sha1": item.get("sha1") or "",
+        "ico": (item.get("ico") or "").lower(),
+        "isv": str(item.get("isv") or "0"),
+    }
+
+def is_video_record(record):
+    """根据 isv 字段或扩展名判断快照记录是否为视频文件"""
+    if record["fc"] != "1":
+        return False
+    extension = record["ico"] or os.path.splitext(record["fn"])[1].lstrip(".").lower()
+    return record["isv"] == "1" or extension in VIDEO_EXTENSIONS
+
+# 新增函数：文件分类规则
+def parse_size(text):
+    m = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?B)?\s*$", text.upper())
+    if not m:
+        raise ValueError(f"无法识别的大小: {text}")
+    return int(float(m.group(1)) * SIZE_UNITS[m.group(2) or "B"])
+
+def compile_rule(spec, name=None):
+    """
+    将规则字符串编译为规则字典，条件之间用分号分隔，所有条件同时满足才算匹配：
+      type=video|file|folder|any   min_size=200MB   max_size=4GB
+      ext=mkv,mp4                  name=<正则，不区分大小写，不能包含分号>
+      action=archive|delete|keep|move 或 move:<路径>
+    """
+    rule = {"name": name or spec, "type": "any", "min_size": None, "max_size": None,
+            "ext": None, "pattern": None, "action": None, "target": None}
+    for part in spec.split(';'):
+        if not part.strip():
+            continue
+        key, sep, value = part.partition('=')
+        key, value = key.strip().lower(), value.strip()
+        if not sep or not value:
+            raise ValueError(f"无法识别的条件: {part.strip()}")
+        if key == "type":
+            if value not in ("video", "file", "folder", "any"):
+                raise ValueError(f"不支持的类型: {value}")
+            rule["type"] = value
+        elif key in ("min_size", "max_size"):
+            rule[key] = parse_size(value)
+        elif key == "ext":
+            rule["ext"] = {e.strip().lstrip('.').lower() for e in value.split(',') if e.strip()}
+        elif key == "name":
+            try:
+                rule["pattern"] = re.compile(value, re.IGNORECASE)
+            except re.error as e:
+                raise ValueError(f"无效的正则表达式 {value}: {e}")
+        elif key == "action":
+            action, _, target = value.partition(':')
+            if action not in ("archive", "delete", "keep", "move"):
+                raise ValueError(f"不支持的动作: {value}")
+            rule["action"], rule["target"] = action, target.strip() or None
+        else:
+            raise ValueError(f"不支持的条件: {key}")
+    if not rule["action"]:
+        raise ValueError("规则缺少 action")
+    return rule
+
+def compile_rules(specs):
+    """编译一组规则，specs 可以是规则字符串列表或 (名称, 规则字符串) 列表"""
+    return [compile_rule(spec) if isinstance(spec, str) else compile_rule(spec[1], spec[0]) for spec in specs]
+
+def match_rule(rule, record):
+    if rule["type"] == "video" and not is_video_record(record):
+        return False
+    if rule["type"] == "file" and record["fc"] != "1":
+        return False
+    if rule["type"] == "folder" and record["fc"] != "0":
+        return False
+    if rule["min_size"] is not None and record["fs"] < rule["min_size"]:
+        return False
+    if rule["max_size"] is not None and record["fs"] > rule["max_size"]:
+        return False
+    if rule["ext"] is not None:
+        extension = record["ico"] or os.path.splitext(record["fn"])[1].lstrip(".").lower()
+        if extension not in rule["ext"]:
+            return False
+    if rule["pattern"] is not None and not rule["pattern"].search(record["fn"]):
+        return False
+    return True
+
+def classify_records(rules, records):
+    """
+    一次遍历所有记录，按第一条匹配的规则分组。
+    返回 {(action, target): [record, ...]}，未匹配任何规则的记录归入 ("keep", None)。
+    """
+    groups = {}
+    for record in records:
+        key = ("keep", None)
+        for rule in rules:
+            if match_rule(rule, record):
+                key = (rule["action"], rule["target"])
+                break
+        groups.setdefault(key, []).append(record)
+    return groups
+
+def load_user_rules(user_id):
+    """读取用户为 /apply_rules 定义的规则，返回 [(名称, 规则字符串)]"""
+    config = read_config()
+    section = f"rules_{user_id}"
+    if section not in config:
+        return []
+    return list(config[section].items())
+
+def save_user_rule(user_id, name, spec):
+    logging.info("Executing: save_user_rule")
+    config = read_config()
+    section = f"rules_{user_id}"
+    if section not in config:
+        config[section] = {}
+    # ConfigParser 会对 % 做插值，需要转义
+    config[section][name] = spec.replace('%', '%%')
+    write_config(config)
+
+def delete_user_rule(user_id, name):
+    logging.info("Executing: delete_user_rule")
+    config = read_config()
+    section = f"rules_{user_id}"
+    if section not in config or name not in config[section]:
+        return False
+    config.remove_option(section, name)
+    write_config(config)
+    return True
+
+def load_folder_snapshot(user_id, cid):
+    return load_state(f"snapshot_{user_id}_{cid}") or {"items": {}, "cursor": 0, "full_sync_at": 0, "version": 0}
+
+def save_folder_snapshot(user_id, cid, snapshot):
+    save_state(f"snapshot_{user_id}_{cid}", snapshot)
+
+def snapshot_remove(user_id, cid, fids):
+    """我们自己移走或删除项目后，同步更新快照"""
+    snapshot = load_folder_snapshot(user_id, cid)
+    for fid in fids:
+        snapshot["items"].pop(fid, None)
+    save_folder_snapshot(user_id, cid, snapshot)
+
+def snapshot_add(user_id, cid, records):
+    """我们自己在文件夹中创建或移入项目后，同步更新快照"""
+    snapshot = load_folder_snapshot(user_id, cid)
+    for record in records:
+        snapshot["items"][record["fid"]] = record
+        snapshot["cursor"] = max(snapshot["cursor"], record["upt"])
+    save_folder_snapshot(user_id, cid, snapshot)
+
+async def fetch_snapshot_record(client, cid, fid):
+    """返回 cid 下项目 fid 在服务器上的快照记录；只查找最近修改的一页（刚创建或移入文件的项目总在其中），找不到时返回 None"""
+    page, _ = await list_folder_page(client, cid, 0, 50, order="user_utime", asc=0)
+    for item in page:
+        record = to_snapshot_record(item)
+        if str(record["fid"]) == str(fid):
+            return record
+    return None
+
+# 新增函数：增量同步文件夹快照
+async def sync_folder_snapshot(client, user_id, cid, full=False):
+    """
+    按修改时间倒序列出 cid 下的项目，遇到早于游标的项目即停止，只处理新增或变更的项目。
+    增量同步后项目数与服务器总数不一致（说明有项目在外部被删除或移入），或距上次全量校对超过
+    SNAPSHOT_FULL_SYNC_INTERVAL 时，改为全量同步。
+    返回 (快照记录字典 fid -> record, 新增或变更的记录列表)。
+    """
+    logging.info("Executing: sync_folder_snapshot")
+    snapshot = load_folder_snapshot(user_id, cid)
+    known = snapshot["items"]
+    now = int(time.time())
+    full = full or not known or now - snapshot["full_sync_at"] > SNAPSHOT_FULL_SYNC_INTERVAL
+
+    items = {} if full else dict(known)
+    changed = []
+    offset = 0
+    page_size = 50  # 新增项目通常很少，从小页开始，逐页翻倍
+    total = 0
+    while True:
+        page, total = await list_folder_page(client, cid, offset, page_size, order="user_utime", asc=0)
+        reached_cursor = False
+        for item in page:
+            record = to_snapshot_record(item)
+            if not record["fid"]:
+                continue
+            if not full and record["upt"] < snapshot["cursor"]:
+                reached_cursor = True
+                break
+            previous = known.get(record["fid"])
+            if previous is None or previous["upt"] != record["upt"]:
+                changed.append(record)
+            items[record["fid"]] = record
+        offset += len(page)
+        if reached_cursor or len(page) < page_size or offset >= total:
+            break
+        page_size = min(page_size * 2, 1150)
+
+    if not full and len(items) != total:
+        logging.info(f"文件夹 {cid} 快照项目数 {len(items)} 与服务器总数 {total} 不一致，改为全量同步")
+        return await sync_folder_snapshot(client, user_id, cid, full=True)
+
+    snapshot["items"] = items
+    snapshot["cursor"] = max([snapshot["cursor"]] + [record["upt"] for record in changed])
+    if changed:
+        # 版本号在每次同步到外部变化时递增，清理和整理据此判断自己上次处理之后是否有新内容
+        snapshot["version"] = snapshot.get("version", 0) + 1
+    if full:
+        snapshot["full_sync_at"] = now
+    save_folder_snapshot(user_id, cid, snapshot)
+    logging.info(f"文件夹 {cid} 快照同步完成（{'全量' if full else '增量'}）：共 {len(items)} 项，新增或变更 {len(changed)} 项")
+    return items, changed
+
+# 新增函数：记录清理、整理处理到的快照版本
+def is_snapshot_processed(user_id, task, cid):
+    """task（cleanup/organize）上次成功执行之后，文件夹 cid 的快照是否没有新的变化"""
+    processed = load_state(f"processed_{user_id}_{task}")
+    return processed == {"cid": cid, "version": load_folder_snapshot(user_id, cid).get("version", 0)}
+
+def mark_snapshot_processed(user_id, task, cid):
+    save_state(f"processed_{user_id}_{task}", {"cid": cid, "version": load_folder_snapshot(user_id, cid).get("version", 0)})
+
+# 新增函数：并发递归遍历文件夹
+async def walk_folders(client, roots, max_depth=None, concurrency=None):
+    """
+    异步生成器：从 roots（[(cid, 路径)]）开始逐层遍历子文件夹，最多 concurrency 个文件夹并发列出，
+    边列出边产出 (根文件夹 cid, 所在路径, 快照记录)，记录中额外包含父文件夹 ID "pid"。
+    根文件夹下的项目深度为 1，深度达到 max_depth 的文件夹不再深入。
+    """
+    max_depth = max_depth or WALK_MAX_DEPTH
+    folders = asyncio.Queue()
+    results = asyncio.Queue(maxsize=1000)
+    finished = object()
+
+    for cid, path in roots:
+        folders.put_nowait((cid, cid, path, 1))
+
+    async def worker():
+        while True:
+            root, cid, path, depth = await folders.get()
+            try:
+                offset = 0
+                while True:
+                    page, total = await list_folder_page(client, cid, offset, 1150)
+                    for item in page:
+                        record = to_snapshot_record(item)
+                        record["pid"] = cid
+                        await results.put((root, path, record))
+                        if record["fc"] == "0" and depth < max_depth:
+                            folders.put_nowait((root, record["fid"], f"{path}/{record['fn']}", depth + 1))
+                    offset += len(page)
+                    if not page or offset >= total:
+                        break
+            except Exception as e:
+                await results.put(e)
+            finally:
+                folders.task_done()
+
+    async def wait_all():
+        await folders.join()
+        await results.put(finished)
+
+    tasks = [asyncio.create_task(worker()) for _ in range(concurrency or WALK_CONCURRENCY)]
+    tasks.append(asyncio.create_task(wait_all()))
+    try:
+        while True:
+            result = await results.get()
+            if result is finished:
+                break
+            if isinstance(result, Exception):
+                raise result
+            yield result
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def collect_nested_files(client, records):
+    """
+    遍历记录中的文件夹，返回 (嵌套的文件记录, {文件 ID: 所属的顶层文件夹 ID}, 未遍历完整的顶层文件夹 ID 集合)。
+    超过 WALK_MAX_DEPTH 层的子文件夹不会被遍历，其中的文件无法处理，调用方不能删除这些顶层文件夹。
+    """
+    roots = [(record["fid"], record["fn"]) for record in records if record["fc"] == "0"]
+    nested, owners, truncated = [], {}, set()
+    if not roots:
+        return nested, owners, truncated
+    depths = {cid: 0 for cid, _ in roots}
+    async for root, path, record in walk_folders(client, roots, max_depth=WALK_MAX_DEPTH):
+        depth = depths[record["pid"]] + 1
+        if record["fc"] == "1":
+            nested.append(record)
+            owners[record["fid"]] = root
+        elif depth >= WALK_MAX_DEPTH:
+            # 父文件夹总是先于子项目产出；达到最大深度的文件夹不再深入
+            truncated.add(root)
+        else:
+            depths[record["fid"]] = depth
+    logging.info(f"遍历 {len(roots)} 个子文件夹，找到 {len(nested)} 个嵌套文件")
+    if truncated:
+        logging.warning(f"{len(truncated)} 个子文件夹超过 {WALK_MAX_DEPTH} 层，未完整遍历，将被保留")
+    return nested, owners, truncated
+
 # 新增函数：获取文件夹列表（仅文件夹）
 async def list_folders_only(client, cid, page=0, limit=1150):
     """获取指定目录下的文件夹列表"""
@@ -717,111 +2650,106 @@ async def list_folders_only(client, cid, page=0, limit=1150):
 
     return folders, len(folders)  # 返回实际的文件夹数量
 
-# 新增函数：获取文件夹路径
-async def get_folder_path(client, folder_id):
-    """获取文件夹的完整路径"""
-    if folder_id == "0":
-        return "/"  # 根目录
+# 文件夹选择会话：callback_data 只携带短会话 ID 和操作（如 "fs:<sid>:e3"），
+# 路径栈、各层页码和已列出的文件夹保存在服务端的 LRU 中，返回上一层或翻页时不需要重新请求 115
+FOLDER_SESSION_CAPACITY = 1000
+FOLDER_PAGE_SIZE = 8
+_FOLDER_SESSIONS = collections.OrderedDict()
+
+def create_folder_session(user_id, selection_type):
+    sid = secrets.token_urlsafe(6)
+    _FOLDER_SESSIONS[sid] = {
+        "user_id": user_id,
+        "type": selection_type,
+        "stack": [["0", "", 0]],  # [cid, 名称, 页码]，第一项为根目录
+        "listings": {},           # cid -> [(fid, 名称)]
+    }
+    while len(_FOLDER_SESSIONS) > FOLDER_SESSION_CAPACITY:
+        _FOLDER_SESSIONS.popitem(last=False)
+    return sid
 
-    # 尝试通过文件列表API获取路径信息
-    try:
-        url = "https://proapi.115.com/open/ufile/files"
-        params = {"cid": str(folder_id), "limit": 1}
-        response = await client.get(url, params=params)
-        res = response.json()
-
-        if res.get("state") and res.get("path"):
-            path_data = res.get("path", [])
-            if path_data:
-                # 构建路径字符串
-                path_parts = [item.get("name", "") for item in path_data if item.get("name")]
-                return "/" + "/".join(path_parts) if path_parts else "/"
-    except Exception as e:
-        logging.warning(f"获取路径时发生异常: {e}")
+def get_folder_session(sid, user_id):
+    session = _FOLDER_SESSIONS.get(sid)
+    if session is None or session["user_id"] != user_id:
+        return None
+    _FOLDER_SESSIONS.move_to_end(sid)
+    return session
 
-    # 如果无法获取路径，返回文件夹ID作为标识
-    return f"/folder_{folder_id}"
+def folder_session_path(session):
+    return "/" + "/".join(name for _, name, _ in session["stack"][1:])
 
 # 新增函数：显示文件夹选择界面
-async def show_folder_selection(update, context, current_cid="0", page=0, selection_type="download", parent_cid=None):
-    """显示文件夹选择界面"""
-    user_id = str(update.effective_user.id)
-    access_token = await check_and_get_access_token(user_id, context)
-    if not access_token:
-        return
-
-    headers = {"Authorization": f"Bearer {access_token}"}
-    async with httpx.AsyncClient(headers=headers, timeout=20) as client:
-        try:
-            # 获取文件夹列表（API获取所有，然后分页显示）
-            all_folders, total_count = await list_folders_only(client, current_cid, 0, 1150)
-
-            # 分页显示文件夹
-            page_size = 8
-            start_idx = page * page_size
-            end_idx = start_idx + page_size
-            folders = all_folders[start_idx:end_idx]
-
-            logging.info(f"显示文件夹选择界面 - 总文件夹数: {total_count}, 当前页显示: {len(folders)}")
-
-            # 获取当前路径
-            current_path = await get_folder_path(client, current_cid)
-
-            # 构建键盘
-            keyboard = []
-
-            # 如果不是根目录，添加上一层按钮
-            if current_cid != "0" and parent_cid:
-                keyboard.append([InlineKeyboardButton("⬆️ 上一层", callback_data=f"folder_up_{selection_type}_{parent_cid}_0")])
-
-            # 添加文件夹列表
-            for folder in folders:
-                folder_name = folder.get("fn", "未知文件夹")
-                folder_fid = folder.get("fid")  # 文件夹使用fid作为ID
-                if len(folder_name) > 20:
-                    display_name = folder_name[:17] + "..."
-                else:
-                    display_name = folder_name
-
-                # 左侧显示文件夹名，右侧显示选择按钮
-                keyboard.append([
-                    InlineKeyboardButton(f"📁 {display_name}", callback_data=f"folder_enter_{selection_type}_{folder_fid}_0"),
-                    InlineKeyboardButton("✅ 选择", callback_data=f"folder_select_{selection_type}_{folder_fid}")
-                ])
-
-            # 添加翻页按钮
-            nav_buttons = []
-            page_size = 8
-            if page > 0:
-                nav_buttons.append(InlineKeyboardButton("⬅️ 上一页", callback_data=f"folder_page_{selection_type}_{current_cid}_{page-1}"))
-
-            if (page + 1) * page_size < total_count:
-                nav_buttons.append(InlineKeyboardButton("➡️ 下一页", callback_data=f"folder_page_{selection_type}_{current_cid}_{page+1}"))
-
-            if nav_buttons:
-                keyboard.append(nav_buttons)
-
-            # 添加取消按钮
-            keyboard.append([InlineKeyboardButton("❌ 取消", callback_data=f"folder_cancel_{selection_type}")])
+async def show_folder_selection(update, context, sid):
+    """显示文件夹选择界面，当前目录的文件夹列表只在第一次进入时请求"""
+    session = _FOLDER_SESSIONS[sid]
+    current_cid, _, page = session["stack"][-1]
+    selection_type = session["type"]
 
-            reply_markup = InlineKeyboardMarkup(keyboard)
-
-            folder_type_name = "下载文件夹" if selection_type == "download" else "归档文件夹"
-            page_info = f"第 {page + 1} 页" if total_count > 8 else ""
-            message_text = f"请选择{folder_type_name}:\n\n📍 当前路径: {current_path}\n📊 文件夹总数: {total_count} {page_info}"
-
-            if hasattr(update, 'callback_query') and update.callback_query:
-                await update.callback_query.edit_message_text(message_text, reply_markup=reply_markup)
+    try:
+        listing = session["listings"].get(current_cid)
+        if listing is None:
+            access_token = await check_and_get_access_token(session["user_id"], context)
+            if not access_token:
+                return
+            async with Api115Client(access_token, timeout=20, user_id=session["user_id"]) as client:
+                all_folders, _ = await list_folders_only(client, current_cid, 0, 1150)
+            listing = session["listings"][current_cid] = [(folder.get("fid"), folder.get("fn", "未知文件夹")) for folder in all_folders]
+
+        total_count = len(listing)
+        start_idx = page * FOLDER_PAGE_SIZE
+        logging.info(f"显示文件夹选择界面 - 总文件夹数: {total_count}, 当前页: {page}")
+
+        # 构建键盘
+        keyboard = []
+
+        # 如果不是根目录，添加上一层按钮
+        if len(session["stack"]) > 1:
+            keyboard.append([InlineKeyboardButton("⬆️ 上一层", callback_data=f"fs:{sid}:u")])
+
+        # 添加文件夹列表，按钮只携带文件夹在列表中的序号
+        for i in range(start_idx, min(start_idx + FOLDER_PAGE_SIZE, total_count)):
+            folder_name = listing[i][1]
+            if len(folder_name) > 20:
+                display_name = folder_name[:17] + "..."
             else:
-                await update.message.reply_text(message_text, reply_markup=reply_markup)
+                display_name = folder_name
+
+            # 左侧显示文件夹名，右侧显示选择按钮
+            keyboard.append([
+                InlineKeyboardButton(f"📁 {display_name}", callback_data=f"fs:{sid}:e{i}"),
+                InlineKeyboardButton("✅ 选择", callback_data=f"fs:{sid}:s{i}")
+            ])
+
+        # 添加翻页按钮
+        nav_buttons = []
+        if page > 0:
+            nav_buttons.append(InlineKeyboardButton("⬅️ 上一页", callback_data=f"fs:{sid}:p{page - 1}"))
+        if (page + 1) * FOLDER_PAGE_SIZE < total_count:
+            nav_buttons.append(InlineKeyboardButton("➡️ 下一页", callback_data=f"fs:{sid}:p{page + 1}"))
+        if nav_buttons:
+            keyboard.append(nav_buttons)
+
+        # 添加取消按钮
+        keyboard.append([InlineKeyboardButton("❌ 取消", callback_data=f"fs:{sid}:c")])
+
+        reply_markup = InlineKeyboardMarkup(keyboard)
+
+        folder_type_name = "下载文件夹" if selection_type == "download" else "归档文件夹"
+        page_info = f"第 {page + 1} 页" if total_count > FOLDER_PAGE_SIZE else ""
+        message_text = f"请选择{folder_type_name}:\n\n📍 当前路径: {folder_session_path(session)}\n📊 文件夹总数: {total_count} {page_info}"
+
+        if hasattr(update, 'callback_query') and update.callback_query:
+            await update.callback_query.edit_message_text(message_text, reply_markup=reply_markup)
+        else:
+            await update.message.reply_text(message_text, reply_markup=reply_markup)
 
-        except Exception as e:
-            logging.error(f"显示文件夹选择界面失败: {e}")
-            error_msg = f"❌ 获取文件夹列表失败：{e}"
-            if hasattr(update, 'callback_query') and update.callback_query:
-                await update.callback_query.edit_message_text(error_msg)
-            else:
-                await update.message.reply_text(error_msg)
+    except Exception as e:
+        logging.error(f"显示文件夹选择界面失败: {e}")
+        error_msg = f"❌ 获取文件夹列表失败：{e}"
+        if hasattr(update, 'callback_query') and update.callback_query:
+            await update.callback_query.edit_message_text(error_msg)
+        else:
+            await update.message.reply_text(error_msg)
 
 # 新增函数：处理文件夹选择回调
 async def handle_folder_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -829,60 +2757,52 @@ async def handle_folder_callback(update: Update, context: ContextTypes.DEFAULT_T
     query = update.callback_query
     await query.answer()
 
-    callback_data = query.data
-    parts = callback_data.split('_')
-
-    if len(parts) < 3:
-        await query.edit_message_text("❌ 无效的操作")
-        return
-
-    action = parts[1]  # enter, select, page, up, cancel
-    selection_type = parts[2]  # download, archive
-
     user_id = str(update.effective_user.id)
-    access_token = await check_and_get_access_token(user_id, context)
-    if not access_token:
+    parts = query.data.split(':', 2)
+    session = get_folder_session(parts[1], user_id) if len(parts) == 3 and parts[0] == "fs" else None
+    if session is None:
+        # 会话已被淘汰、机器人重启过，或是旧版本的按钮
+        await query.edit_message_text("⌛ 文件夹选择已过期，请重新执行 /set_download_folder 或 /set_archive_folder。")
         return
 
+    sid = parts[1]
+    action, arg = parts[2][:1], parts[2][1:]
+    stack = session["stack"]
+
     try:
-        if action == "enter":
-            # 进入文件夹
-            folder_fid = parts[3]  # 文件夹的fid
-            page = int(parts[4]) if len(parts) > 4 else 0
-
-            # 进入子文件夹，使用fid作为新的cid
-            # 这里需要获取当前的cid，暂时使用"0"作为parent_cid
-            await show_folder_selection(update, context, folder_fid, page, selection_type, "0")
-
-        elif action == "select":
-            # 选择文件夹
-            folder_fid = parts[3]  # 文件夹的fid
-
-            headers = {"Authorization": f"Bearer {access_token}"}
-            async with httpx.AsyncClient(headers=headers, timeout=20) as client:
-                folder_path = await get_folder_path(client, folder_fid)
-
-                if selection_type == "download":
-                    save_user_download_folder(user_id, folder_fid, folder_path)
-                    await query.edit_message_text(f"✅ 下载文件夹已设置为:\n📁 {folder_path}")
-                else:  # archive
-                    save_user_archive_folder(user_id, folder_fid, folder_path)
-                    await query.edit_message_text(f"✅ 归档文件夹已设置为:\n📁 {folder_path}")
-
-        elif action == "page":
+        if action == "e":
+            # 进入子文件夹，记录在路径栈中
+            folder_fid, folder_name = session["listings"][stack[-1][0]][int(arg)]
+            stack.append([folder_fid, folder_name, 0])
+            await show_folder_selection(update, context, sid)
+
+        elif action == "s":
+            # 选择文件夹，路径由路径栈拼出，不需要请求 115
+            folder_fid, folder_name = session["listings"][stack[-1][0]][int(arg)]
+            folder_path = folder_session_path(session).rstrip("/") + "/" + folder_name
+            _FOLDER_SESSIONS.pop(sid, None)
+
+            if session["type"] == "download":
+                save_user_download_folder(user_id, folder_fid, folder_path)
+                await query.edit_message_text(f"✅ 下载文件夹已设置为:\n📁 {folder_path}")
+            else:  # archive
+                save_user_archive_folder(user_id, folder_fid, folder_path)
+                await query.edit_message_text(f"✅ 归档文件夹已设置为:\n📁 {folder_path}")
+
+        elif action == "p":
             # 翻页
-            current_folder_id = parts[3]
-            page = int(parts[4])
-            await show_folder_selection(update, context, current_folder_id, page, selection_type)
+            stack[-1][2] = int(arg)
+            await show_folder_selection(update, context, sid)
 
-        elif action == "up":
-            # 返回上一层
-            parent_cid = parts[3]
-            page = int(parts[4]) if len(parts) > 4 else 0
-            await show_folder_selection(update, context, parent_cid, page, selection_type)
+        elif action == "u":
+            # 返回上一层，恢复离开时所在的页
+            if len(stack) > 1:
+                stack.pop()
+            await show_folder_selection(update, context, sid)
 
-        elif action == "cancel":
+        elif action == "c":
             # 取消选择
+            _FOLDER_SESSIONS.pop(sid, None)
             await query.edit_message_text("❌ 已取消文件夹选择")
 
     except Exception as e:
@@ -899,100 +2819,720 @@ async def handle_cleanup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not access_token:
         return
 
+    async with Api115Client(access_token, timeout=30, user_id=user_id) as client:
+        try:
+            await run_inflight(user_id, "cleanup", cleanup_download_folder(
+                client, user_id, update.message.reply_text, progress=update.message.reply_text), resumable=True)
+        except ShutdownInterrupted:
+            await update.message.reply_text("🔄 机器人正在重启，清理已中断，重启后会自动继续完成。")
+        except Exception as e:
+            logging.error(f"清理操作失败: {e}")
+            await update.message.reply_text(f"❌ 清理操作失败：{e}")
+
+async def cleanup_download_folder(client, user_id, notify, progress=None, skip_unchanged=False):
+    """
+    清理下载文件夹：把视频归档到归档文件夹的分组中，再清空下载文件夹。
+    结果通过 notify(文本) 发送，进度提示通过 progress(文本) 发送（可省略）；
+    skip_unchanged=True 时快照自上次成功清理以来没有变化即跳过（定时任务使用）。返回执行结果 TASK_*。
+    """
     # 获取下载文件夹和归档文件夹设置
     download_folder_id, download_folder_path = load_user_download_folder(user_id)
     archive_folder_id, archive_folder_path = load_user_archive_folder(user_id)
 
     if not download_folder_id:
-        await update.message.reply_text("请先通过 /set_download_folder 设置下载文件夹。")
-        return
+        await notify("请先通过 /set_download_folder 设置下载文件夹。")
+        return TASK_NOT_CONFIGURED
 
     if not archive_folder_id:
+        await notify("请先通过 /set_archive_folder 设置归档文件夹。")
+        return TASK_NOT_CONFIGURED
+
+    if progress:
+        await progress("🔄 开始清理操作...")
+        await progress(f"📁 下载文件夹：{download_folder_path}")
+        await progress(f"📁 归档文件夹：{archive_folder_path}")
+        await progress("📋 正在获取视频文件列表...")
+
+    # 增量同步下载文件夹快照，并从快照中筛选视频文件
+    items, changed = await sync_folder_snapshot(client, user_id, download_folder_id)
+    if skip_unchanged and is_snapshot_processed(user_id, "cleanup", download_folder_id):
+        return TASK_UNCHANGED
+    # 并发遍历子文件夹，把嵌套在种子文件夹中的视频一并归档
+    nested, owners, truncated = await collect_nested_files(client, items.values())
+    video_files = classify_records(compile_rules(CLEANUP_RULES), list(items.values()) + nested).get(("archive", None), [])
+
+    if not video_files:
+        mark_snapshot_processed(user_id, "cleanup", download_folder_id)
+        await notify("✅ 下载文件夹没有视频文件需要移动。")
+        return TASK_NOTHING
+
+    # 按需移动视频文件，确保每个 group_xxx 目录最多 200 个文件；
+    # 当前分组及其剩余容量从本地分组索引中读取，无需请求服务器
+    # 按内容哈希跳过归档中已存在的视频，这些重复文件会随下载目录一起清空
+    video_files, duplicates = await filter_archived_duplicates(client, user_id, archive_folder_id, video_files)
+    if duplicates:
+        await notify(f"♻️ 跳过 {len(duplicates)} 个归档中已存在的重复视频。")
+
+    ids = [record["fid"] for record in video_files]
+    placements = {}
+    failures = failed_results(await archive_files_to_groups(client, user_id, archive_folder_id, ids, placements))
+    moved_ids = [fid for fid in ids if fid not in failures]
+    snapshot_remove(user_id, download_folder_id, moved_ids)
+    archived = [record for record in video_files if record["fid"] not in failures]
+    add_to_hash_index(user_id, archive_folder_id, archived, placements)
+    record_usage(user_id, bytes_archived=sum(int(record["fs"] or 0) for record in archived))
+    moved_total = len(moved_ids)
+
+    logging.info(f"已移动 {moved_total} 个视频文件到归档目录")
+    await notify(f"✅ 已移动 {moved_total} 个视频文件到归档目录。\n开始清空下载目录...")
+    if failures:
+        await notify(f"⚠️ {len(failures)} 个视频文件移动失败，已保留在下载目录中。")
+    if truncated:
+        await notify(f"⚠️ {len(truncated)} 个文件夹的子文件夹超过 {WALK_MAX_DEPTH} 层，未完整检查，已保留在下载目录中。")
+
+    # 清空下载目录（仅保留移动失败的文件）
+    try:
+        remaining_items = list(load_folder_snapshot(user_id, download_folder_id)["items"].values())
+        keep_ids = {*failures, *(owners[fid] for fid in failures if fid in owners), *truncated}
+        delete_ids, deleted_names = await delete_items(client, download_folder_id, remaining_items, exclude_ids=keep_ids)
+        snapshot_remove(user_id, download_folder_id, delete_ids)
+        mark_snapshot_processed(user_id, "cleanup", download_folder_id)
+        logging.info(f"已删除下载目录下 {len(delete_ids)} 个项目，名称: {', '.join(deleted_names[:10])}")
+        await notify(f"🗑️ 已清空下载目录，删除 {len(delete_ids)} 个项目。")
+    except Exception as e:
+        logging.error(f"清空下载目录失败: {e}")
+        await notify(f"⚠️ 清空下载目录失败: {e}")
+    return TASK_DONE
+
+# 新增函数：按分类结果执行移动、归档和删除
+async def execute_classified(client, user_id, folder_cid, archive_cid, classified):
+    """执行 classify_records 的结果，并同步更新文件夹快照，返回 [(说明, 数量)]"""
+    summary = []
+    for (action, target), records in classified.items():
+        ids = [record["fid"] for record in records]
+        if action == "keep":
+            summary.append(("保留", len(ids)))
+        elif action in ("archive", "move"):
+            if action == "archive":
+                results = await archive_files_to_groups(client, user_id, archive_cid, ids)
+                label = "归档"
+            else:
+                target_cid, _ = await find_or_create_folder_by_path(client, "0", target)
+                results = await move_files(client, ids, target_cid)
+                label = f"移动到 {target}"
+            failures = failed_results(results)
+            moved_ids = [fid for fid in ids if fid not in failures]
+            snapshot_remove(user_id, folder_cid, moved_ids)
+            moved_bytes = sum(int(record["fs"] or 0) for record in records if record["fid"] not in failures)
+            record_usage(user_id, **{"bytes_archived" if action == "archive" else "bytes_moved": moved_bytes})
+            summary.append((label, len(moved_ids)))
+            if failures:
+                summary.append((f"{label}失败", len(failures)))
+        elif action == "delete":
+            delete_ids, _ = await delete_items(client, folder_cid, records)
+            snapshot_remove(user_id, folder_cid, delete_ids)
+            summary.append(("删除", len(delete_ids)))
+    return summary
+
+async def handle_rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理 /rules 命令，列出用户定义的分类规则"""
+    logging.info("Executing: handle_rules")
+    user_id = str(update.effective_user.id)
+    rules = load_user_rules(user_id)
+    if not rules:
+        await update.message.reply_text(
+            "你还没有定义分类规则。\n\n"
+            "用法：/set_rule <名称> <规则>\n"
+            "示例：/set_rule movies type=video; min_size=1GB; action=move:/电影\n"
+            "条件：type=video|file|folder|any、min_size、max_size、ext=mkv,mp4、name=<正则>\n"
+            "动作：action=archive|delete|keep|move:<路径>"
+        )
+        return
+    response_text = "📐 分类规则（按顺序匹配，第一条命中的规则生效，未命中的项目保留）：\n\n"
+    response_text += "\n".join(f"{i}. {name}: {spec}" for i, (name, spec) in enumerate(rules, 1))
+    await send_long_message(update, context, response_text)
+
+async def handle_set_rule(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理 /set_rule 命令，添加或替换一条分类规则"""
+    logging.info("Executing: handle_set_rule")
+    user_id = str(update.effective_user.id)
+    if len(context.args) < 2 or not ACCOUNT_NAME_PATTERN.match(context.args[0]):
+        # 规则名称会作为 config.ini 的键保存，只允许字母、数字、下划线和短横线
+        await update.message.reply_text("用法：/set_rule <名称> <规则>，使用 /rules 查看规则语法。\n名称只能包含字母、数字、下划线或短横线。")
+        return
+    name = context.args[0].lower()
+    spec = " ".join(context.args[1:])
+    try:
+        rule = compile_rule(spec, name)
+        if rule["action"] == "move" and not rule["target"]:
+            raise ValueError("move 动作需要指定目标路径，例如 action=move:/电影")
+    except ValueError as e:
+        await update.message.reply_text(f"❌ 规则无效：{e}")
+        return
+    save_user_rule(user_id, name, spec)
+    await update.message.reply_text(f"✅ 已保存规则 {name}: {spec}")
+
+async def handle_del_rule(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logging.info("Executing: handle_del_rule")
+    user_id = str(update.effective_user.id)
+    if not context.args:
+        await update.message.reply_text("用法：/del_rule <名称>")
+        return
+    if delete_user_rule(user_id, context.args[0].lower()):
+        await update.message.reply_text(f"🗑️ 已删除规则 {context.args[0].lower()}。")
+    else:
+        await update.message.reply_text(f"❌ 规则 {context.args[0].lower()} 不存在。")
+
+async def handle_apply_rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    处理 /apply_rules 命令：同步一次下载文件夹快照，按用户规则一次遍历完成分类，
+    再分别移动、归档或删除，一次列表即可服务多个目标文件夹。
+    """
+    logging.info("Executing: handle_apply_rules")
+    user_id = str(update.effective_user.id)
+    try:
+        rules = compile_rules(load_user_rules(user_id))
+    except ValueError as e:
+        await update.message.reply_text(f"❌ 规则无效：{e}")
+        return
+    if not rules:
+        await update.message.reply_text("你还没有定义分类规则，请先通过 /set_rule 添加。")
+        return
+
+    download_folder_id, download_folder_path = load_user_download_folder(user_id)
+    archive_folder_id, archive_folder_path = load_user_archive_folder(user_id)
+    if not download_folder_id:
+        await update.message.reply_text("请先通过 /set_download_folder 设置下载文件夹。")
+        return
+    if not archive_folder_id and any(rule["action"] == "archive" for rule in rules):
         await update.message.reply_text("请先通过 /set_archive_folder 设置归档文件夹。")
         return
 
-    headers = {"Authorization": f"Bearer {access_token}"}
-    async with httpx.AsyncClient(headers=headers, timeout=30) as client:
+    access_token = await check_and_get_access_token(user_id, context)
+    if not access_token:
+        return
+
+    async with Api115Client(access_token, timeout=30, user_id=user_id) as client:
         try:
-            await update.message.reply_text("🔄 开始清理操作...")
-            await update.message.reply_text(f"📁 下载文件夹：{download_folder_path}")
-            await update.message.reply_text(f"📁 归档文件夹：{archive_folder_path}")
+            items, changed = await sync_folder_snapshot(client, user_id, download_folder_id)
+            classified = classify_records(rules, items.values())
+            summary = await execute_classified(client, user_id, download_folder_id, archive_folder_id, classified)
+            result_text = "✅ 规则执行完成：\n" + "\n".join(f"{label}: {count}" for label, count in summary)
+            await send_long_message(update, context, result_text)
+        except Exception as e:
+            logging.error(f"执行分类规则失败: {e}")
+            await update.message.reply_text(f"❌ 执行分类规则失败：{e}")
+
+# 新增函数：解析 cron 表达式
+def parse_cron(expr):
+    """解析 5 个字段的 cron 表达式，支持 *、a-b、/n 和逗号列表，返回各字段允许取值的集合"""
+    parts = expr.split()
+    if len(parts) != 5:
+        raise ValueError("cron 表达式需要 5 个字段：分 时 日 月 周")
+    fields = []
+    for part, (low, high) in zip(parts, CRON_FIELD_RANGES):
+        values = set()
+        for item in part.split(","):
+            value_range, _, step = item.partition("/")
+            try:
+                step = int(step) if step else 1
+                if value_range == "*":
+                    start, end = low, high
+                elif "-" in value_range:
+                    start, end = map(int, value_range.split("-", 1))
+                else:
+                    start = int(value_range)
+                    end = high if step > 1 else start
+            except ValueError:
+                raise ValueError(f"无效的 cron 字段: {part}")
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError(f"cron 字段超出范围: {part}")
+            values.update(range(start, end + 1, step))
+        fields.append(values)
+    # 周日可以写作 0 或 7
+    if 7 in fields[4]:
+        fields[4] = (fields[4] - {7}) | {0}
+    return fields
+
+def next_cron_time(fields, after):
+    """返回 after（时间戳）之后第一个符合 cron 字段的整分钟时间戳"""
+    minutes, hours, days, months, weekdays = fields
+    # 与标准 cron 相同：日和周都有限制时满足其一即可
+    restrict_both = len(days) < 31 and len(weekdays) < 7
+    t = datetime.fromtimestamp(after).replace(second=0, microsecond=0) + timedelta(minutes=1)
+    limit = t + timedelta(days=366 * 5)
+    while t < limit:
+        if t.month not in months:
+            t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            continue
+        day_match, weekday_match = t.day in days, (t.weekday() + 1) % 7 in weekdays
+        if not (day_match or weekday_match if restrict_both else day_match and weekday_match):
+            t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            continue
+        if t.hour not in hours:
+            t = t.replace(minute=0) + timedelta(hours=1)
+            continue
+        if t.minute not in minutes:
+            t += timedelta(minutes=1)
+            continue
+        return t.timestamp()
+    raise ValueError("cron 表达式在 5 年内不会触发")
+
+# 新增函数：用户定时任务
+def load_user_schedules(user_id):
+    """读取用户的定时任务，返回 {任务: cron 表达式}"""
+    config = read_config()
+    section = f"schedule_{user_id}"
+    if section not in config:
+        return {}
+    return {task: expr for task, expr in config[section].items() if task in SCHEDULED_TASKS}
 
-            # 获取下载文件夹下的视频文件（type=4 表示视频）
-            await update.message.reply_text("📋 正在获取视频文件列表...")
-            video_files = await list_files(client, download_folder_id, file_type=4)
+def save_user_schedule(user_id, task, expr):
+    """保存定时任务，expr 为 None 时删除"""
+    logging.info("Executing: save_user_schedule")
+    config = read_config()
+    section = f"schedule_{user_id}"
+    if section not in config:
+        config[section] = {}
+    if expr is None:
+        config.remove_option(section, task)
+    else:
+        config[section][task] = expr
+    write_config(config)
 
-            if not video_files:
-                await update.message.reply_text("✅ 下载文件夹没有视频文件需要移动。")
-                return
+def schedule_offset(user_id, task):
+    """固定错开时间（由用户 ID 和任务决定）加随机延迟"""
+    stagger = int(hashlib.md5(f"{user_id}:{task}".encode()).hexdigest(), 16) % (SCHEDULE_STAGGER + 1)
+    return stagger + random.uniform(0, SCHEDULE_JITTER)
+
+def schedule_user_task(job_queue, user_id, task):
+    """按用户的 cron 表达式安排下一次执行，并替换之前安排的同名任务；返回下一次触发的时间戳"""
+    name = f"schedule_{user_id}_{task}"
+    for job in job_queue.get_jobs_by_name(name):
+        job.schedule_removal()
+    expr = load_user_schedules(user_id).get(task)
+    if not expr:
+        return None
+    try:
+        next_time = next_cron_time(parse_cron(expr), time.time())
+    except ValueError as e:
+        logging.error(f"用户 {user_id} 的定时任务 {task} 无效（{expr}）: {e}")
+        return None
+    delay = next_time - time.time() + schedule_offset(user_id, task)
+    job_queue.run_once(run_scheduled_task, when=delay, name=name, data=(user_id, task))
+    return next_time
+
+def schedule_all_user_tasks(job_queue):
+    """启动时为当前 worker 负责的用户安排定时任务"""
+    count = 0
+    for user_id in list_owned_users():
+        for task in load_user_schedules(user_id):
+            if schedule_user_task(job_queue, user_id, task):
+                count += 1
+    logging.info(f"已安排 {count} 个定时任务")
+
+async def run_user_task(bot, user_id, task, skip_unchanged, title):
+    """在后台执行一次清理或整理，结果以 “title：结果” 的形式发送给用户"""
+    label, runner = SCHEDULED_TASKS[task]
+    access_token, err = await get_valid_access_token(user_id)
+    if err:
+        logging.warning(f"用户 {user_id} 的{label}无法执行: {err}")
+        return
+    messages = []
 
-            # 辅助函数：查找 archive 下最新的 group_xxx 文件夹，若无则创建 group_1
-            async def find_or_create_latest_group_folder(client, archive_cid):
-                folders, _ = await list_folders_only(client, archive_cid)
-                max_n = 0
-                max_folder = None
-                for f in folders:
-                    name = f.get("fn", "")
-                    # 支持 group_1, group_01, group_001 等格式，取出数字部分
-                    m = re.match(r"group_(0*)(\d+)$", name)
-                    if m:
-                        # 数字在第二个分组
-                        n = int(m.group(2))
-                        if n > max_n:
-                            max_n = n
-                            max_folder = f
-
-                if max_folder:
-                    return max_folder.get("fid"), max_folder.get("fn"), max_n
-
-                # 未找到，创建 group_001
-                folder_id, folder_name = await create_folder_with_name(client, archive_cid, "group_001")
-                return folder_id, folder_name, 1
-
-            # 找到或创建当前目标 group 文件夹
-            current_folder_id, current_folder_name, current_index = await find_or_create_latest_group_folder(client, archive_folder_id)
-
-            # 计算当前文件夹中的文件数量（仅统计文件，不包括子文件夹）
-            current_items = await list_all_items(client, current_folder_id)
-            current_count = sum(1 for it in current_items if str(it.get("fc")) == "1")
-
-            # 按需移动视频文件，确保每个 group_xxx 目录最多 200 个文件
-            remaining = [f for f in video_files if f.get("fid")]
-            moved_total = 0
-
-            while remaining:
-                space = 200 - current_count
-                if space <= 0:
-                    # 创建下一个 group
-                    current_index += 1
-                    new_name = f"group_{current_index:03d}"
-                    current_folder_id, created_name = await create_folder_with_name(client, archive_folder_id, new_name)
-                    current_count = 0
-                    space = 200
-
-                to_move = remaining[:space]
-                ids = [vf["fid"] for vf in to_move]
-                if ids:
-                    await move_files(client, ids, current_folder_id)
-                    moved_total += len(ids)
-                    current_count += len(ids)
-                remaining = remaining[len(ids):]
-
-            logging.info(f"已移动 {moved_total} 个视频文件到归档目录")
-            await update.message.reply_text(f"✅ 已移动 {moved_total} 个视频文件到归档目录。\n开始清空下载目录...")
-
-            # 清空下载目录（不排除任何文件/文件夹）
-            try:
-                delete_ids, deleted_names = await delete_files(client, download_folder_id, exclude_ids=set())
-                logging.info(f"已删除下载目录下 {len(delete_ids)} 个项目，名称: {', '.join(deleted_names[:10])}")
-                await update.message.reply_text(f"🗑️ 已清空下载目录，删除 {len(delete_ids)} 个项目。")
-            except Exception as e:
-                logging.error(f"清空下载目录失败: {e}")
-                await update.message.reply_text(f"⚠️ 清空下载目录失败: {e}")
+    async def notify(text):
+        messages.append(text)
+
+    async with Api115Client(access_token, timeout=30, user_id=user_id) as client:
+        outcome = await run_inflight(user_id, task, runner(client, user_id, notify, skip_unchanged=skip_unchanged),
+                                     resumable=True)
+    if outcome == TASK_UNCHANGED:
+        logging.info(f"用户 {user_id} 的下载文件夹没有变化，跳过{label}")
+        return
+    if outcome == TASK_NOT_CONFIGURED:
+        logging.warning(f"用户 {user_id} 的{label}缺少文件夹设置，无法执行")
+        title = f"⚠️ {label}无法执行"
+    if messages:
+        await bot.send_message(chat_id=user_id, text=f"{title}：\n" + "\n".join(messages))
+
+async def run_scheduled_task(context: ContextTypes.DEFAULT_TYPE):
+    """执行一次定时任务，快照没有变化时跳过；无论成功与否都安排下一次执行"""
+    user_id, task = context.job.data
+    label = SCHEDULED_TASKS[task][0]
+    logging.info(f"执行用户 {user_id} 的定时{label}")
+    try:
+        await run_user_task(context.bot, user_id, task, True, f"⏰ 定时{label}完成")
+    except ShutdownInterrupted:
+        logging.info(f"用户 {user_id} 的定时{label}因停机被中断，将在重启后继续")
+    except Exception:
+        logging.error(f"执行用户 {user_id} 的定时{label}时发生异常:\n{traceback.format_exc()}")
+    finally:
+        # 停机时不再安排，启动时会重新安排所有定时任务
+        if not shutting_down():
+            schedule_user_task(context.job_queue, user_id, task)
+
+async def run_interrupted_task(context: ContextTypes.DEFAULT_TYPE):
+    """重新执行上次因停机被中断的清理或整理（不跳过未变化的快照）"""
+    user_id, task = context.job.data
+    label = SCHEDULED_TASKS[task][0]
+    logging.info(f"继续执行用户 {user_id} 上次被中断的{label}")
+    try:
+        await run_user_task(context.bot, user_id, task, False, f"🔁 上次被中断的{label}已继续完成")
+    except ShutdownInterrupted:
+        logging.info(f"用户 {user_id} 的{label}再次因停机被中断，将在重启后继续")
+    except Exception:
+        logging.error(f"继续执行用户 {user_id} 的{label}时发生异常:\n{traceback.format_exc()}")
+        # 失败的操作不再自动重试，避免每次启动都重复失败
+        save_state(f"checkpoint_{user_id}_{task}", None)
+
+SCHEDULED_TASKS = {
+    "cleanup": ("清理", cleanup_download_folder),
+    "organize": ("整理", organize_download_folder),
+}
 
+async def handle_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    处理 /schedule 命令：
+      /schedule                          查看定时任务
+      /schedule cleanup 0 3 * * *        每天 3 点执行 /cleanup
+      /schedule organize off             取消定时整理
+    """
+    logging.info("Executing: handle_schedule")
+    user_id = str(update.effective_user.id)
+    args = context.args or []
+
+    if not args:
+        schedules = load_user_schedules(user_id)
+        if not schedules:
+            await update.message.reply_text(
+                "⏰ 还没有定时任务。\n\n用法：/schedule <cleanup|organize> <分 时 日 月 周>\n"
+                "例如 /schedule cleanup 0 3 * * * 每天 3 点清理；/schedule cleanup off 取消。"
+            )
+            return
+        result_text = "⏰ 定时任务：\n"
+        for task, expr in schedules.items():
+            jobs = context.job_queue.get_jobs_by_name(f"schedule_{user_id}_{task}")
+            next_run = jobs[0].next_t.astimezone().strftime('%Y-%m-%d %H:%M') if jobs and jobs[0].next_t else "未安排"
+            result_text += f"\n{SCHEDULED_TASKS[task][0]}（{task}）：{expr}\n  下次执行: {next_run}\n"
+        await update.message.reply_text(result_text)
+        return
+
+    task = args[0]
+    if task not in SCHEDULED_TASKS or len(args) < 2:
+        await update.message.reply_text("用法：/schedule <cleanup|organize> <分 时 日 月 周> 或 /schedule <cleanup|organize> off")
+        return
+
+    label = SCHEDULED_TASKS[task][0]
+    if args[1] == "off":
+        save_user_schedule(user_id, task, None)
+        schedule_user_task(context.job_queue, user_id, task)
+        await update.message.reply_text(f"✅ 已取消定时{label}。")
+        return
+
+    expr = " ".join(args[1:])
+    try:
+        next_time = next_cron_time(parse_cron(expr), time.time())
+    except ValueError as e:
+        await update.message.reply_text(f"❌ 无效的 cron 表达式：{e}")
+        return
+    save_user_schedule(user_id, task, expr)
+    schedule_user_task(context.job_queue, user_id, task)
+    await update.message.reply_text(
+        f"✅ 已设置定时{label}：{expr}\n下次执行约在 {time.strftime('%Y-%m-%d %H:%M', time.localtime(next_time))} 之后的几分钟内。"
+    )
+
+# 新增函数：归档分组索引
+def load_group_index(user_id, archive_cid):
+    """读取归档文件夹的分组索引：{"groups": {序号: {"fid", "name", "count"}}, "reconciled_at"}"""
+    index = load_state(f"group_index_{user_id}_{archive_cid}") or {"groups": {}, "reconciled_at": 0}
+    # JSON 的键只能是字符串，这里统一转换回整数序号
+    index["groups"] = {int(n): group for n, group in index["groups"].items()}
+    return index
+
+def save_group_index(user_id, archive_cid, index):
+    save_state(f"group_index_{user_id}_{archive_cid}", index)
+
+async def reconcile_group_index(client, user_id, archive_cid):
+    """列出归档文件夹下的 group_xxx 文件夹，与服务器校对分组索引，并统计最新分组中的文件数"""
+    logging.info("Executing: reconcile_group_index")
+    folders, _ = await list_folders_only(client, archive_cid)
+    old_groups = load_group_index(user_id, archive_cid)["groups"]
+    groups = {}
+    for f in folders:
+        # 支持 group_1, group_01, group_001 等格式，取出数字部分
+        m = re.match(r"group_(0*)(\d+)$", f.get("fn", ""))
+        if m:
+            n = int(m.group(2))
+            previous = old_groups.get(n, {})
+            count = previous.get("count") if previous.get("fid") == f.get("fid") else None
+            groups[n] = {"fid": f.get("fid"), "name": f.get("fn"), "count": count}
+
+    # 只有最新的分组会继续接收文件，因此只统计它的文件数（仅统计文件，不包括子文件夹）
+    if groups:
+        latest = groups[max(groups)]
+        _, latest["count"] = await list_folder_page(client, latest["fid"], 0, 1, show_dir=0)
+
+    index = {"groups": groups, "reconciled_at": int(time.time())}
+    save_group_index(user_id, archive_cid, index)
+    return index
+
+async def get_current_group(client, user_id, archive_cid):
+    """
+    返回最新的分组 (序号, fid, 文件数)。分组索引缺失或超过 GROUP_INDEX_RECONCILE_INTERVAL 未校对时
+    先与服务器校对；没有任何分组时创建 group_001。
+    """
+    index = load_group_index(user_id, archive_cid)
+    if not index["groups"] or int(time.time()) - index["reconciled_at"] > GROUP_INDEX_RECONCILE_INTERVAL:
+        index = await reconcile_group_index(client, user_id, archive_cid)
+
+    if not index["groups"]:
+        folder_id, folder_name = await create_folder_with_name(client, archive_cid, "group_001")
+        index["groups"][1] = {"fid": folder_id, "name": folder_name, "count": 0}
+        save_group_index(user_id, archive_cid, index)
+
+    n = max(index["groups"])
+    group = index["groups"][n]
+    if group["count"] is None:
+        _, group["count"] = await list_folder_page(client, group["fid"], 0, 1, show_dir=0)
+        save_group_index(user_id, archive_cid, index)
+    return n, group["fid"], group["count"]
+
+def record_group_files(user_id, archive_cid, n, count):
+    """我们自己向分组移入文件后，更新分组索引中的文件数"""
+    index = load_group_index(user_id, archive_cid)
+    if n in index["groups"] and index["groups"][n]["count"] is not None:
+        index["groups"][n]["count"] += count
+        save_group_index(user_id, archive_cid, index)
+
+async def create_next_group(client, user_id, archive_cid, n):
+    new_name = f"group_{n:03d}"
+    folder_id, folder_name = await create_folder_with_name(client, archive_cid, new_name)
+    index = load_group_index(user_id, archive_cid)
+    index["groups"][n] = {"fid": folder_id, "name": folder_name, "count": 0}
+    save_group_index(user_id, archive_cid, index)
+    return folder_id
+
+# 新增函数：将文件按每组最多 GROUP_CAPACITY 个移动到归档分组
+async def archive_files_to_groups(client, user_id, archive_cid, file_ids, placements=None):
+    """
+    依次填满最新分组、按需创建下一个分组，返回逐个 ID 的移动结果字典；
+    传入 placements 字典时记录移动成功的文件所在的分组 {fid: 分组 fid}
+    """
+    logging.info("Executing: archive_files_to_groups")
+    current_index, current_folder_id, current_count = await get_current_group(client, user_id, archive_cid)
+
+    remaining = [fid for fid in file_ids if fid]
+    results = {}
+    reconciled = False
+    while remaining:
+        space = GROUP_CAPACITY - current_count
+        if space <= 0:
+            # 创建下一个 group
+            current_index += 1
+            current_folder_id = await create_next_group(client, user_id, archive_cid, current_index)
+            current_count = 0
+            space = GROUP_CAPACITY
+
+        ids = remaining[:space]
+        chunk_results = await move_files(client, ids, current_folder_id)
+        failures = failed_results(chunk_results)
+        if len(failures) == len(ids) and not reconciled:
+            # 全部失败时分组可能已在外部被删除或改名，与服务器校对一次后重试
+            logging.warning(f"移动到分组 {current_index} 全部失败，重新校对分组索引")
+            await reconcile_group_index(client, user_id, archive_cid)
+            current_index, current_folder_id, current_count = await get_current_group(client, user_id, archive_cid)
+            reconciled = True
+            continue
+        results.update(chunk_results)
+        if placements is not None:
+            placements.update((fid, current_folder_id) for fid in ids if fid not in failures)
+        moved = len(ids) - len(failures)
+        record_group_files(user_id, archive_cid, current_index, moved)
+        current_count += moved
+        remaining = remaining[len(ids):]
+
+    return results
+
+# 新增函数：归档内容哈希索引
+def file_hash_key(record):
+    """以 sha1 + 文件大小作为内容标识，没有 sha1 的记录返回 None"""
+    if not record.get("sha1"):
+        return None
+    return f"{record['sha1'].upper()}:{record['fs']}"
+
+def load_hash_index(user_id, archive_cid):
+    """读取归档内容哈希索引：{"hashes": {内容标识: {"fid", "fn", "pid"}}, "built_at"}"""
+    return load_state(f"hash_index_{user_id}_{archive_cid}") or {"hashes": {}, "built_at": 0}
+
+def save_hash_index(user_id, archive_cid, index):
+    save_state(f"hash_index_{user_id}_{archive_cid}", index)
+
+async def build_hash_index(client, user_id, archive_cid):
+    """
+    遍历全部归档分组重建内容哈希索引，一次遍历即可找出重复文件。
+    同一内容出现多次时保留序号最小的分组中的文件，返回 [(保留的文件, 重复的文件记录)]。
+    """
+    logging.info("Executing: build_hash_index")
+    groups = (await reconcile_group_index(client, user_id, archive_cid))["groups"]
+    roots = [(groups[n]["fid"], groups[n]["name"]) for n in sorted(groups)]
+    order = {fid: i for i, (fid, _) in enumerate(roots)}
+
+    hashes = {}
+    duplicates = {}
+    async for root, path, record in walk_folders(client, roots, max_depth=1):
+        key = file_hash_key(record)
+        if record["fc"] != "1" or not key:
+            continue
+        entry = {"fid": record["fid"], "fn": record["fn"], "pid": record["pid"], "order": order[root]}
+        kept = hashes.get(key)
+        if kept is None:
+            hashes[key] = entry
+            continue
+        # 遍历是并发的，这里保证保留的总是序号较小分组中的文件
+        if (entry["order"], entry["fn"]) < (kept["order"], kept["fn"]):
+            hashes[key], entry = entry, kept
+        duplicates.setdefault(key, []).append(entry)
+
+    index = {"hashes": hashes, "built_at": int(time.time())}
+    save_hash_index(user_id, archive_cid, index)
+    duplicate_pairs = [(hashes[key], entry) for key, entries in duplicates.items() for entry in entries]
+    logging.info(f"归档内容哈希索引重建完成：{len(hashes)} 个文件，{len(duplicate_pairs)} 个重复")
+    return duplicate_pairs
+
+async def list_archived_files(client, user_id, archive_cid, entries):
+    """
+    列出哈希索引条目所在的归档分组（每个分组只列一次，并发数受 WALK_CONCURRENCY 限制），
+    返回仍在这些分组中的文件 ID；所在分组未知或已不属于归档文件夹的条目不会被确认
+    """
+    groups = {group["fid"] for group in load_group_index(user_id, archive_cid)["groups"].values()}
+    roots = sorted({entry["pid"] for entry in entries if entry.get("pid") in groups})
+    present = set()
+    if roots:
+        async for root, path, record in walk_folders(client, [(pid, "") for pid in roots], max_depth=1):
+            present.add(record["fid"])
+    return present
+
+async def filter_archived_duplicates(client, user_id, archive_cid, records):
+    """
+    从待归档的记录中剔除归档中已存在（或本批次中重复）的文件，返回 (需要归档的记录, 重复的记录)。
+    跳过的文件会随下载目录一起被删除，因此先列出归档分组，确认归档中的那份仍在分组中
+    （已被删除、进入回收站或移出归档的文件不算）。
+    """
+    index = load_hash_index(user_id, archive_cid)
+    if int(time.time()) - index["built_at"] > HASH_INDEX_REBUILD_INTERVAL:
+        await build_hash_index(client, user_id, archive_cid)
+        index = load_hash_index(user_id, archive_cid)
+
+    candidates = {}
+    for record in records:
+        key = file_hash_key(record)
+        if key and key in index["hashes"]:
+            candidates[key] = index["hashes"][key]
+    present = await list_archived_files(client, user_id, archive_cid, candidates.values()) if candidates else set()
+    verified = {key for key, entry in candidates.items() if entry["fid"] in present}
+    stale = candidates.keys() - verified
+    if stale:
+        # 归档中的文件已不在原分组中，索引过期
+        for key in stale:
+            index["hashes"].pop(key, None)
+        save_hash_index(user_id, archive_cid, index)
+
+    unique, duplicates, seen = [], [], set()
+    for record in records:
+        key = file_hash_key(record)
+        if key and (key in seen or key in verified):
+            duplicates.append(record)
+            continue
+        if key:
+            seen.add(key)
+        unique.append(record)
+    return unique, duplicates
+
+def add_to_hash_index(user_id, archive_cid, records, placements=None):
+    """归档文件后，将其内容标识和所在分组（placements: {fid: 分组 fid}）加入哈希索引"""
+    index = load_hash_index(user_id, archive_cid)
+    placements = placements or {}
+    for record in records:
+        key = file_hash_key(record)
+        if key and key not in index["hashes"]:
+            index["hashes"][key] = {"fid": record["fid"], "fn": record["fn"], "pid": placements.get(record["fid"]), "order": None}
+    save_hash_index(user_id, archive_cid, index)
+
+async def handle_dedup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理 /dedup 命令：重建归档内容哈希索引并报告重复文件，/dedup delete 删除重复的副本"""
+    logging.info("Executing: handle_dedup")
+    user_id = str(update.effective_user.id)
+    archive_folder_id, archive_folder_path = load_user_archive_folder(user_id)
+    if not archive_folder_id:
+        await update.message.reply_text("请先通过 /set_archive_folder 设置归档文件夹。")
+        return
+    access_token = await check_and_get_access_token(user_id, context)
+    if not access_token:
+        return
+
+    delete = bool(context.args) and context.args[0] == "delete"
+    async with Api115Client(access_token, timeout=30, user_id=user_id) as client:
+        try:
+            await update.message.reply_text("🔍 正在扫描归档分组...")
+            duplicates = await build_hash_index(client, user_id, archive_folder_id)
+            if not duplicates:
+                await update.message.reply_text("✅ 归档中没有重复的文件。")
+                return
+
+            result_text = f"♻️ 归档中共有 {len(duplicates)} 个重复文件：\n"
+            result_text += "\n".join(f"{dup['fn']}（与 {kept['fn']} 相同）" for kept, dup in duplicates[:50])
+            if len(duplicates) > 50:
+                result_text += f"\n... 还有 {len(duplicates) - 50} 个"
+
+            if delete:
+                by_parent = {}
+                for kept, dup in duplicates:
+                    by_parent.setdefault(dup["pid"], []).append(dup)
+                deleted = 0
+                for parent_id, records in by_parent.items():
+                    delete_ids, _ = await delete_items(client, parent_id, records)
+                    deleted += len(delete_ids)
+                # 分组中的文件数发生变化，下次归档前重新校对分组索引
+                index = load_group_index(user_id, archive_folder_id)
+                index["reconciled_at"] = 0
+                save_group_index(user_id, archive_folder_id, index)
+                result_text += f"\n\n🗑️ 已删除 {deleted} 个重复文件。"
+            else:
+                result_text += "\n\n使用 /dedup delete 删除重复的副本（保留序号最小分组中的文件）。"
+            await send_long_message(update, context, result_text)
         except Exception as e:
-            logging.error(f"清理操作失败: {e}")
-            await update.message.reply_text(f"❌ 清理操作失败：{e}")
+            logging.error(f"归档去重失败: {e}")
+            await update.message.reply_text(f"❌ 归档去重失败：{e}")
+
+# 云下载任务状态
+TASK_STATUS_DESC = {
+    -1: "❌ 下载失败",
+    0: "⏳ 分配中",
+    1: "⬇️ 下载中",
+    2: "✅ 已完成"
+}
+
+def to_task_record(task):
+    """将任务列表接口返回的任务整理为统一的记录，数值字段转换为整数"""
+    def to_int(value, default=0):
+        try:
+            return int(value)
+        except (ValueError, TypeError):
+            return default
+    return {
+        "info_hash": task.get("info_hash", ""),
+        "name": task.get("name") or "未知任务",
+        "url": task.get("url", ""),
+        "status": to_int(task.get("status"), -1),
+        "percent": to_int(task.get("percentDone")),
+        "size": to_int(task.get("size")),
+        "add_time": to_int(task.get("add_time")),
+    }
+
+def format_size(size):
+    if size >= 1024 ** 3:
+        return f"{size / 1024 ** 3:.1f} GB"
+    return f"{size / 1024 ** 2:.1f} MB"
 
 # 新增函数：获取云下载任务列表
 async def get_task_list(client, page=1):
@@ -1054,143 +3594,609 @@ async def get_incomplete_tasks(client):
 
     return incomplete_tasks
 
+# 任务面板：/task_status 显示分页的未完成任务，可按状态筛选、按进度或大小排序。
+# 任务列表缓存在 _TASK_SNAPSHOTS 中，筛选、排序和翻页直接使用缓存，只有点击刷新或缓存超过 TASK_SNAPSHOT_TTL 秒时才重新获取；
+# 每个账号只缓存最近渲染的一页（按该页任务的签名），刷新后内容没有变化时不重新渲染
+TASK_PAGE_SIZE = 10
+TASK_SNAPSHOT_TTL = 30
+TASK_FILTERS = {"all": ("全部", None), "failed": ("失败", -1), "downloading": ("下载中", 1), "allocating": ("分配中", 0)}
+TASK_SORTS = {"time": "时间", "progress": "进度", "size": "大小"}
+_TASK_SNAPSHOTS = {}       # (user_id, account) -> {"tasks": [任务记录], "fetched_at": 时间戳}
+_TASK_PAGE_RENDERS = {}    # (user_id, account) -> ((筛选, 排序, 页码), 签名, 文本, 键盘)
+
+async def load_task_snapshot(user_id, context, force=False):
+    """返回 (账号, 任务快照)；缓存不存在、过期或 force=True 时重新获取未完成任务"""
+    account = load_active_account(user_id)
+    key = (user_id, account)
+    snapshot = _TASK_SNAPSHOTS.get(key)
+    if snapshot and not force and time.time() - snapshot["fetched_at"] < TASK_SNAPSHOT_TTL:
+        return account, snapshot
+
+    access_token = await check_and_get_access_token(user_id, context)
+    if not access_token:
+        return account, None
+    async with Api115Client(access_token, timeout=30, user_id=user_id) as client:
+        tasks = await get_incomplete_tasks(client)
+    snapshot = _TASK_SNAPSHOTS[key] = {"tasks": [to_task_record(task) for task in tasks], "fetched_at": time.time()}
+    logging.info(f"获取到 {len(tasks)} 个未完成任务")
+    return account, snapshot
+
+def render_task_page(user_id, account, snapshot, task_filter, sort, page):
+    """
+    渲染任务面板的一页，返回 (文本, 键盘)；该页内容没有变化时直接使用缓存的结果，
+    只重新生成末尾的更新时间
+    """
+    status = TASK_FILTERS[task_filter][1]
+    tasks = [task for task in snapshot["tasks"] if status is None or task["status"] == status]
+    if sort == "progress":
+        tasks.sort(key=lambda task: task["percent"], reverse=True)
+    elif sort == "size":
+        tasks.sort(key=lambda task: task["size"], reverse=True)
+    page_count = max(1, -(-len(tasks) // TASK_PAGE_SIZE))
+    page = min(page, page_count - 1)
+    page_tasks = tasks[page * TASK_PAGE_SIZE:(page + 1) * TASK_PAGE_SIZE]
+    counts = collections.Counter(task["status"] for task in snapshot["tasks"])
+
+    signature = (page, page_count, tuple(sorted(counts.items())),
+                 tuple((task["info_hash"], task["status"], task["percent"], task["size"]) for task in page_tasks))
+    footer = f"🕒 更新于 {time.strftime('%H:%M:%S', time.localtime(snapshot['fetched_at']))}"
+    cached = _TASK_PAGE_RENDERS.get((user_id, account))
+    if cached and cached[:2] == ((task_filter, sort, page), signature):
+        return cached[2] + footer, cached[3]
+
+    if not snapshot["tasks"]:
+        text = "✅ 当前没有未完成的云下载任务！"
+    else:
+        text = f"📋 未完成的云下载任务 · {TASK_FILTERS[task_filter][0]} {len(tasks)} 个 · 按{TASK_SORTS[sort]}排序\n"
+        text += f"第 {page + 1}/{page_count} 页\n\n"
+        for i, task in enumerate(page_tasks, page * TASK_PAGE_SIZE + 1):
+            name = task["name"] if len(task["name"]) <= 60 else task["name"][:57] + "..."
+            size_info = f" ({format_size(task['size'])})" if task["size"] > 0 else ""
+            progress_bar = "█" * (task["percent"] // 10) + "░" * (10 - task["percent"] // 10)
+            text += f"{i}. {TASK_STATUS_DESC.get(task['status'], '❓ 未知状态')}\n"
+            text += f"📁 {name}{size_info}\n"
+            text += f"📊 进度: {task['percent']}% [{progress_bar}]\n\n"
+        if not page_tasks:
+            text += "没有符合条件的任务。\n\n"
+
+    def button(label, f=task_filter, s=sort, p=page, op="v"):
+        return InlineKeyboardButton(label, callback_data=f"ts:{op}:{f}:{s}:{p}")
+
+    keyboard = [
+        [button(("✓" if f == task_filter else "") + name + (f" {counts[st]}" if st is not None else ""), f=f, p=0)
+         for f, (name, st) in TASK_FILTERS.items()],
+        [button(("✓" if s == sort else "") + name, s=s, p=0) for s, name in TASK_SORTS.items()],
+    ]
+    nav_buttons = []
+    if page > 0:
+        nav_buttons.append(button("⬅️ 上一页", p=page - 1))
+    if page + 1 < page_count:
+        nav_buttons.append(button("➡️ 下一页", p=page + 1))
+    if nav_buttons:
+        keyboard.append(nav_buttons)
+    keyboard.append([button("🔄 刷新", op="r")])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    _TASK_PAGE_RENDERS[(user_id, account)] = ((task_filter, sort, page), signature, text, reply_markup)
+    return text + footer, reply_markup
+
 # 新增函数：处理获取任务状态命令
 async def handle_task_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """处理 /task_status 命令，显示未完成的云下载任务"""
+    """处理 /task_status 命令，显示未完成云下载任务的面板"""
     logging.info("Executing: handle_task_status")
     user_id = str(update.effective_user.id)
+    try:
+        account, snapshot = await load_task_snapshot(user_id, context, force=True)
+        if snapshot is None:
+            return
+        text, reply_markup = render_task_page(user_id, account, snapshot, "all", "time", 0)
+        await update.message.reply_text(text, reply_markup=reply_markup)
+    except Exception as e:
+        logging.error(f"获取任务状态失败: {e}")
+        await update.message.reply_text(f"❌ 获取任务状态失败：{e}")
+
+async def handle_task_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理任务面板的筛选、排序、翻页和刷新按钮，在原消息上更新"""
+    query = update.callback_query
+    user_id = str(update.effective_user.id)
+    parts = query.data.split(':')
+    if len(parts) != 5 or parts[2] not in TASK_FILTERS or parts[3] not in TASK_SORTS:
+        await query.answer("❌ 无效的操作")
+        return
+    _, op, task_filter, sort, page = parts
+
+    try:
+        account, snapshot = await load_task_snapshot(user_id, context, force=op == "r")
+        if snapshot is None:
+            await query.answer()
+            return
+        text, reply_markup = render_task_page(user_id, account, snapshot, task_filter, sort, int(page))
+        if text == query.message.text:
+            await query.answer("没有变化" if op == "r" else None)
+            return
+        await query.answer("✅ 已刷新" if op == "r" else None)
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    except BadRequest as e:
+        # 刷新后内容没有变化
+        if "not modified" not in str(e):
+            raise
+    except Exception as e:
+        logging.error(f"更新任务面板失败: {e}")
+        await query.answer(f"❌ 获取任务状态失败：{e}", show_alert=True)
+
+# 新增函数：获取全部云下载任务
+async def get_all_tasks(client):
+    """获取全部云下载任务（包括已完成和失败的），第一页之后的页面最多 BULK_CONCURRENCY 个并发获取"""
+    data = await get_task_list(client, 1)
+    tasks = list(data.get("tasks", []))
+    page_count = int(data.get("page_count", 1) or 1)
+    semaphore = asyncio.Semaphore(BULK_CONCURRENCY)
+
+    async def fetch(page):
+        async with semaphore:
+            return (await get_task_list(client, page)).get("tasks", [])
+
+    for page_tasks in await asyncio.gather(*(fetch(page) for page in range(2, page_count + 1))):
+        tasks.extend(page_tasks)
+    return tasks
+
+# 新增函数：批量删除云下载任务
+async def delete_offline_tasks(client, info_hashes, del_source_file=0):
+    """逐个删除云下载任务，最多 BULK_CONCURRENCY 个请求并发；返回 {info_hash: None（成功）或错误信息}"""
+    url = "https://proapi.115.com/open/offline/del_task"
+    semaphore = asyncio.Semaphore(BULK_CONCURRENCY)
+
+    async def delete(info_hash):
+        async with semaphore:
+            try:
+                response = await client.post(url, data={"info_hash": info_hash, "del_source_file": del_source_file})
+                res = response.json()
+            except Exception as e:
+                return f"请求异常: {e!r}"
+        if res.get("state"):
+            return None
+        return res.get("message") or res.get("error") or str(res)
+
+    unique_hashes = list(dict.fromkeys(h for h in info_hashes if h))
+    results = dict(zip(unique_hashes, await asyncio.gather(*(delete(h) for h in unique_hashes))))
+    for info_hash, error in failed_results(results).items():
+        logging.warning(f"删除云下载任务失败 {info_hash}: {error}")
+    return results
+
+def invalidate_task_snapshot(user_id):
+    """任务列表被修改后丢弃任务面板的缓存"""
+    for key in [key for key in _TASK_SNAPSHOTS if key[0] == user_id]:
+        _TASK_SNAPSHOTS.pop(key, None)
+
+async def handle_retry_failed(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理 /retry_failed 命令：删除下载失败的任务后重新提交它们的链接"""
+    logging.info("Executing: handle_retry_failed")
+    user_id = str(update.effective_user.id)
     access_token = await check_and_get_access_token(user_id, context)
     if not access_token:
         return
+    # 删除任务之前先确认有可用于重新提交的账号（已设置下载文件夹且 token 有效）
+    account = await select_account_for_submission(user_id)
+    if not account:
+        await update.message.reply_text("请先通过 /set_download_folder 设置下载文件夹。")
+        return
+    _, err = await get_valid_access_token(user_id, account)
+    if err:
+        await update.message.reply_text(f"❌ {err}")
+        return
 
-    headers = {"Authorization": f"Bearer {access_token}"}
-    async with httpx.AsyncClient(headers=headers, timeout=30) as client:
-        try:
-            await update.message.reply_text("🔄 正在获取云下载任务状态...")
-
-            # 获取所有未完成任务
-            incomplete_tasks = await get_incomplete_tasks(client)
+    try:
+        await update.message.reply_text("🔄 正在查找下载失败的任务...")
+        async with Api115Client(access_token, timeout=30, user_id=user_id) as client:
+            tasks = [to_task_record(task) for task in await get_all_tasks(client)]
+            failed = {task["info_hash"]: task["url"] for task in tasks if task["status"] == -1 and task["url"] and task["info_hash"]}
+            if not failed:
+                await update.message.reply_text("✅ 没有下载失败的任务。")
+                return
+            # 先删除失败的任务，否则 115 会认为重新提交的链接是重复任务；删除失败的不重新提交
+            results = await delete_offline_tasks(client, list(failed))
+        invalidate_task_snapshot(user_id)
+
+        links = [failed[info_hash] for info_hash, error in results.items() if error is None]
+        result_text = f"🔁 找到 {len(failed)} 个下载失败的任务，重新提交 {len(links)} 个。\n"
+        if len(links) < len(failed):
+            result_text += f"⚠️ {len(failed) - len(links)} 个任务删除失败，未重新提交。\n"
+        if links:
+            try:
+                result = await submit_links(user_id, links)
+            except Exception as e:
+                # 失败的任务已被删除，链接必须保留下来
+                enqueue_pending_links(user_id, links, f"重新提交时发生异常: {e}")
+                raise
+            # 没有被服务器处理的链接（包括整体失败时的全部链接）都加入待提交队列
+            unsent = set(result["unsent"])
+            result["failed"] = [(url, message) for url, message in result["failed"] if url not in unsent]
+            processed = set(result["succeeded"]) | {url for url, _ in result["failed"]}
+            result["deferred"] = [url for url in links if url not in processed]
+            if result["deferred"]:
+                enqueue_pending_links(user_id, result["deferred"], result["error"])
+            result_text += "\n" + format_submit_result(result, show_account=len(list_user_accounts(user_id)) > 1)
+        await send_long_message(update, context, result_text)
+    except Exception as e:
+        logging.error(f"重新提交失败任务时发生异常:\n{traceback.format_exc()}")
+        await update.message.reply_text(f"❌ 重新提交失败任务失败：{e}")
 
-            logging.info(f"获取到 {len(incomplete_tasks)} 个未完成任务")
+async def handle_clear_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理 /clear_tasks [failed|completed] 命令：从任务列表中删除失败和/或已完成的任务（不删除已下载的文件）"""
+    logging.info("Executing: handle_clear_tasks")
+    user_id = str(update.effective_user.id)
+    scopes = {"failed": {-1}, "completed": {2}}
+    statuses = scopes.get(context.args[0], None) if context.args else {-1, 2}
+    if statuses is None:
+        await update.message.reply_text("用法：/clear_tasks [failed|completed]，不带参数时清除失败和已完成的任务。")
+        return
+    access_token = await check_and_get_access_token(user_id, context)
+    if not access_token:
+        return
 
-            if not incomplete_tasks:
-                await update.message.reply_text("✅ 当前没有未完成的云下载任务！")
+    try:
+        async with Api115Client(access_token, timeout=30, user_id=user_id) as client:
+            tasks = [to_task_record(task) for task in await get_all_tasks(client)]
+            info_hashes = [task["info_hash"] for task in tasks if task["status"] in statuses]
+            if not info_hashes:
+                await update.message.reply_text("✅ 没有需要清除的任务。")
                 return
+            await update.message.reply_text(f"🧹 正在清除 {len(info_hashes)} 个任务...")
+            results = await delete_offline_tasks(client, info_hashes)
+        invalidate_task_snapshot(user_id)
+
+        failed = failed_results(results)
+        result_text = f"🧹 已清除 {len(results) - len(failed)} 个任务。"
+        if failed:
+            result_text += f"\n⚠️ {len(failed)} 个任务清除失败，可稍后重试。"
+        await update.message.reply_text(result_text)
+    except Exception as e:
+        logging.error(f"清除任务时发生异常:\n{traceback.format_exc()}")
+        await update.message.reply_text(f"❌ 清除任务失败：{e}")
+
+# 新增函数：管理员命令
+def is_admin(user_id):
+    return str(user_id) in ADMIN_USER_IDS
+
+def format_usage(usage):
+    return (f"🔗 {USAGE_FIELDS['links']}: {usage['links']}　📡 {USAGE_FIELDS['api_calls']}: {usage['api_calls']}\n"
+            f"📦 {USAGE_FIELDS['bytes_moved']}: {format_size(usage['bytes_moved'])}　🗄️ {USAGE_FIELDS['bytes_archived']}: {format_size(usage['bytes_archived'])}")
+
+async def handle_usage(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理 /usage [user_id] 命令（仅管理员）：显示全部用户的汇总用量，或指定用户的用量"""
+    logging.info("Executing: handle_usage")
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ 只有管理员可以使用此命令。")
+        return
 
-            # 构建任务状态消息
-            result_text = f"📋 未完成的云下载任务 ({len(incomplete_tasks)} 个):\n\n"
-
-            for i, task in enumerate(incomplete_tasks, 1):
-                # 添加调试信息
-                logging.info(f"处理任务 {i}: {task}")
-
-                task_name = task.get("name", "未知任务")
-
-                # 安全地转换百分比
-                try:
-                    percent_done = int(task.get("percentDone", 0))
-                except (ValueError, TypeError):
-                    percent_done = 0
-
-                # 安全地转换状态
-                try:
-                    status = int(task.get("status", -1))
-                except (ValueError, TypeError):
-                    status = -1
-
-                size_raw = task.get("size", 0)
-
-                # 安全地转换文件大小为数字
-                try:
-                    size = int(size_raw) if size_raw else 0
-                except (ValueError, TypeError):
-                    logging.warning(f"文件大小转换失败: {size_raw} (类型: {type(size_raw)})")
-                    size = 0
-
-                # 状态描述
-                status_desc = {
-                    -1: "❌ 下载失败",
-                    0: "⏳ 分配中",
-                    1: "⬇️ 下载中"
-                }.get(status, "❓ 未知状态")
-
-                # 文件大小格式化
-                if size > 0:
-                    size_gb = size / (1024 * 1024 * 1024)
-                    if size_gb >= 1:
-                        size_info = f" ({size_gb:.1f} GB)"
-                    else:
-                        size_mb = size / (1024 * 1024)
-                        size_info = f" ({size_mb:.1f} MB)"
-                else:
-                    size_info = ""
+    if context.args:
+        user_id = context.args[0]
+        await update.message.reply_text(f"📈 用户 {user_id} 的用量：\n{format_usage(load_usage(user_id))}")
+        return
 
-                # 进度条
-                progress_bar = "█" * (percent_done // 10) + "░" * (10 - percent_done // 10)
+    usages = {user_id: load_usage(user_id) for user_id in list_known_users()}
+    total = collections.Counter()
+    for usage in usages.values():
+        total.update(usage)
+    result_text = f"📈 全部 {len(usages)} 个用户的用量：\n{format_usage(total)}\n\n提交链接最多的用户：\n"
+    active_users = [item for item in usages.items() if any(item[1].values())]
+    top_users = sorted(active_users, key=lambda item: (item[1]["links"], item[1]["api_calls"]), reverse=True)[:10]
+    for user_id, usage in top_users:
+        result_text += f"\n👤 {user_id}\n{format_usage(usage)}\n"
+    result_text += "\n使用 /usage <用户ID> 查看单个用户。"
+    await send_long_message(update, context, result_text)
+
+async def broadcast_message(bot, admin_id, text):
+    """按 BROADCAST_RATE 限速向所有已知用户发送消息，完成后把结果发给管理员"""
+    user_ids = list_known_users()
+    sent, blocked, failed = 0, 0, 0
+    for user_id in user_ids:
+        for attempt in range(2):
+            try:
+                await bot.send_message(chat_id=user_id, text=text)
+                sent += 1
+            except RetryAfter as e:
+                # 触发限流时按 Telegram 要求的时间等待后重试一次
+                await asyncio.sleep(e.retry_after)
+                if attempt == 0:
+                    continue
+                failed += 1
+            except Forbidden:
+                blocked += 1
+            except Exception as e:
+                logging.warning(f"向用户 {user_id} 广播失败: {e!r}")
+                failed += 1
+            break
+        await asyncio.sleep(1 / BROADCAST_RATE)
+    await bot.send_message(chat_id=admin_id, text=f"📣 广播完成：成功 {sent}，已屏蔽机器人 {blocked}，失败 {failed}（共 {len(user_ids)} 个用户）。")
+
+async def handle_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理 /broadcast <消息> 命令（仅管理员）：在后台向所有已知用户发送消息"""
+    logging.info("Executing: handle_broadcast")
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ 只有管理员可以使用此命令。")
+        return
+    # 命令与消息之间可能是空格也可能是换行，保留消息内部的换行
+    parts = update.message.text.split(None, 1)
+    text = parts[1].strip() if len(parts) > 1 else ""
+    if not text:
+        await update.message.reply_text("用法：/broadcast <消息内容>")
+        return
+    count = len(list_known_users())
+    context.application.create_task(run_inflight(update.effective_user.id, "broadcast",
+                                                 broadcast_message(context.bot, update.effective_user.id, text)))
+    await update.message.reply_text(f"📣 正在向 {count} 个用户广播，预计需要 {count / BROADCAST_RATE:.0f} 秒。")
 
-                result_text += f"{i}. {status_desc}\n"
-                result_text += f"📁 {task_name}{size_info}\n"
-                result_text += f"📊 进度: {percent_done}% [{progress_bar}]\n\n"
+# 新增函数：内联搜索索引
+def load_search_index(user_id):
+    return load_state(f"search_index_{user_id}")
 
-                # 避免消息过长，最多显示20个任务
-                if i >= 20:
-                    result_text += f"... 还有 {len(incomplete_tasks) - 20} 个任务\n"
-                    break
+def save_search_index(user_id, index):
+    save_state(f"search_index_{user_id}", index)
 
-            await send_long_message(update, context, result_text)
+_SEARCH_INDEX_BUILDING = set()
 
-        except Exception as e:
-            logging.error(f"获取任务状态失败: {e}")
-            await update.message.reply_text(f"❌ 获取任务状态失败：{e}")
+async def refresh_search_index(user_id, folders=False):
+    """刷新用户的搜索索引：总是刷新最近的任务，folders=True 或索引不存在时重建文件夹索引"""
+    if user_id in _SEARCH_INDEX_BUILDING:
+        return
+    _SEARCH_INDEX_BUILDING.add(user_id)
+    try:
+        account = load_active_account(user_id)
+        access_token, err = await get_valid_access_token(user_id, account)
+        if err:
+            logging.warning(f"刷新用户 {user_id} 的搜索索引失败: {err}")
+            return
+        now = time.time()
+        index = load_search_index(user_id) or {}
+        if index.get("account") != account:
+            index.update(account=account, folders=None)
+        async with Api115Client(access_token, timeout=30, user_id=user_id) as client:
+            data = await get_task_list(client, 1)
+            index["tasks"] = [to_task_record(task) for task in data.get("tasks", [])]
+            index["tasks_at"] = now
+            if folders or index.get("folders") is None:
+                entries = []
+                async with contextlib.aclosing(walk_folders(client, [("0", "")], max_depth=SEARCH_INDEX_DEPTH)) as walker:
+                    async for _, path, record in walker:
+                        if record["fc"] == "0":
+                            entries.append({"fid": record["fid"], "name": record["fn"], "path": f"{path}/{record['fn']}"})
+                            if len(entries) >= SEARCH_INDEX_MAX_FOLDERS:
+                                break
+                index["folders"] = entries
+                index["folders_at"] = now
+        save_search_index(user_id, index)
+        logging.info(f"用户 {user_id} 的搜索索引已刷新：{len(index['folders'])} 个文件夹，{len(index['tasks'])} 个任务")
+    finally:
+        _SEARCH_INDEX_BUILDING.discard(user_id)
+
+async def refresh_search_index_job(context: ContextTypes.DEFAULT_TYPE):
+    """后台定期刷新近期使用过内联搜索的用户的索引"""
+    now = time.time()
+    for user_id in list_owned_users():
+        if shutting_down():
+            break
+        index = load_search_index(user_id)
+        if not index or now - load_state(f"search_used_{user_id}", 0) > SEARCH_INDEX_IDLE:
+            continue
+        try:
+            await run_inflight(user_id, "search_index",
+                               refresh_search_index(user_id, folders=now - index.get("folders_at", 0) > SEARCH_FOLDERS_REFRESH_INTERVAL))
+        except ShutdownInterrupted:
+            break
+        except Exception:
+            logging.error(f"刷新用户 {user_id} 的搜索索引时发生异常:\n{traceback.format_exc()}")
+
+def search_index(index, query):
+    """在索引中查找所有关键词都出现在名称中的文件夹和任务；没有关键词时只返回最近的任务"""
+    terms = query.lower().split()
+    results = []
+    if terms:
+        folders = [f for f in index.get("folders") or [] if all(term in f["name"].lower() for term in terms)]
+        # 名称以第一个关键词开头的排在前面，其次是路径较短的
+        folders.sort(key=lambda f: (not f["name"].lower().startswith(terms[0]), len(f["path"])))
+        results.extend(("folder", f) for f in folders[:SEARCH_MAX_RESULTS])
+    tasks = [t for t in index.get("tasks") or [] if all(term in t["name"].lower() for term in terms)]
+    results.extend(("task", t) for t in tasks)
+    return results[:SEARCH_MAX_RESULTS]
+
+async def handle_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理内联查询：只读取本地索引，索引不存在时在后台建立"""
+    query = update.inline_query
+    user_id = str(update.effective_user.id)
+    now = time.time()
+    if now - load_state(f"search_used_{user_id}", 0) > SEARCH_USED_RESOLUTION:
+        save_state(f"search_used_{user_id}", now)
+    index = load_search_index(user_id)
+    if index is None or index.get("account") != load_active_account(user_id):
+        context.application.create_task(run_inflight(user_id, "search_index", refresh_search_index(user_id, folders=True)))
+        await query.answer([], cache_time=0, is_personal=True,
+                           button=InlineQueryResultsButton("🔄 正在建立搜索索引，请稍后再试", start_parameter="search"))
+        return
+
+    results = []
+    for kind, entry in search_index(index, query.query):
+        if kind == "folder":
+            results.append(InlineQueryResultArticle(
+                id=f"f{entry['fid']}",
+                title=f"📁 {entry['name']}",
+                description=entry["path"],
+                input_message_content=InputTextMessageContent(f"📁 {entry['path']}\nCID: {entry['fid']}")
+            ))
+        else:
+            status = TASK_STATUS_DESC.get(entry["status"], "❓ 未知状态")
+            size_info = f" · {format_size(entry['size'])}" if entry["size"] else ""
+            results.append(InlineQueryResultArticle(
+                id=f"t{entry['info_hash'] or len(results)}",
+                title=entry["name"],
+                description=f"{status} · {entry['percent']}%{size_info}",
+                input_message_content=InputTextMessageContent(f"{status} {entry['name']}\n📊 进度: {entry['percent']}%{size_info}")
+            ))
+    await query.answer(results, cache_time=5, is_personal=True)
+
+# 命令菜单，setup_commands 注册前会与上次注册的内容比较
+BOT_COMMANDS = [
+    ("start", "开始与机器人交互"),
+    ("set_refresh_token", "设置 115 的 refresh_token"),
+    ("set_download_folder", "设置下载文件夹"),
+    ("set_archive_folder", "设置归档文件夹"),
+    ("add_account", "添加额外的 115 账号"),
+    ("accounts", "查看账号列表及剩余配额"),
+    ("use_account", "切换当前操作的账号"),
+    ("remove_account", "删除额外的 115 账号"),
+    ("status", "查看用户状态信息"),
+    ("quota", "查看离线任务配额信息"),
+    ("task_status", "查看未完成的云下载任务状态"),
+    ("pending", "查看待提交队列"),
+    ("retry_failed", "重新提交下载失败的任务"),
+    ("clear_tasks", "清除失败和已完成的任务"),
+    ("organize_videos", "整理视频文件"),
+    ("cleanup", "将下载文件夹的所有文件移动到归档文件夹"),
+    ("dedup", "查找归档中的重复文件"),
+    ("rules", "查看分类规则"),
+    ("set_rule", "添加或替换分类规则"),
+    ("del_rule", "删除分类规则"),
+    ("apply_rules", "按分类规则整理下载文件夹"),
+    ("schedule", "设置定时清理或整理")
+]
 
 async def setup_commands(app):
+    """注册命令菜单；命令列表的哈希与上次注册时相同则跳过 set_my_commands 请求"""
     logging.info("Executing: setup_commands")
+    digest = hashlib.sha256(json.dumps(BOT_COMMANDS, ensure_ascii=False).encode('utf-8')).hexdigest()
+    key = f"bot_commands_hash_{app.bot.id}"
+    if load_state(key) == digest:
+        logging.info("命令菜单未变化，跳过注册")
+        return
     await app.bot.set_my_commands([
-        BotCommand(command="start", description="开始与机器人交互"),
-        BotCommand(command="set_refresh_token", description="设置 115 的 refresh_token"),
-        BotCommand(command="set_download_folder", description="设置下载文件夹"),
-        BotCommand(command="set_archive_folder", description="设置归档文件夹"),
-        BotCommand(command="status", description="查看用户状态信息"),
-        BotCommand(command="quota", description="查看离线任务配额信息"),
-        BotCommand(command="task_status", description="查看未完成的云下载任务状态"),
-        BotCommand(command="organize_videos", description="整理视频文件"),
-        BotCommand(command="cleanup", description="将下载文件夹的所有文件移动到归档文件夹")
+        BotCommand(command=command, description=description) for command, description in BOT_COMMANDS
     ])
+    save_state(key, digest, flush=True)
 
-def main():
-    logging.info("Executing: main")
-    token = get_bot_token()
+async def on_startup(app):
+    install_signal_handlers(app)
+    start_config_writer()
+    schedule_all_user_tasks(app.job_queue)
+    resume_interrupted_tasks(app.job_queue)
+    await setup_commands(app)
+
+async def on_shutdown(app):
+    """PTB 停止接收更新并等待进行中的任务后调用：写入配置、用量和本地状态，关闭 HTTP 连接池"""
+    try:
+        await stop_config_writer()
+        flush_usage()
+        await flush_state_async()
+    finally:
+        await close_http_client()
+        if _RECORDER is not None:
+            _RECORDER.close()
+    if _SHUTDOWN_STARTED is not None:
+        logging.info(f"停机完成，用时 {time.monotonic() - _SHUTDOWN_STARTED:.1f} 秒")
+
+def build_application(token, request=None):
+    """
+    创建并配置 Application（处理器与后台任务），不启动轮询；供 main、启动基准测试和 replay.py 使用。
+    request 为 telegram.request.BaseRequest 实例时用它代替默认的 HTTP 请求（回放时不连接 Telegram）。
+    """
+    logging.info("Executing: build_application")
     # 如果设置了 TELEGRAM_API_BASE_URL，则将其作为 base_url 传入 ApplicationBuilder
+    builder = ApplicationBuilder().token(token).post_init(on_startup).post_shutdown(on_shutdown)
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
     if TELEGRAM_API_BASE_URL:
         logging.info(f"使用自定义 Telegram API 基址: {TELEGRAM_API_BASE_URL}")
-        app = ApplicationBuilder().token(token).base_url(TELEGRAM_API_BASE_URL).post_init(setup_commands).build()
+        builder = builder.base_url(TELEGRAM_API_BASE_URL)
     else:
         logging.info("使用默认的 Telegram API 基址")
-        app = ApplicationBuilder().token(token).post_init(setup_commands).build()
+    app = builder.build()
+
+    if RECORD_CASSETTE:
+        start_recording(RECORD_CASSETTE)
+        app.add_handler(TypeHandler(Update, record_update), group=-3)
+    # 停机过程中拒绝新的更新
+    app.add_handler(TypeHandler(Update, reject_during_shutdown), group=-2)
+    if WORKER_COUNT > 1:
+        # 最先运行，把不属于当前 worker 的更新转发出去
+        app.add_handler(TypeHandler(Update, route_update), group=-1)
 
     conv_handler = ConversationHandler(
         entry_points=[
-            CommandHandler("set_refresh_token", ask_refresh_token)
+            CommandHandler("set_refresh_token", ask_refresh_token),
+            CommandHandler("add_account", ask_account_token)
         ],
         states={
-            ASK_REFRESH_TOKEN: [MessageHandler(filters.TEXT & ~filters.COMMAND, save_refresh_token)]
+            ASK_REFRESH_TOKEN: [MessageHandler(filters.TEXT & ~filters.COMMAND, save_refresh_token)],
+            ASK_ACCOUNT_TOKEN: [MessageHandler(filters.TEXT & ~filters.COMMAND, save_refresh_token)]
         },
         fallbacks=[CommandHandler("cancel", cancel)]
     )
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("status", status))
+    app.add_handler(CommandHandler("accounts", handle_accounts))
+    app.add_handler(CommandHandler("use_account", handle_use_account))
+    app.add_handler(CommandHandler("remove_account", handle_remove_account))
     app.add_handler(CommandHandler("quota", handle_quota))
     app.add_handler(CommandHandler("task_status", handle_task_status))
+    app.add_handler(CommandHandler("pending", handle_pending))
+    app.add_handler(CommandHandler("retry_failed", track_handler("retry_failed", handle_retry_failed)))
+    app.add_handler(CommandHandler("clear_tasks", track_handler("clear_tasks", handle_clear_tasks)))
+    app.add_handler(CommandHandler("usage", handle_usage))
+    app.add_handler(CommandHandler("broadcast", handle_broadcast))
     app.add_handler(CommandHandler("organize_videos", handle_organize_videos))
     app.add_handler(CommandHandler("cleanup", handle_cleanup))
+    app.add_handler(CommandHandler("dedup", track_handler("dedup", handle_dedup)))
+    app.add_handler(CommandHandler("rules", handle_rules))
+    app.add_handler(CommandHandler("set_rule", handle_set_rule))
+    app.add_handler(CommandHandler("del_rule", handle_del_rule))
+    app.add_handler(CommandHandler("apply_rules", track_handler("apply_rules", handle_apply_rules)))
+    app.add_handler(CommandHandler("schedule", handle_schedule))
     app.add_handler(CommandHandler("set_download_folder", set_download_folder))
     app.add_handler(CommandHandler("set_archive_folder", set_archive_folder))
-    app.add_handler(CallbackQueryHandler(handle_folder_callback))  # 处理文件夹选择回调
+    app.add_handler(CallbackQueryHandler(handle_folder_callback, pattern=r"^(fs:|folder_)"))  # 处理文件夹选择回调
+    app.add_handler(CallbackQueryHandler(handle_task_callback, pattern=r"^ts:"))  # 处理任务面板按钮
+    app.add_handler(InlineQueryHandler(handle_inline_query))
     app.add_handler(conv_handler)
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_add_task))
+    app.add_handler(MessageHandler(filters.Document.ALL, track_handler("document", handle_document)))
+
+    # 后台定期刷新各账号的配额缓存
+    app.job_queue.run_repeating(refresh_quota_cache_job, interval=QUOTA_REFRESH_INTERVAL, first=10)
+    # 后台定期重新提交待提交队列中的链接
+    app.job_queue.run_repeating(drain_pending_tasks_job, interval=PENDING_DRAIN_INTERVAL, first=30)
+    # 后台定期写入文件夹快照等本地状态
+    app.job_queue.run_repeating(flush_state_job, interval=STATE_FLUSH_INTERVAL, first=STATE_FLUSH_INTERVAL)
+    # 后台定期检查 config.ini 是否被手动修改
+    app.job_queue.run_repeating(config_watch_job, interval=CONFIG_WATCH_INTERVAL, first=CONFIG_WATCH_INTERVAL)
+    # 后台定期把用量统计写入本地状态
+    app.job_queue.run_repeating(flush_usage_job, interval=USAGE_FLUSH_INTERVAL, first=USAGE_FLUSH_INTERVAL)
+    # 后台定期刷新内联搜索索引
+    app.job_queue.run_repeating(refresh_search_index_job, interval=SEARCH_TASKS_REFRESH_INTERVAL, first=SEARCH_TASKS_REFRESH_INTERVAL)
+    return app
 
-    app.run_polling()
+def main():
+    logging.info("Executing: main")
+    if not 0 <= WORKER_INDEX < WORKER_COUNT:
+        logging.error(f"WORKER_INDEX 必须在 0 到 WORKER_COUNT - 1（{WORKER_COUNT - 1}）之间，当前为 {WORKER_INDEX}。")
+        sys.exit(1)
+    token = get_bot_token()
+    preload_user_tokens()
+    app = build_application(token)
+    if WEBHOOK_URL:
+        logging.info(f"以 webhook 模式运行，worker {WORKER_INDEX}/{WORKER_COUNT}，监听端口 {worker_listen_port()}")
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=worker_listen_port(),
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            stop_signals=None  # 由 on_startup 安装的 begin_shutdown 处理
+        )
+    elif WORKER_COUNT > 1:
+        logging.error("WORKER_COUNT 大于 1 时必须设置 WEBHOOK_URL 以 webhook 模式运行。")
+        sys.exit(1)
+    else:
+        app.run_polling(stop_signals=None)  # 由 on_startup 安装的 begin_shutdown 处理
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,350 @@
+"""
+离线回放：把 RECORD_CASSETTE 录制的 Telegram 更新和 115 接口响应回放到 bot.py 的处理器上，不连接网络。
+
+用法：python replay.py cassette.jsonl [--speed 倍数] [--repeat 次数] [--json]
+                                       [--save-output 文件] [--compare 文件]
+
+- 在临时目录中以录制开始时的配置和本地状态启动，按录制时的间隔（除以 --speed）依次处理更新；
+  --speed 0 表示不等待，用于测量最大吞吐。
+- 115 接口请求优先按“接口 + 参数”匹配录制的响应，其次按接口顺序匹配，并按录制的耗时（除以 --speed）延迟返回；
+  没有匹配的请求返回 404 并计入“缺失”。
+- Telegram 请求由 FakeTelegramRequest 应答，机器人发送的消息作为回放输出，可用 --save-output 保存，
+  修改代码后用 --compare 比对（有差异时退出码为 1）。
+- --repeat 大于 1 时每一轮在新的子进程中执行，输出各轮耗时的中位数。
+- 后台任务（配额刷新、待提交队列、定时任务等）不会运行；发送文件添加任务需要下载文件，无法离线回放。
+"""
+import os
+import sys
+import re
+import json
+import logging
+import time
+import asyncio
+import argparse
+import tempfile
+import itertools
+import statistics
+import subprocess
+import collections
+import urllib.parse
+import configparser
+
+import httpx
+from telegram.request import BaseRequest
+
+REPLAY_BOT_TOKEN = "123456:replay"
+REPLAY_BOT_ID = 123456
+
+def load_cassette(path):
+    """返回 (start 记录, 其余事件)"""
+    with open(path, encoding='utf-8') as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    if not events or events[0]["kind"] != "start":
+        sys.exit(f"{path} 缺少 start 记录，请设置 RECORD_CASSETTE 重新录制")
+    return events[0], events[1:]
+
+def normalize(value):
+    # 与录制时一样经过一次 JSON 序列化，元组变为列表
+    return json.loads(json.dumps(value, ensure_ascii=False, default=str))
+
+def request_key(scrub, method, url, params, data, json_body):
+    """(接口, 参数) 两级匹配键；参数中的 token 与录制时一样被替换"""
+    endpoint = (method, urllib.parse.urlsplit(url).path)
+    body = json.dumps(normalize(scrub([params, data, json_body])), sort_keys=True, ensure_ascii=False)
+    return endpoint, body
+
+class ReplayHttpClient:
+    """代替共享的 httpx 客户端，按录制的顺序返回 115 接口的响应"""
+
+    is_closed = False
+
+    def __init__(self, events, scrub, speed):
+        self.scrub = scrub
+        self.speed = speed
+        self.exact = collections.defaultdict(collections.deque)
+        self.loose = collections.defaultdict(collections.deque)
+        for event in events:
+            endpoint, body = request_key(scrub, event["method"], event["url"], event.get("params"), event.get("data"), event.get("json"))
+            entry = (body, event)
+            self.exact[endpoint, body].append(entry)
+            self.loose[endpoint].append(entry)
+        self.stats = collections.Counter()
+        self.missing = []
+
+    async def aclose(self):
+        pass
+
+    async def get(self, url, **kwargs):
+        return await self._request("GET", url, kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self._request("POST", url, kwargs)
+
+    def _take(self, endpoint, body):
+        queue = self.exact.get((endpoint, body))
+        if queue:
+            entry = queue.popleft()
+            self.loose[endpoint].remove(entry)
+            self.stats["exact"] += 1
+            return entry[1]
+        queue = self.loose.get(endpoint)
+        if queue:
+            entry = queue.popleft()
+            self.exact[endpoint, entry[0]].remove(entry)
+            self.stats["endpoint"] += 1
+            return entry[1]
+        return None
+
+    async def _request(self, method, url, kwargs):
+        endpoint, body = request_key(self.scrub, method, url, kwargs.get("params"), kwargs.get("data"), kwargs.get("json"))
+        request = httpx.Request(method, url)
+        event = self._take(endpoint, body)
+        if event is None:
+            self.stats["missing"] += 1
+            self.missing.append(f"{method} {endpoint[1]} {body[:200]}")
+            return httpx.Response(404, json={"state": False, "message": "回放中没有匹配的录制响应"}, request=request)
+        if self.speed:
+            await asyncio.sleep(event.get("elapsed", 0) / self.speed)
+        if event.get("error"):
+            raise getattr(httpx, event["error"], httpx.TransportError)("回放录制的错误", request=request)
+        if event.get("body") is not None:
+            return httpx.Response(event["status"], json=event["body"], request=request)
+        return httpx.Response(event["status"], text=event.get("text") or "", request=request)
+
+    def unused(self):
+        return collections.Counter(f"{method} {path}" for (method, path), queue in self.loose.items() for _ in queue)
+
+class FakeTelegramRequest(BaseRequest):
+    """应答机器人发出的 Telegram Bot API 请求，并记录发送的消息作为回放输出"""
+
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.outputs = []
+        self.message_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] += 1
+        if endpoint not in ("getMe", "setMyCommands", "deleteMyCommands"):
+            self.outputs.append({"method": endpoint, **{key: params[key] for key in sorted(params) if key != "cache_time"}})
+        return 200, json.dumps({"ok": True, "result": self.result(endpoint, params)}).encode()
+
+    def result(self, endpoint, params):
+        if endpoint == "getMe":
+            return {"id": REPLAY_BOT_ID, "is_bot": True, "first_name": "replay", "username": "replay_bot"}
+        if endpoint in ("sendMessage", "editMessageText"):
+            return {
+                "message_id": params.get("message_id") or next(self.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": params.get("chat_id", 0), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        return True
+
+class ReplayClock:
+    """代替 bot 模块中的 time：time() 返回录制时对应的时间，缓存过期等判断与录制时一致；其余函数不变"""
+
+    def __init__(self, wall):
+        self.wall = wall
+        self.offset = 0.0
+
+    def time(self):
+        return self.wall + self.offset
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+def update_label(update):
+    """按命令、回调前缀或更新类型归类，用于统计耗时"""
+    if update.callback_query:
+        return "callback " + (update.callback_query.data or "").split(":")[0]
+    if update.inline_query:
+        return "inline_query"
+    message = update.effective_message
+    if message and message.text and message.text.startswith("/"):
+        return message.text.split()[0].split("@")[0]
+    if message and message.document:
+        return "document"
+    return "message"
+
+def prepare_workdir(start):
+    """在临时目录中写入录制开始时的配置和本地状态；token 已被替换，设置为长期有效以免回放时刷新"""
+    workdir = tempfile.mkdtemp(prefix="replay-")
+    config = configparser.ConfigParser()
+    config.read_dict(start["config"])
+    for section in config.sections():
+        if "access_token_expire_at" in config[section]:
+            config[section]["access_token_expire_at"] = "9999999999"
+    with open(os.path.join(workdir, "config.ini"), "w") as f:
+        config.write(f)
+    with open(os.path.join(workdir, "state.json"), "w", encoding="utf-8") as f:
+        json.dump(start["state"], f, ensure_ascii=False)
+    return workdir
+
+async def replay(path, speed):
+    start, events = load_cassette(path)
+    os.chdir(prepare_workdir(start))
+    for name in ("RECORD_CASSETTE", "TOKEN_ENCRYPTION_KEY", "SHARED_STATE_DB", "WORKER_COUNT", "WEBHOOK_URL", "BOT_STATE_FILE",
+                 "BOT_DURABLE_STATE_FILE"):
+        os.environ.pop(name, None)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot
+    from telegram import Update
+    logging.getLogger().setLevel(logging.WARNING)
+
+    http = ReplayHttpClient([e for e in events if e["kind"] == "http"], bot.scrub_secrets, speed)
+    clock = ReplayClock(start["wall"])
+    bot.get_http_client = lambda: http
+    bot.time = clock
+
+    # 文件夹浏览的会话 ID 是随机生成的：回放时按创建顺序使用 r1、r2...，并把录制的会话 ID 按出现顺序对应过去
+    create_folder_session = bot.create_folder_session
+    sids = {}
+    counter = itertools.count(1)
+
+    def replay_folder_session(user_id, selection_type):
+        session = bot._FOLDER_SESSIONS.pop(create_folder_session(user_id, selection_type))
+        sid = f"r{next(counter)}"
+        bot._FOLDER_SESSIONS[sid] = session
+        return sid
+
+    def map_sid(match):
+        return "fs:" + sids.setdefault(match.group(1), f"r{len(sids) + 1}") + ":"
+
+    bot.create_folder_session = replay_folder_session
+
+    request = FakeTelegramRequest()
+    app = bot.build_application(REPLAY_BOT_TOKEN, request=request)
+    errors = collections.Counter()
+    label = None
+
+    async def record_error(update, context):
+        errors[label] += 1
+        logging.error(f"回放 {label} 时发生异常: {context.error!r}")
+
+    app.add_error_handler(record_error)
+    await app.initialize()
+    await bot.on_startup(app)
+    background = asyncio.all_tasks()  # 配置写入任务等常驻任务，回放结束时不等待
+
+    latencies = collections.defaultdict(list)
+    updates = [e for e in events if e["kind"] == "update"]
+    started = time.perf_counter()
+    for event in updates:
+        if speed:
+            delay = started + event["t"] / speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        clock.offset = event["t"]
+        data = event["update"]
+        if data.get("callback_query", {}).get("data"):
+            data["callback_query"]["data"] = re.sub(r"^fs:([^:]+):", map_sid, data["callback_query"]["data"])
+        update = Update.de_json(data, app.bot)
+        label = update_label(update)
+        t0 = time.perf_counter()
+        await app.process_update(update)
+        latencies[label].append((time.perf_counter() - t0) * 1000)
+    # 等待处理器在后台创建的任务（如建立搜索索引）
+    pending = asyncio.all_tasks() - background
+    if pending:
+        await asyncio.wait(pending, timeout=30)
+    elapsed = time.perf_counter() - started
+
+    await bot.on_shutdown(app)
+    await app.shutdown()
+    return {
+        "updates": len(updates),
+        "recorded_seconds": updates[-1]["t"] - updates[0]["t"] if updates else 0,
+        "elapsed": elapsed,
+        "handlers": {name: {"count": len(values), "median_ms": statistics.median(values), "max_ms": max(values),
+                            "errors": errors[name]} for name, values in sorted(latencies.items())},
+        "http": dict(http.stats),
+        "http_missing": http.missing[:20],
+        "http_unused": dict(http.unused()),
+        "telegram": dict(request.calls),
+        "outputs": request.outputs,
+    }
+
+def print_summary(path, speed, summary):
+    print(f"回放 {path}：{summary['updates']} 个更新，录制时长 {summary['recorded_seconds']:.1f} 秒，"
+          f"回放用时 {summary['elapsed']:.2f} 秒（speed={speed:g}）")
+    print(f"{'处理器':<24}{'次数':>6}{'中位数 ms':>12}{'最大 ms':>10}{'错误':>6}")
+    for name, stats in summary["handlers"].items():
+        print(f"{name:<27}{stats['count']:>6}{stats['median_ms']:>12.1f}{stats['max_ms']:>10.1f}{stats['errors']:>6}")
+    http = summary["http"]
+    print(f"115 接口：参数匹配 {http.get('exact', 0)}，按接口匹配 {http.get('endpoint', 0)}，缺失 {http.get('missing', 0)}，"
+          f"未使用 {sum(summary['http_unused'].values())}")
+    for line in summary["http_missing"]:
+        print(f"  缺失: {line}")
+    print(f"Telegram 请求：{sum(summary['telegram'].values())}（" +
+          "，".join(f"{name} {count}" for name, count in sorted(summary["telegram"].items())) + "）")
+
+def compare_outputs(expected, actual):
+    """逐条比较回放输出，返回差异描述"""
+    diffs = []
+    for i, (a, b) in enumerate(itertools.zip_longest(expected, actual)):
+        if a != b:
+            diffs.append(f"#{i}:\n  之前: {json.dumps(a, ensure_ascii=False)[:300]}\n  现在: {json.dumps(b, ensure_ascii=False)[:300]}")
+    return diffs
+
+def run_child(path, speed):
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), path, "--speed", str(speed), "--json"],
+        stderr=subprocess.DEVNULL,
+    )
+    # bot 的日志也会输出到 stdout，结果在最后一行
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="离线回放录制的 Telegram 更新和 115 接口响应")
+    parser.add_argument("cassette")
+    parser.add_argument("--speed", type=float, default=10, help="回放倍速，0 表示不等待（默认 10）")
+    parser.add_argument("--repeat", type=int, default=1, help="回放轮数，每轮在新的子进程中执行")
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出结果")
+    parser.add_argument("--save-output", help="保存机器人发送的消息，供之后 --compare 比对")
+    parser.add_argument("--compare", help="与之前保存的输出比对，有差异时退出码为 1")
+    args = parser.parse_args()
+    # 回放时会切换到临时目录，先把路径转换为绝对路径
+    path = os.path.abspath(args.cassette)
+    save_output = args.save_output and os.path.abspath(args.save_output)
+    compare = args.compare and os.path.abspath(args.compare)
+
+    if args.repeat > 1:
+        results = [run_child(path, args.speed) for _ in range(args.repeat)]
+        summary = results[-1]
+        elapsed = [r["elapsed"] for r in results]
+        print(f"{args.repeat} 轮回放用时：中位数 {statistics.median(elapsed):.2f} 秒，"
+              f"最小 {min(elapsed):.2f} 秒，最大 {max(elapsed):.2f} 秒")
+    else:
+        summary = asyncio.run(replay(path, args.speed))
+        if args.json:
+            print(json.dumps(summary, ensure_ascii=False))
+        else:
+            print_summary(args.cassette, args.speed, summary)
+
+    if save_output:
+        with open(save_output, "w", encoding="utf-8") as f:
+            json.dump(summary["outputs"], f, ensure_ascii=False, indent=1)
+    if compare:
+        with open(compare, encoding="utf-8") as f:
+            diffs = compare_outputs(json.load(f), summary["outputs"])
+        if diffs:
+            print(f"❌ 回放输出与 {args.compare} 有 {len(diffs)} 处不同：")
+            print("\n".join(diffs[:20]))
+            sys.exit(1)
+        print(f"✅ 回放输出与 {args.compare} 一致（{len(summary['outputs'])} 条）")
+
+if __name__ == '__main__':
+    main()